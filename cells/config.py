@@ -1,9 +1,16 @@
+import copy
+import typing
 import yaml
 import os
 import shutil
 
 
 class ConfigManager:
+    # 进程内的 YAML 解析缓存：路径 -> ((修改时间, 大小), 解析结果)
+    PARSED_FILES: typing.Dict[str, typing.Tuple[tuple, typing.Any]] = {}
+    # 合并会话配置、补全后的结果：(配置文件, 会话配置文件, 模板文件, 是否补全) -> (各文件状态, 配置)
+    MERGED_CONFIGS: typing.Dict[tuple, typing.Tuple[tuple, dict]] = {}
+
     def __init__(self, config_name, template_name, launcher_id=""):
         self.config_name = config_name
         self.config_file = f"{config_name}.yaml"
@@ -23,9 +30,6 @@ class ConfigManager:
                 # 如果模板文件不存在，输出相应的日志
                 print(f"模板文件 {self.template_file} 不存在，无法创建配置文件 {self.config_file}")
 
-        with open(self.config_file, "r", encoding="utf-8") as config_file:
-            self.data = yaml.safe_load(config_file)
-
         if self.launcher_id:
             if not os.path.exists(self.config_file_id) and os.path.exists(self.template_file):
                 # 如果config_name_{launcher_id}.yaml不存在，则创建并在每行前加上#
@@ -37,21 +41,58 @@ class ConfigManager:
                             new_config_file.write(f"{line}")
                         else:
                             new_config_file.write(f"# {line}")
-            if os.path.exists(self.config_file_id):
-                with open(self.config_file_id, "r", encoding="utf-8") as new_config_file:
-                    new_data = yaml.safe_load(new_config_file)
-                    if new_data:
-                        self.data.update(new_data)  # 合并new_config_file的内容，覆盖原有的配置
+
+        # 相关文件均未修改时直接使用上次合并的结果
+        cache_key = (self.config_file, self.config_file_id if self.launcher_id else "", self.template_file, completion)
+        cached = ConfigManager.MERGED_CONFIGS.get(cache_key)
+        if cached is not None and cached[0] == self._files_state():
+            self.data = copy.deepcopy(cached[1])
+            return
+
+        self.data = self._read_yaml(self.config_file) or {}
+
+        if self.launcher_id and os.path.exists(self.config_file_id):
+            new_data = self._read_yaml(self.config_file_id)
+            if new_data:
+                self.data.update(new_data)  # 合并new_config_file的内容，覆盖原有的配置
 
         if completion:
             await self.complete_config()
 
+        # 补全可能改写了配置文件，因此在补全之后记录文件状态
+        ConfigManager.MERGED_CONFIGS[cache_key] = (self._files_state(), copy.deepcopy(self.data))
+
+    def _files_state(self) -> tuple:
+        return tuple(self._file_state(path) for path in (self.config_file, self.config_file_id if self.launcher_id else "", self.template_file))
+
+    @staticmethod
+    def _file_state(path: str) -> typing.Optional[tuple]:
+        if not path:
+            return None
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
+
+    @classmethod
+    def _read_yaml(cls, path: str) -> typing.Any:
+        """
+        读取并解析 YAML，文件未修改时使用缓存；返回副本，调用方可随意修改
+        """
+        state = cls._file_state(path)
+        cached = cls.PARSED_FILES.get(path)
+        if cached is None or cached[0] != state:
+            with open(path, "r", encoding="utf-8") as file:
+                cached = (state, yaml.safe_load(file))
+            cls.PARSED_FILES[path] = cached
+        return copy.deepcopy(cached[1])
+
     async def complete_config(self):
         # 检查是否有缺失的配置项，进行补全
         updated = False
 
-        with open(self.template_file, "r", encoding="utf-8") as template_file:
-            self.template_data = yaml.safe_load(template_file)
+        self.template_data = self._read_yaml(self.template_file)
 
         for key, value in self.template_data.items():
             if key not in self.data:
@@ -5,12 +5,15 @@ import functools
 import os
 from typing import Any, Coroutine
 import asyncio
+import hashlib
 import yaml
 from datetime import datetime
 from pkg.core import app
 from pkg.plugin.context import APIHost
 from pkg.provider import entities as llm_entities
 from pkg.provider.modelmgr import errors
+from plugins.Waifu.cells.llm_scheduler import LLMScheduler
+from plugins.Waifu.organs.lru_cache import LRUCache
 
 
 def handle_errors(func):
@@ -29,22 +32,91 @@ def handle_errors(func):
 
 
 class Generator:
+    """
+    模型的选定结果由进程内所有 Generator 共享，只在模型配置文件或LangBot模型列表变化时重新解析；
+    实例本身只保存各会话、各组件的破甲提示及发言人等轻量状态
+    """
+
+    # 进程内共享的模型配置及选定模型
+    SHARED_MODEL_CONFIG: dict = {}
+    SHARED_MODEL_INFO = None
+    # 上次解析时的 (模型配置文件修改时间, LangBot模型UUID列表)
+    _model_state: typing.Optional[tuple] = None
+    _model_lock: typing.Optional[asyncio.Lock] = None
+    # 破甲文件内容缓存：路径 -> (修改时间, 内容)
+    JAIL_BREAK_TEXTS: typing.Dict[str, typing.Tuple[int, str]] = {}
+    # 辅助提问的模型回复缓存（默认关闭），按 模型 + 完整消息内容 寻址，每个方法一个缓存、各自的存活秒数
+    RESPONSE_CACHE_ENABLED: bool = False
+    RESPONSE_CACHE_PERSIST: bool = False
+    RESPONSE_CACHE_MAX_BYTES: int = 4 * 1024 * 1024
+    RESPONSE_CACHE_TTLS: typing.Dict[str, float] = {
+        "return_string_without_jail_break": 7 * 24 * 3600,
+        "return_list": 7 * 24 * 3600,
+        "return_number": 24 * 3600,
+        "select_from_list": 24 * 3600,
+    }
+
     ap: app.Application
 
-    def __init__(self, ap: app.Application):
+    def __init__(self, ap: app.Application, priority: int = LLMScheduler.REPLY):
         self.ap = ap
+        self.priority = priority  # 未在上下文中指定优先级时使用
         self._jail_break_dict = {}
         self._jail_break_type = ""
         self._speakers = []
         self.model_config_path = "data/plugins/Waifu/config/model_config.yaml"
-        self.selected_model_info = None
-        self.model_config = {}
 
+    @property
+    def selected_model_info(self):
+        return Generator.SHARED_MODEL_INFO
+
+    @selected_model_info.setter
+    def selected_model_info(self, model_info):
+        Generator.SHARED_MODEL_INFO = model_info
 
-    async def _initialize_model_config(self):
+    @property
+    def model_config(self) -> dict:
+        return Generator.SHARED_MODEL_CONFIG
+
+    @model_config.setter
+    def model_config(self, config: dict):
+        Generator.SHARED_MODEL_CONFIG = config
+
+    async def _initialize_model_config(self, force: bool = False):
         """Loads or creates the model configuration and sets the selected model."""
-        await self._load_or_create_model_config()
-        await self._set_selected_model()
+        if Generator._model_lock is None:
+            Generator._model_lock = asyncio.Lock()
+        async with Generator._model_lock:
+            # 已由其他会话或组件解析过，且配置未变化时直接复用
+            if not force and Generator._model_state is not None and Generator._model_state == self._get_model_state():
+                return
+            await self._load_or_create_model_config()
+            await self._set_selected_model()
+            Generator._model_state = self._get_model_state()
+
+    @classmethod
+    def configure_response_cache(cls, enabled: bool, persist: bool = False, max_bytes: typing.Optional[int] = None, ttls: typing.Optional[typing.Dict[str, float]] = None):
+        cls.RESPONSE_CACHE_ENABLED = bool(enabled)
+        cls.RESPONSE_CACHE_PERSIST = bool(persist)
+        if max_bytes is not None:
+            cls.RESPONSE_CACHE_MAX_BYTES = int(max_bytes)
+        if ttls:
+            cls.RESPONSE_CACHE_TTLS = {**cls.RESPONSE_CACHE_TTLS, **ttls}
+
+    @classmethod
+    def response_cache_stats(cls) -> str:
+        lines = [f"{name.removeprefix('llm_')}：{cache.stats()}" for name, cache in LRUCache.SHARED.items() if name.startswith("llm_")]
+        if not lines:
+            return "模型回复缓存未启用或暂无记录。"
+        return "\n".join(lines)
+
+    def _get_model_state(self) -> tuple:
+        try:
+            mtime = os.stat(self.model_config_path).st_mtime_ns
+        except OSError:
+            mtime = None
+        models = tuple(model_info.model_entity.uuid for model_info in (self.ap.model_mgr.llm_models or []))
+        return mtime, models
 
     async def _load_or_create_model_config(self):
         """加载或创建 model_config.yaml，仅当模型列表变化时才更新"""
@@ -221,8 +293,8 @@ class Generator:
         prompt = f"""Please select the most suitable option from the given list based on the question. Question: {question} List: {options}. Ensure your answer contains only one option from the list and no additional explanation or context."""
         messages = self._get_question_prompts(prompt, output_format="text", system_prompt=system_prompt)
         self.ap.logger.info("发送请求：\n{}".format(self.messages_to_readable_str(messages)))
-        response = await model_info.requester.invoke_llm(None, model=model_info, messages=messages)
-        cleaned_response = self.clean_response(response.content)
+        content = await self._invoke_cached("select_from_list", model_info, messages)
+        cleaned_response = self.clean_response(content)
         self.ap.logger.info("模型回复：\n{}".format(cleaned_response))
         return cleaned_response
 
@@ -241,8 +313,8 @@ class Generator:
 
         self.ap.logger.info("发送请求：\n{}".format(self.messages_to_readable_str(messages)))
 
-        response = await model_info.requester.invoke_llm(None, model=model_info, messages=messages)
-        cleaned_response = self.clean_response(response.content)
+        content = await self._invoke_cached("return_list", model_info, messages)
+        cleaned_response = self.clean_response(content)
 
         self.ap.logger.info("模型回复：\n{}".format(cleaned_response))
         return self._parse_json_list(cleaned_response, generate_tags)
@@ -261,7 +333,7 @@ class Generator:
 
         self.ap.logger.info("发送请求：\n{}".format(self.messages_to_readable_str(messages)))
 
-        response = await model_info.requester.invoke_llm(None, model=model_info, messages=messages)
+        response = await self._invoke_llm(model_info, messages)
         cleaned_response = self.clean_response(response.content)
 
         self.ap.logger.info("模型回复：\n{}".format(cleaned_response))
@@ -282,8 +354,8 @@ class Generator:
 
         self.ap.logger.info("发送请求：\n{}".format(self.messages_to_readable_str(messages)))
 
-        response = await model_info.requester.invoke_llm(None, model=model_info, messages=messages)
-        cleaned_response = self.clean_response(response.content)
+        content = await self._invoke_cached("return_number", model_info, messages)
+        cleaned_response = self.clean_response(content)
 
         self.ap.logger.info("模型回复：\n{}".format(cleaned_response))
         return self._parse_number(cleaned_response)
@@ -302,7 +374,7 @@ class Generator:
 
         self.ap.logger.info("发送请求：\n{}".format(self.messages_to_readable_str(messages)))
 
-        response = await model_info.requester.invoke_llm(None, model=model_info, messages=messages)
+        response = await self._invoke_llm(model_info, messages)
         cleaned_response = self.clean_response(response.content)
 
         self.ap.logger.info("模型回复：\n{}".format(cleaned_response))
@@ -324,8 +396,8 @@ class Generator:
 
         self.ap.logger.info("发送请求：\n{}".format(self.messages_to_readable_str(messages)))
 
-        response = await model_info.requester.invoke_llm(None, model=model_info, messages=messages)
-        cleaned_response = self.clean_response(response.content)
+        content = await self._invoke_cached("return_string_without_jail_break", model_info, messages)
+        cleaned_response = self.clean_response(content)
 
         self.ap.logger.info("模型回复：\n{}".format(cleaned_response))
         return cleaned_response
@@ -348,7 +420,7 @@ class Generator:
 
         self.ap.logger.info("发送请求：\n{}".format(self.messages_to_readable_str(messages)))
 
-        response = await model_info.requester.invoke_llm(None, model=model_info, messages=messages)
+        response = await self._invoke_llm(model_info, messages)
         cleaned_response = self.clean_response(response.content)
 
         self.ap.logger.info("模型回复：\n{}".format(cleaned_response))
@@ -369,12 +441,51 @@ class Generator:
 
         self.ap.logger.info("发送请求：\n{}".format(self.messages_to_readable_str(messages)))
 
-        response = await model_info.requester.invoke_llm(None, model=model_info, messages=messages)
+        response = await self._invoke_llm(model_info, messages)
         cleaned_response = self.clean_response(response.content)
 
         self.ap.logger.info("模型回复：\n{}".format(cleaned_response))
         return cleaned_response
 
+    async def _invoke_llm(self, model_info, messages: typing.List[llm_entities.Message]) -> llm_entities.Message:
+        """
+        经全局调度排队后调用模型
+        """
+        return await LLMScheduler.run(
+            model_info.model_entity.uuid,
+            lambda: model_info.requester.invoke_llm(None, model=model_info, messages=messages),
+            self.priority,
+        )
+
+    async def _invoke_cached(self, method: str, model_info, messages: typing.List[llm_entities.Message]) -> str:
+        """
+        调用模型并返回未清理的回复文本；启用回复缓存时，同一模型收到完全相同的消息直接返回缓存结果
+        """
+        key = self._response_cache_key(model_info, messages) if Generator.RESPONSE_CACHE_ENABLED else None
+        if key is None:
+            return (await self._invoke_llm(model_info, messages)).content
+        uuid = model_info.model_entity.uuid
+        file = f"data/plugins/Waifu/data/llm_cache_{method}_{uuid}.jsonl" if Generator.RESPONSE_CACHE_PERSIST else None
+        cache = LRUCache.shared(self.ap, f"llm_{method}_{uuid}", 100000, Generator.RESPONSE_CACHE_MAX_BYTES, Generator.RESPONSE_CACHE_TTLS.get(method, 0), file)
+        content = cache.get(key)
+        if content is not None:
+            self.ap.logger.info("命中模型回复缓存")
+            return content
+        content = (await self._invoke_llm(model_info, messages)).content
+        if isinstance(content, str):
+            cache.put(key, content)
+        return content
+
+    @staticmethod
+    def _response_cache_key(model_info, messages: typing.List[llm_entities.Message]) -> typing.Optional[str]:
+        normalized = []
+        for message in messages:
+            if not isinstance(message.content, str):
+                return None  # 图片等非文本内容不缓存
+            normalized.append([message.role, message.content.strip()])
+        payload = json.dumps([model_info.model_entity.uuid, normalized], ensure_ascii=False)
+        return hashlib.sha1(payload.encode("utf-8")).hexdigest()
+
     def clean_response(self, response: str) -> str:
         if self._speakers:
             # 使用正则去掉self._speakers中的任何名称，后跟冒号或中文冒号及其后的空格
@@ -500,16 +611,30 @@ class Generator:
         if jail_break_type == "all":
             # Load all jail break files
             for type_name in ["before", "after", "end"]:
-                filepath = f"{base_filepath}jail_break_{type_name}.txt"
-                if os.path.exists(filepath):
-                    with open(filepath, "r", encoding="utf-8") as f:
-                        self._jail_break_dict[type_name] = f.read().replace("{{user}}", user_name)
+                text = self._read_jail_break(f"{base_filepath}jail_break_{type_name}.txt")
+                if text is not None:
+                    self._jail_break_dict[type_name] = text.replace("{{user}}", user_name)
         else:
             # Load a specific jail break type
-            filepath = f"{base_filepath}jail_break_{jail_break_type}.txt"
-            if os.path.exists(filepath):
-                with open(filepath, "r", encoding="utf-8") as f:
-                    self._jail_break_dict[jail_break_type] = f.read().replace("{{user}}", user_name)
+            text = self._read_jail_break(f"{base_filepath}jail_break_{jail_break_type}.txt")
+            if text is not None:
+                self._jail_break_dict[jail_break_type] = text.replace("{{user}}", user_name)
+
+    def _read_jail_break(self, filepath: str) -> typing.Optional[str]:
+        """
+        各会话、各组件共用破甲文件内容，文件修改后重新读取
+        """
+        try:
+            mtime = os.stat(filepath).st_mtime_ns
+        except OSError:
+            return None
+        cached = Generator.JAIL_BREAK_TEXTS.get(filepath)
+        if cached is not None and cached[0] == mtime:
+            return cached[1]
+        with open(filepath, "r", encoding="utf-8") as f:
+            text = f.read()
+        Generator.JAIL_BREAK_TEXTS[filepath] = (mtime, text)
+        return text
 
     def set_speakers(self, speakers: list):
         self._speakers = speakers
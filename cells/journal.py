@@ -0,0 +1,91 @@
+import json
+import os
+import typing
+from pkg.core import app
+from plugins.Waifu.cells.persistence import Persistence
+
+
+class Journal:
+    """
+    追加写入的JSONL日志，每行一条记录
+    写入代价与单条记录大小相关，与历史长度无关；写入中途崩溃最多损坏最后一行
+    写盘交由 Persistence 在后台批量完成
+    """
+
+    ap: app.Application
+    _file: str
+    _count: int
+
+    def __init__(self, ap: app.Application, file: str):
+        self.ap = ap
+        self._file = file
+        self._count = 0
+
+    def __len__(self) -> int:
+        return self._count
+
+    async def read(self) -> typing.List[dict]:
+        """
+        先写入尚未写盘的记录，再读取全部记录
+        """
+        await Persistence.flush_file(self._file)
+        return self.read_written()
+
+    def read_written(self) -> typing.List[dict]:
+        """
+        读取已写盘的全部记录，截掉写入中断留下的不完整行，避免之后的追加与其粘连
+        """
+        records = []
+        if not os.path.exists(self._file):
+            self._count = 0
+            return records
+        with open(self._file, "rb") as file:
+            data = file.read()
+        end = data.rfind(b"\n") + 1
+        if end < len(data):
+            self.ap.logger.warning(f"Dropping incomplete last record of journal '{self._file}'.")
+            with open(self._file, "r+b") as file:
+                file.truncate(end)
+            data = data[:end]
+        for line_no, line in enumerate(data.decode("utf-8").splitlines(), 1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                records.append(json.loads(line))
+            except json.JSONDecodeError:
+                self.ap.logger.warning(f"Skipping broken record at line {line_no} of journal '{self._file}'.")
+        self._count = len(records)
+        return records
+
+    def append(self, record: dict):
+        self.extend([record])
+
+    def extend(self, records: typing.List[dict]):
+        if not records:
+            return
+        Persistence.append(self._file, "".join(json.dumps(record, ensure_ascii=False) + "\n" for record in records))
+        self._count += len(records)
+
+    def truncate(self):
+        """
+        快照写入后清空日志，Persistence 保证先写快照再清空
+        """
+        Persistence.write(self._file, "")
+        self._count = 0
+
+    def rewrite(self, records: typing.Callable[[], typing.List[dict]], count: int):
+        """
+        用当前全部记录整体替换日志，记录在写盘前才生成，count 为调用时的记录条数
+        """
+        Persistence.write(self._file, lambda: "".join(json.dumps(record, ensure_ascii=False) + "\n" for record in records()))
+        self._count = count
+
+    async def delete(self):
+        await Persistence.discard(self._file)
+        if os.path.exists(self._file):
+            os.remove(self._file)
+        self._count = 0
+
+    def file(self) -> str:
+        return self._file
@@ -0,0 +1,160 @@
+import asyncio
+import contextlib
+import contextvars
+import typing
+from collections import OrderedDict, deque
+from pkg.core import app
+
+
+class _ModelQueue:
+    running: int
+    # 优先级 -> (会话 -> 等待中的请求)
+    waiting: typing.Dict[int, "OrderedDict[str, deque]"]
+    served: int
+    max_depth: int
+
+    def __init__(self):
+        self.running = 0
+        self.waiting = {}
+        self.served = 0
+        self.max_depth = 0
+
+    def depth(self, priority: typing.Optional[int] = None) -> int:
+        priorities = [priority] if priority is not None else list(self.waiting)
+        return sum(len(queue) for p in priorities for queue in self.waiting.get(p, {}).values())
+
+
+class LLMScheduler:
+    """
+    进程级LLM请求调度：所有 Generator 的模型调用经此排队
+    - 每个模型同时进行的请求数不超过 MAX_CONCURRENCY
+    - 按优先级放行，数值越小越优先：回复 > 旁白、数值判断 > 记忆总结、主动问候等后台任务
+    - 同一优先级内按会话轮流放行，单个会话的大量请求不会挤占其他会话
+    请求的优先级及所属会话取自上下文变量，由调用方在处理消息或执行后台任务时设定
+    """
+
+    REPLY = 0
+    NARRATION = 1
+    BACKGROUND = 2
+    PRIORITY_NAMES = {REPLY: "回复", NARRATION: "旁白", BACKGROUND: "后台"}
+
+    ap: typing.Optional[app.Application] = None
+    MAX_CONCURRENCY: int = 4
+    MODELS: typing.Dict[str, _ModelQueue] = {}
+    PRIORITY: contextvars.ContextVar = contextvars.ContextVar("waifu_llm_priority", default=None)
+    LAUNCHER: contextvars.ContextVar = contextvars.ContextVar("waifu_llm_launcher", default="")
+
+    @classmethod
+    def configure(cls, ap: app.Application, max_concurrency: typing.Optional[int] = None):
+        cls.ap = ap
+        if max_concurrency is not None:
+            cls.MAX_CONCURRENCY = max(1, int(max_concurrency))
+            for model in list(cls.MODELS):
+                cls._dispatch(model)
+
+    @classmethod
+    @contextlib.contextmanager
+    def priority(cls, priority: int):
+        """
+        在 with 范围内发出的请求使用指定优先级
+        """
+        token = cls.PRIORITY.set(priority)
+        try:
+            yield
+        finally:
+            cls.PRIORITY.reset(token)
+
+    @classmethod
+    def set_launcher(cls, launcher_id: str):
+        """
+        标记当前任务所属会话，之后在此任务中创建的任务一并继承
+        """
+        cls.LAUNCHER.set(launcher_id)
+
+    @classmethod
+    async def run(cls, model: str, call: typing.Callable[[], typing.Awaitable[typing.Any]], default_priority: int = REPLY) -> typing.Any:
+        priority = cls.PRIORITY.get()
+        if priority is None:
+            priority = default_priority
+        await cls._acquire(model, priority, cls.LAUNCHER.get())
+        try:
+            return await call()
+        finally:
+            cls._release(model)
+
+    @classmethod
+    async def _acquire(cls, model: str, priority: int, launcher_id: str):
+        queue = cls.MODELS.setdefault(model, _ModelQueue())
+        if queue.running < cls.MAX_CONCURRENCY and queue.depth() == 0:
+            queue.running += 1
+            queue.served += 1
+            return
+        waiter = asyncio.get_running_loop().create_future()
+        launchers = queue.waiting.setdefault(priority, OrderedDict())
+        launchers.setdefault(launcher_id, deque()).append(waiter)
+        queue.max_depth = max(queue.max_depth, queue.depth())
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                # 已获得名额但调用方被取消，归还名额
+                cls._release(model)
+            else:
+                cls._remove_waiter(queue, priority, launcher_id, waiter)
+            raise
+
+    @classmethod
+    def _release(cls, model: str):
+        queue = cls.MODELS[model]
+        queue.running -= 1
+        cls._dispatch(model)
+
+    @classmethod
+    def _dispatch(cls, model: str):
+        queue = cls.MODELS[model]
+        while queue.running < cls.MAX_CONCURRENCY:
+            waiter = cls._next_waiter(queue)
+            if waiter is None:
+                return
+            queue.running += 1
+            queue.served += 1
+            waiter.set_result(None)
+
+    @staticmethod
+    def _next_waiter(queue: _ModelQueue) -> typing.Optional[asyncio.Future]:
+        for priority in sorted(queue.waiting):
+            launchers = queue.waiting[priority]
+            while launchers:
+                launcher_id, waiters = next(iter(launchers.items()))
+                waiter = waiters.popleft()
+                # 轮到的会话放到队尾
+                if waiters:
+                    launchers.move_to_end(launcher_id)
+                else:
+                    del launchers[launcher_id]
+                if not waiter.done():
+                    return waiter
+        return None
+
+    @staticmethod
+    def _remove_waiter(queue: _ModelQueue, priority: int, launcher_id: str, waiter: asyncio.Future):
+        launchers = queue.waiting.get(priority, {})
+        waiters = launchers.get(launcher_id)
+        if waiters is None:
+            return
+        try:
+            waiters.remove(waiter)
+        except ValueError:
+            return
+        if not waiters:
+            del launchers[launcher_id]
+
+    @classmethod
+    def stats(cls) -> str:
+        if not cls.MODELS:
+            return "暂无模型请求。"
+        lines = []
+        for model, queue in cls.MODELS.items():
+            waiting = " ".join(f"{name}：{queue.depth(priority)}" for priority, name in cls.PRIORITY_NAMES.items())
+            lines.append(f"{model} 进行中：{queue.running}/{cls.MAX_CONCURRENCY} 排队 {waiting} 最大排队：{queue.max_depth} 已放行：{queue.served}")
+        return "\n".join(lines)
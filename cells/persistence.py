@@ -0,0 +1,268 @@
+import asyncio
+import os
+import threading
+import typing
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from pkg.core import app
+
+Content = typing.Union[str, bytes, typing.Callable[[], typing.Union[str, bytes]]]
+
+
+class Persistence:
+    """
+    进程级持久化服务：各模块只登记脏数据，由服务合并后在线程池中批量写盘
+    - write：整体替换文件，同一文件只保留最新内容；内容可以是函数，在写盘前才生成；bytes按二进制写入
+    - append：追加到文件末尾，同一文件的多次追加合并为一次写入
+    首次登记后最多等待 MAX_LATENCY 秒写盘，累计字节数超过 MAX_DIRTY_BYTES 时立即写盘；函数内容按上次生成的大小计入
+    同一批次按文件最后修改的先后顺序写入，某个文件写入失败时其后的文件留到下次重试
+    """
+
+    ap: typing.Optional[app.Application] = None
+    MAX_LATENCY: float = 1.0
+    MAX_DIRTY_BYTES: int = 256 * 1024
+    # 文件路径 -> [替换内容(None表示仅追加), 追加内容]
+    PENDING: "OrderedDict[str, list]" = OrderedDict()
+    DIRTY_BYTES: int = 0
+    # 文件路径 -> 函数内容上次生成的字节数
+    SIZES: typing.Dict[str, int] = {}
+    # 文件路径 -> 正在写入该文件的批次
+    IN_FLIGHT: typing.Dict[str, asyncio.Future] = {}
+    EXECUTOR = ThreadPoolExecutor(max_workers=1, thread_name_prefix="waifu-persistence")
+    LOCK = threading.Lock()
+    TIMER: typing.Optional[asyncio.TimerHandle] = None
+    FLUSHING: typing.Optional[asyncio.Future] = None
+
+    @classmethod
+    def configure(cls, ap: app.Application, max_latency: typing.Optional[float] = None, max_dirty_bytes: typing.Optional[int] = None):
+        cls.ap = ap
+        if max_latency is not None:
+            cls.MAX_LATENCY = max(0.0, float(max_latency))
+        if max_dirty_bytes is not None:
+            cls.MAX_DIRTY_BYTES = max(0, int(max_dirty_bytes))
+
+    @classmethod
+    def write(cls, path: str, content: Content):
+        if isinstance(content, (str, bytes)):
+            cls.DIRTY_BYTES += len(content)
+        else:
+            cls.DIRTY_BYTES += cls.SIZES.get(path, 0)
+        cls.PENDING[path] = [content, ""]
+        cls.PENDING.move_to_end(path)
+        cls._schedule()
+
+    @classmethod
+    def append(cls, path: str, text: str):
+        if not text:
+            return
+        entry = cls.PENDING.get(path)
+        if entry is None:
+            cls.PENDING[path] = [None, text]
+        else:
+            entry[1] += text
+            cls.PENDING.move_to_end(path)
+        cls.DIRTY_BYTES += len(text)
+        cls._schedule()
+
+    @classmethod
+    async def discard(cls, path: str):
+        """
+        丢弃尚未写盘的数据，并等待已提交的写入该文件的批次完成，删除文件前调用，避免文件被重新写出
+        """
+        cls._pop_pending(path)
+        writing = cls.IN_FLIGHT.get(path)
+        if writing is not None and not writing.done():
+            await asyncio.wait([writing])
+            cls._pop_pending(path)  # 写入失败放回队列的内容同样丢弃
+
+    @classmethod
+    def _pop_pending(cls, path: str):
+        entry = cls.PENDING.pop(path, None)
+        if entry is not None:
+            cls.DIRTY_BYTES = max(0, cls.DIRTY_BYTES - cls._entry_bytes(path, entry))
+
+    @classmethod
+    def _entry_bytes(cls, path: str, entry: list) -> int:
+        content, appended = entry
+        if content is None:
+            size = 0
+        elif isinstance(content, (str, bytes)):
+            size = len(content)
+        else:
+            size = cls.SIZES.get(path, 0)
+        return size + len(appended)
+
+    @classmethod
+    async def flush_file(cls, path: str):
+        """
+        立即写入单个文件并等待完成，读取该文件前调用以保证读到最新内容
+        排在它之前的文件一并写入，保持写入顺序；写盘在写盘线程中进行
+        """
+        if path not in cls.PENDING:
+            # 等待正在写入该文件的批次
+            writing = cls.IN_FLIGHT.get(path)
+            if writing is not None and not writing.done():
+                await asyncio.wait([writing])
+            return
+        batch = []
+        while cls.PENDING:
+            pending_path, entry = cls.PENDING.popitem(last=False)
+            cls.DIRTY_BYTES = max(0, cls.DIRTY_BYTES - cls._entry_bytes(pending_path, entry))
+            batch.append(cls._materialize(pending_path, entry))
+            if pending_path == path:
+                break
+        writing = cls._submit_batch(batch)
+        await asyncio.wait([writing])
+        cls._requeue(writing.result())
+
+    @classmethod
+    async def flush(cls):
+        """
+        写入全部脏数据并等待完成，插件退出时调用
+        """
+        for _ in range(3):
+            if cls.FLUSHING is not None and not cls.FLUSHING.done():
+                await asyncio.wait([cls.FLUSHING])
+            if not cls.PENDING:
+                break
+            cls._start_flush()
+            if cls.FLUSHING is not None:
+                await asyncio.wait([cls.FLUSHING])
+        if cls.PENDING:
+            cls._log_error(f"Persistence: {len(cls.PENDING)} files could not be flushed.")
+        # 等待提交到写盘线程的其他任务（如数据库写入）完成
+        await asyncio.wrap_future(cls.EXECUTOR.submit(lambda: None))
+
+    @classmethod
+    def _schedule(cls):
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            # 没有事件循环时直接同步写盘
+            cls._flush_now()
+            return
+
+        if cls.DIRTY_BYTES >= cls.MAX_DIRTY_BYTES:
+            cls._start_flush()
+        elif cls.TIMER is None:
+            cls.TIMER = loop.call_later(cls.MAX_LATENCY, cls._start_flush)
+
+    @classmethod
+    def _take_batch(cls) -> typing.List[typing.Tuple[str, typing.Optional[str], str]]:
+        batch = []
+        while cls.PENDING:
+            path, entry = cls.PENDING.popitem(last=False)
+            batch.append(cls._materialize(path, entry))
+        cls.DIRTY_BYTES = 0
+        return batch
+
+    @classmethod
+    def _materialize(cls, path: str, entry: list) -> typing.Tuple[str, typing.Optional[str], str]:
+        content, appended = entry
+        if callable(content):
+            try:
+                content = content()
+            except Exception as e:
+                cls._log_error(f"Persistence: error generating content for '{path}': {e}")
+                content = None
+            else:
+                cls.SIZES[path] = len(content)
+        return (path, content, appended)
+
+    @classmethod
+    def _start_flush(cls):
+        if cls.TIMER is not None:
+            cls.TIMER.cancel()
+            cls.TIMER = None
+        if cls.FLUSHING is not None and not cls.FLUSHING.done():
+            # 上一批次完成后再写，保证同一文件的写入顺序
+            return
+        if not cls.PENDING:
+            return
+        cls.FLUSHING = cls._submit_batch(cls._take_batch())
+        cls.FLUSHING.add_done_callback(cls._on_flushed)
+
+    @classmethod
+    def _submit_batch(cls, batch: typing.List[typing.Tuple[str, typing.Optional[str], str]]) -> asyncio.Future:
+        writing = asyncio.get_running_loop().run_in_executor(cls.EXECUTOR, cls._write_batch_locked, batch)
+        for path, _, _ in batch:
+            cls.IN_FLIGHT[path] = writing
+        writing.add_done_callback(lambda _: cls._clear_in_flight(batch, writing))
+        return writing
+
+    @classmethod
+    def _clear_in_flight(cls, batch: typing.List[typing.Tuple[str, typing.Optional[str], str]], writing: asyncio.Future):
+        for path, _, _ in batch:
+            if cls.IN_FLIGHT.get(path) is writing:
+                del cls.IN_FLIGHT[path]
+
+    @classmethod
+    def _on_flushed(cls, future: asyncio.Future):
+        try:
+            cls._requeue(future.result())
+        except Exception as e:
+            cls._log_error(f"Persistence: unexpected error while flushing: {e}")
+        if cls.PENDING and cls.TIMER is None:
+            cls.TIMER = asyncio.get_running_loop().call_later(cls.MAX_LATENCY, cls._start_flush)
+
+    @classmethod
+    def _flush_now(cls):
+        if cls.TIMER is not None:
+            cls.TIMER.cancel()
+            cls.TIMER = None
+        cls._requeue(cls._write_batch_locked(cls._take_batch()))
+
+    @classmethod
+    def _requeue(cls, remaining: typing.List[typing.Tuple[str, typing.Optional[str], str]]):
+        """
+        写入失败的文件放回队首；若期间已有新的整体替换则以新内容为准
+        """
+        for path, content, appended in reversed(remaining):
+            entry = cls.PENDING.get(path)
+            if entry is None:
+                cls.PENDING[path] = [content, appended]
+            elif entry[0] is None:
+                entry[0] = content
+                entry[1] = appended + entry[1]
+            cls.PENDING.move_to_end(path, last=False)
+
+    @classmethod
+    def _write_batch_locked(cls, batch: typing.List[typing.Tuple[str, typing.Optional[str], str]]) -> typing.List[typing.Tuple[str, typing.Optional[str], str]]:
+        with cls.LOCK:
+            return cls._write_batch(batch)
+
+    @classmethod
+    def _write_batch(cls, batch: typing.List[typing.Tuple[str, typing.Optional[str], str]]) -> typing.List[typing.Tuple[str, typing.Optional[str], str]]:
+        for i, (path, content, appended) in enumerate(batch):
+            try:
+                cls._write_file(path, content, appended)
+            except Exception as e:
+                cls._log_error(f"Persistence: error writing file '{path}': {e}")
+                return batch[i:]
+        return []
+
+    @staticmethod
+    def _write_file(path: str, content: typing.Union[str, bytes, None], appended: str):
+        folder = os.path.dirname(path)
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+        if content is None:
+            with open(path, "a", encoding="utf-8") as file:
+                file.write(appended)
+                file.flush()
+            return
+        tmp_file = f"{path}.tmp"
+        if isinstance(content, bytes):
+            with open(tmp_file, "wb") as file:
+                file.write(content + appended.encode("utf-8"))
+                file.flush()
+        else:
+            with open(tmp_file, "w", encoding="utf-8") as file:
+                file.write(content + appended)
+                file.flush()
+        os.replace(tmp_file, path)
+
+    @classmethod
+    def _log_error(cls, message: str):
+        if cls.ap is not None:
+            cls.ap.logger.error(message)
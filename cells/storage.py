@@ -0,0 +1,390 @@
+import asyncio
+import json
+import os
+import re
+import sqlite3
+import time
+import typing
+from concurrent.futures import Future
+from pkg.core import app
+from plugins.Waifu.cells.persistence import Persistence
+
+DATA_DIR = "data/plugins/Waifu/data"
+CARDS_DIR = "data/plugins/Waifu/cards"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS long_term_memory (
+    launcher_id TEXT NOT NULL,
+    seq INTEGER NOT NULL,
+    summary TEXT NOT NULL,
+    tags TEXT NOT NULL,
+    timestamp REAL NOT NULL,
+    PRIMARY KEY (launcher_id, seq)
+);
+CREATE INDEX IF NOT EXISTS idx_long_term_memory_time ON long_term_memory (launcher_id, timestamp);
+CREATE TABLE IF NOT EXISTS short_term_memory (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    launcher_id TEXT NOT NULL,
+    role TEXT NOT NULL,
+    content TEXT,
+    timestamp REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_short_term_memory_launcher ON short_term_memory (launcher_id, id);
+CREATE TABLE IF NOT EXISTS conversations (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    launcher_id TEXT NOT NULL,
+    line TEXT NOT NULL,
+    timestamp REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_conversations_time ON conversations (launcher_id, timestamp);
+CREATE TABLE IF NOT EXISTS value_game (
+    launcher_id TEXT NOT NULL,
+    character TEXT NOT NULL,
+    value INTEGER NOT NULL,
+    PRIMARY KEY (launcher_id, character)
+);
+CREATE TABLE IF NOT EXISTS life_data (
+    launcher_id TEXT PRIMARY KEY,
+    data TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS card_summary (
+    launcher_id TEXT NOT NULL,
+    target_id TEXT NOT NULL,
+    summary TEXT NOT NULL,
+    PRIMARY KEY (launcher_id, target_id)
+);
+CREATE TABLE IF NOT EXISTS migrated (
+    launcher_id TEXT PRIMARY KEY,
+    timestamp REAL NOT NULL
+);
+"""
+
+
+class SqliteStorage:
+    """
+    可选的SQLite存储后端（WAL模式，单个数据库文件）
+    提供与JSON文件相同的读写操作，所有数据库操作都在 Persistence 的写盘线程中串行执行：
+    写入直接提交后返回，读取以协程等待结果、不阻塞事件循环，且总能看到之前提交的写入
+    首次访问某个launcher时自动导入其原有的JSON数据
+    """
+
+    ap: typing.Optional[app.Application] = None
+    ENABLED: bool = False
+    DB_FILE: str = f"{DATA_DIR}/waifu.db"
+    CONNECTION: typing.Optional[sqlite3.Connection] = None
+    CHECKED: typing.Dict[str, asyncio.Future] = {}  # launcher -> 导入检查任务
+
+    @classmethod
+    def configure(cls, ap: app.Application, backend: str):
+        cls.ap = ap
+        cls.ENABLED = backend == "sqlite"
+        if cls.ENABLED:
+            ap.logger.info(f"Waifu使用SQLite存储：{cls.DB_FILE}")
+
+    @classmethod
+    def enabled(cls) -> bool:
+        return cls.ENABLED
+
+    # 线程调度
+
+    @classmethod
+    def _connect(cls) -> sqlite3.Connection:
+        # 只在写盘线程中调用
+        if cls.CONNECTION is None:
+            os.makedirs(os.path.dirname(cls.DB_FILE), exist_ok=True)
+            connection = sqlite3.connect(cls.DB_FILE, check_same_thread=False)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            connection.executescript(SCHEMA)
+            cls.CONNECTION = connection
+        return cls.CONNECTION
+
+    @classmethod
+    def _transaction(cls, func: typing.Callable[[sqlite3.Connection], typing.Any]) -> typing.Any:
+        connection = cls._connect()
+        with connection:
+            return func(connection)
+
+    @classmethod
+    def _submit(cls, func: typing.Callable[[sqlite3.Connection], typing.Any]):
+        future = Persistence.EXECUTOR.submit(cls._transaction, func)
+        future.add_done_callback(cls._on_written)
+
+    @classmethod
+    def _on_written(cls, future: Future):
+        e = future.exception()
+        if e is not None and cls.ap is not None:
+            cls.ap.logger.error(f"SqliteStorage: error writing database '{cls.DB_FILE}': {e}")
+
+    @classmethod
+    async def _query(cls, func: typing.Callable[[sqlite3.Connection], typing.Any]) -> typing.Any:
+        return await asyncio.wrap_future(Persistence.EXECUTOR.submit(cls._transaction, func))
+
+    @classmethod
+    async def ensure_launcher(cls, launcher_id: str):
+        """
+        首次访问时导入该launcher的JSON数据，同时访问的读取等待同一次导入完成
+        """
+        task = cls.CHECKED.get(launcher_id)
+        if task is None:
+            task = cls.CHECKED[launcher_id] = asyncio.ensure_future(cls._ensure_launcher(launcher_id))
+        try:
+            await asyncio.shield(task)
+        except Exception:
+            if cls.CHECKED.get(launcher_id) is task:
+                del cls.CHECKED[launcher_id]  # 下次访问时重试
+            raise
+
+    @classmethod
+    async def _ensure_launcher(cls, launcher_id: str):
+        if await cls._query(lambda connection: connection.execute("SELECT 1 FROM migrated WHERE launcher_id = ?", (launcher_id,)).fetchone()):
+            return
+        if await cls._import(launcher_id) and cls.ap is not None:
+            cls.ap.logger.info(f"已将launcher {launcher_id} 的JSON数据导入SQLite")
+
+    # 长期记忆
+
+    @classmethod
+    async def load_long_term_memory(cls, launcher_id: str) -> typing.List[typing.Tuple[str, typing.List[str]]]:
+        await cls.ensure_launcher(launcher_id)
+        rows = await cls._query(lambda connection: connection.execute(
+            "SELECT summary, tags FROM long_term_memory WHERE launcher_id = ? ORDER BY seq", (launcher_id,)).fetchall())
+        return [(summary, json.loads(tags)) for summary, tags in rows]
+
+    @classmethod
+    async def get_latest_long_term_memory(cls, launcher_id: str) -> typing.Optional[dict]:
+        await cls.ensure_launcher(launcher_id)
+        row = await cls._query(lambda connection: connection.execute(
+            "SELECT summary, tags FROM long_term_memory WHERE launcher_id = ? ORDER BY seq DESC LIMIT 1", (launcher_id,)).fetchone())
+        if row is None:
+            return None
+        return {"summary": row[0], "tags": json.loads(row[1])}
+
+    @classmethod
+    def add_long_term_memory(cls, launcher_id: str, seq: int, summary: str, tags: typing.List[str]):
+        record = (launcher_id, seq, summary, json.dumps(tags, ensure_ascii=False), time.time())
+        cls._submit(lambda connection: connection.execute(
+            "INSERT OR REPLACE INTO long_term_memory (launcher_id, seq, summary, tags, timestamp) VALUES (?, ?, ?, ?, ?)", record))
+
+    # 短期记忆
+
+    @classmethod
+    async def load_short_term_memory(cls, launcher_id: str) -> typing.List[typing.Tuple[str, str]]:
+        await cls.ensure_launcher(launcher_id)
+        return await cls._query(lambda connection: connection.execute(
+            "SELECT role, content FROM short_term_memory WHERE launcher_id = ? ORDER BY id", (launcher_id,)).fetchall())
+
+    @classmethod
+    def apply_short_term_memory(cls, launcher_id: str, record: dict):
+        """
+        执行与预写日志相同的 append/pop/keep 操作
+        """
+        op = record.get("op")
+        if op == "append":
+            row = (launcher_id, record["role"], record["content"], time.time())
+            cls._submit(lambda connection: connection.execute(
+                "INSERT INTO short_term_memory (launcher_id, role, content, timestamp) VALUES (?, ?, ?, ?)", row))
+        elif op == "pop":
+            cls._submit(lambda connection: connection.execute(
+                "DELETE FROM short_term_memory WHERE id = (SELECT MAX(id) FROM short_term_memory WHERE launcher_id = ?)", (launcher_id,)))
+        elif op == "keep":
+            count = record["count"]
+            cls._submit(lambda connection: connection.execute(
+                "DELETE FROM short_term_memory WHERE launcher_id = ? AND id NOT IN "
+                "(SELECT id FROM short_term_memory WHERE launcher_id = ? ORDER BY id DESC LIMIT ?)", (launcher_id, launcher_id, count)))
+
+    # 对话记录
+
+    @classmethod
+    def append_conversations(cls, launcher_id: str, lines: typing.List[str]):
+        now = time.time()
+        rows = [(launcher_id, line, now) for line in lines]
+        cls._submit(lambda connection: connection.executemany(
+            "INSERT INTO conversations (launcher_id, line, timestamp) VALUES (?, ?, ?)", rows))
+
+    # 数值、人生经历、角色卡摘要
+
+    @classmethod
+    async def load_value(cls, launcher_id: str, character: str) -> typing.Optional[int]:
+        await cls.ensure_launcher(launcher_id)
+        row = await cls._query(lambda connection: connection.execute(
+            "SELECT value FROM value_game WHERE launcher_id = ? AND character = ?", (launcher_id, character)).fetchone())
+        return None if row is None else row[0]
+
+    @classmethod
+    def save_value(cls, launcher_id: str, character: str, value: int):
+        cls._submit(lambda connection: connection.execute(
+            "INSERT OR REPLACE INTO value_game (launcher_id, character, value) VALUES (?, ?, ?)", (launcher_id, character, value)))
+
+    @classmethod
+    async def load_life_data(cls, launcher_id: str) -> typing.Optional[dict]:
+        await cls.ensure_launcher(launcher_id)
+        row = await cls._query(lambda connection: connection.execute(
+            "SELECT data FROM life_data WHERE launcher_id = ?", (launcher_id,)).fetchone())
+        return None if row is None else json.loads(row[0])
+
+    @classmethod
+    async def load_card_summary(cls, launcher_id: str, target_id: str) -> typing.Optional[str]:
+        await cls.ensure_launcher(launcher_id)
+        row = await cls._query(lambda connection: connection.execute(
+            "SELECT summary FROM card_summary WHERE launcher_id = ? AND target_id = ?", (launcher_id, target_id)).fetchone())
+        return None if row is None else row[0]
+
+    @classmethod
+    def save_card_summary(cls, launcher_id: str, target_id: str, summary: str):
+        cls._submit(lambda connection: connection.execute(
+            "INSERT OR REPLACE INTO card_summary (launcher_id, target_id, summary) VALUES (?, ?, ?)", (launcher_id, target_id, summary)))
+
+    @classmethod
+    def delete_launcher(cls, launcher_id: str):
+        def delete(connection: sqlite3.Connection):
+            for table in ["long_term_memory", "short_term_memory", "conversations", "value_game", "life_data"]:
+                connection.execute(f"DELETE FROM {table} WHERE launcher_id = ?", (launcher_id,))
+        cls._submit(delete)
+
+    # JSON数据迁移
+
+    @classmethod
+    async def migrate(cls) -> int:
+        """
+        将data目录中所有launcher的JSON数据导入SQLite，已导入的launcher会被跳过
+        :return: 本次导入的launcher数量
+        """
+        pattern = re.compile(r"^(?:memories|short_term_memory|conversations|life)_(.+)\.(?:json|jsonl|log)$")
+        launcher_ids = set()
+        for file in os.listdir(DATA_DIR) if os.path.exists(DATA_DIR) else []:
+            match = pattern.match(file)
+            if match:
+                launcher_ids.add(match.group(1))
+        count = 0
+        for launcher_id in sorted(launcher_ids):
+            if await cls._import(launcher_id):
+                count += 1
+        return count
+
+    @classmethod
+    async def _import(cls, launcher_id: str) -> bool:
+        files = cls._launcher_files(launcher_id)
+        # 先把尚未写盘的JSON数据落盘
+        for file in files:
+            await Persistence.flush_file(os.path.join(DATA_DIR, file))
+        return await cls._query(lambda connection: cls._import_launcher(connection, launcher_id, files))
+
+    @staticmethod
+    def _launcher_files(launcher_id: str) -> typing.List[str]:
+        """
+        按文件名精确匹配该launcher的数据文件，数值文件只认角色卡目录中存在的角色，
+        避免把其他数据文件或id以 _{launcher_id} 结尾的launcher的文件当成该launcher的数据
+        """
+        if not os.path.exists(DATA_DIR):
+            return []
+        names = {f"memories_{launcher_id}.json", f"memories_{launcher_id}.jsonl", f"short_term_memory_{launcher_id}.json",
+                 f"short_term_memory_{launcher_id}.jsonl", f"conversations_{launcher_id}.log", f"life_{launcher_id}.json"}
+        characters = {"default_person", "default_group"}
+        if os.path.exists(CARDS_DIR):
+            characters.update(file[:-len(".yaml")] for file in os.listdir(CARDS_DIR) if file.endswith(".yaml"))
+        names.update(f"{character}_{launcher_id}.json" for character in characters)
+        prefix = f"card_summary_{launcher_id}_"
+        return [file for file in os.listdir(DATA_DIR)
+                if file in names or (file.startswith(prefix) and file.endswith(".txt") and "_" not in file[len(prefix):])]
+
+    @classmethod
+    def _import_launcher(cls, connection: sqlite3.Connection, launcher_id: str, files: typing.List[str]) -> bool:
+        if connection.execute("SELECT 1 FROM migrated WHERE launcher_id = ?", (launcher_id,)).fetchone():
+            return False
+        now = time.time()
+
+        memories = cls._read_long_term_memory_files(launcher_id)
+        connection.executemany(
+            "INSERT OR IGNORE INTO long_term_memory (launcher_id, seq, summary, tags, timestamp) VALUES (?, ?, ?, ?, ?)",
+            [(launcher_id, seq, item["summary"], json.dumps(item["tags"], ensure_ascii=False), now) for seq, item in enumerate(memories)])
+
+        messages = cls._read_short_term_memory_files(launcher_id)
+        connection.executemany(
+            "INSERT INTO short_term_memory (launcher_id, role, content, timestamp) VALUES (?, ?, ?, ?)",
+            [(launcher_id, item["role"], item["content"], now) for item in messages])
+
+        conversations_file = f"{DATA_DIR}/conversations_{launcher_id}.log"
+        if os.path.exists(conversations_file):
+            with open(conversations_file, "r", encoding="utf-8") as file:
+                connection.executemany(
+                    "INSERT INTO conversations (launcher_id, line, timestamp) VALUES (?, ?, ?)",
+                    [(launcher_id, line.rstrip("\n"), now) for line in file])
+
+        life_file = f"{DATA_DIR}/life_{launcher_id}.json"
+        if os.path.exists(life_file):
+            with open(life_file, "r", encoding="utf-8") as file:
+                connection.execute("INSERT OR REPLACE INTO life_data (launcher_id, data) VALUES (?, ?)", (launcher_id, file.read()))
+
+        # 其余的 {character}_{launcher_id}.json 为数值文件
+        suffix = f"_{launcher_id}.json"
+        prefix = f"card_summary_{launcher_id}_"
+        for file_name in files:
+            if file_name.endswith(suffix) and file_name not in (f"memories{suffix}", f"short_term_memory{suffix}", f"life{suffix}"):
+                character = file_name[:-len(suffix)]
+                try:
+                    with open(os.path.join(DATA_DIR, file_name), "r") as file:
+                        value = json.load(file).get("value", 0)
+                    connection.execute("INSERT OR IGNORE INTO value_game (launcher_id, character, value) VALUES (?, ?, ?)", (launcher_id, character, value))
+                except (json.JSONDecodeError, AttributeError):
+                    continue
+            elif file_name.startswith(prefix) and file_name.endswith(".txt"):
+                with open(os.path.join(DATA_DIR, file_name), "r", encoding="utf-8") as file:
+                    connection.execute("INSERT OR IGNORE INTO card_summary (launcher_id, target_id, summary) VALUES (?, ?, ?)",
+                                       (launcher_id, file_name[len(prefix):-len(".txt")], file.read()))
+
+        connection.execute("INSERT INTO migrated (launcher_id, timestamp) VALUES (?, ?)", (launcher_id, now))
+        return bool(memories or messages)
+
+    @staticmethod
+    def _read_journal(file_name: str) -> typing.List[dict]:
+        records = []
+        if not os.path.exists(file_name):
+            return records
+        with open(file_name, "r", encoding="utf-8") as file:
+            for line in file:
+                try:
+                    records.append(json.loads(line))
+                except json.JSONDecodeError:
+                    continue
+        return records
+
+    @classmethod
+    def _read_long_term_memory_files(cls, launcher_id: str) -> typing.List[dict]:
+        memories = []
+        snapshot_file = f"{DATA_DIR}/memories_{launcher_id}.json"
+        if os.path.exists(snapshot_file):
+            with open(snapshot_file, "r", encoding="utf-8") as file:
+                content = file.read()
+            if content.strip():
+                memories = json.loads(content).get("long_term", [])
+        for record in cls._read_journal(f"{DATA_DIR}/memories_{launcher_id}.jsonl"):
+            if record.get("seq", len(memories)) >= len(memories):
+                memories.append(record)
+        return memories
+
+    @classmethod
+    def _read_short_term_memory_files(cls, launcher_id: str) -> typing.List[dict]:
+        messages = []
+        checkpoint_seq = 0
+        snapshot_file = f"{DATA_DIR}/short_term_memory_{launcher_id}.json"
+        if os.path.exists(snapshot_file):
+            with open(snapshot_file, "r", encoding="utf-8") as file:
+                content = file.read()
+            if content.strip():
+                data = json.loads(content)
+                if isinstance(data, dict):
+                    checkpoint_seq = data.get("seq", 0)
+                    data = data["messages"]
+                messages = data
+        for record in cls._read_journal(f"{DATA_DIR}/short_term_memory_{launcher_id}.jsonl"):
+            if record.get("seq", 0) <= checkpoint_seq:
+                continue
+            op = record.get("op")
+            if op == "append":
+                messages.append({"role": record["role"], "content": record["content"]})
+            elif op == "pop" and messages:
+                messages.pop()
+            elif op == "keep" and record["count"] < len(messages):
+                messages = messages[len(messages) - record["count"]:]
+        return messages
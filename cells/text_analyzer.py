@@ -1,3 +1,4 @@
+import asyncio
 import json
 import requests
 import yaml
@@ -77,7 +78,7 @@ class TextAnalyzer:
         i18n_list = []
         related_list = []
 
-        response = self._call_texsmart_api(text)
+        response = await asyncio.to_thread(self._call_texsmart_api, text)
         parsed_data = self._parse_texsmart_response(response)
 
         words = [w["str"] for w in parsed_data["word_list"]]  # 基础粒度分词
@@ -110,7 +111,7 @@ class TextAnalyzer:
         negative_dict = await self._load_yaml_dict("negative")
         negative_list = negative_dict.get("negative", [])
 
-        response = self._call_texsmart_api(text)
+        response = await asyncio.to_thread(self._call_texsmart_api, text)  # 同步网络请求放到线程中，不阻塞事件循环
         parsed_data = self._parse_texsmart_response(response)
         words = [w["str"] for w in parsed_data["phrase_list"]]
 
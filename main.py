@@ -10,6 +10,8 @@ import random
 import re
 import copy
 import shutil
+import time
+from collections import OrderedDict
 from pkg.platform.sources.aiocqhttp import AiocqhttpAdapter
 from pkg.provider import runner
 from pkg.core import app
@@ -21,6 +23,9 @@ from pkg.provider import entities as llm_entities
 from plugins.Waifu.cells.config import ConfigManager
 from plugins.Waifu.cells.generator import Generator
 from plugins.Waifu.cells.cards import Cards
+from plugins.Waifu.cells.persistence import Persistence
+from plugins.Waifu.cells.llm_scheduler import LLMScheduler
+from plugins.Waifu.cells.storage import SqliteStorage
 from plugins.Waifu.organs.memories import Memory
 from plugins.Waifu.systems.narrator import Narrator
 from plugins.Waifu.systems.value_game import ValueGame
@@ -42,6 +47,9 @@ COMMANDS = {
     "最近L4召回": "显示最近召回的记忆，用法：[最近L4召回]。",
     "最近L5召回": "显示最近召回的记忆，用法：[最近L5召回]。",
     "召回阈值": "显示召回阈值，用法：[召回阈值]。",
+    "标签缓存": "显示标签缓存的条目数、占用、命中率及淘汰次数，用法：[标签缓存]。",
+    "模型队列": "显示各模型进行中及各优先级排队中的请求数，用法：[模型队列]。",
+    "模型缓存": "显示模型回复缓存的条目数、占用、命中率及淘汰次数，用法：[模型缓存]。",
     "删除记忆": "删除所有长短期记忆，用法：[删除记忆]。",
     "修改数值": "修改Value Game的数字，用法：[修改数值][数值]。",
     "态度": "显示当前Value Game所对应的“态度Manner”，用法：[态度]。",
@@ -53,6 +61,7 @@ COMMANDS = {
     "控制人物": "控制角色发言（行动）或触发AI生成角色消息，用法：[控制人物][角色名称/assistant]|[发言(行动)/继续]。",
     "推进剧情": "自动依序调用：旁白 -> 控制人物，角色名称省略默认为user，用法：[推进剧情][角色名称]。",
     "撤回": "从短期记忆中删除最后的对话，用法：[撤回]。",
+    "迁移数据": "将data目录中所有JSON记忆、数值数据导入SQLite，需将storage_backend设为sqlite，用法：[迁移数据]。",
     "请设计": "调试：设计一个列表，用法：[请设计][设计内容]。",
     "请选择": "调试：从给定列表中选择，用法：[请选择][问题]|[选项1,选项2,……]。",
     "回答数字": "调试：返回数字答案，用法：[回答数字][问题]。",
@@ -73,7 +82,13 @@ class WaifuCache:
         self.cards = Cards(ap)
         self.narrator = Narrator(ap, launcher_id)
         self.thoughts = Thoughts(ap)
-        self.proactive = ProactiveGreeter(ap, launcher_id)
+        self.lock = asyncio.Lock()  # 串行化对该会话状态（记忆、数值等）的修改
+        self.inbox: asyncio.Queue = asyncio.Queue()  # 待处理的消息：(ctx, 发言人, 消息内容, 是否被@)
+        self.worker_task = None
+        self.ingesting = []  # 已从队列取出、尚未保存的消息
+        self.pending_reply = None  # 工作协程已取出、正在等待回复延迟的消息的 ctx
+        self.manner_tasks = set()  # 回复后在后台进行的情绪分析，释放前需等待其写入数值
+        self.proactive = ProactiveGreeter(ap, launcher_id, self.lock)
         self.conversation_analysis_flag = True
         self.thinking_mode_flag = True
         self.story_mode_flag = True
@@ -97,6 +112,48 @@ class WaifuCache:
         self.group_message_chain = None
         self.blacklist = []
         self.ignore_prefix = []
+        self.last_active = time.time()
+        self.active_handlers = 0
+
+    def is_busy(self) -> bool:
+        """
+        正在处理消息、等待延迟回复、总结记忆、情绪分析、旁白计时或主动问候运行中的会话不可释放
+        """
+        if self.active_handlers > 0 or self.response_timers_flag or self.ingesting or not self.inbox.empty():
+            return True
+        if self.manner_tasks:
+            return True
+        if self.memory.is_summarizing():
+            return True
+        if self.launcher_timer_tasks and not self.launcher_timer_tasks.done():
+            return True
+        main_task = getattr(self.proactive, "_main_task", None)
+        return main_task is not None and not main_task.done()
+
+    async def close(self):
+        """
+        停止计时器，等待后台情绪分析写入数值，并将待写入数据落盘，之后再次访问时从磁盘重新载入
+        """
+        if self.launcher_timer_tasks:
+            self.launcher_timer_tasks.cancel()
+            self.launcher_timer_tasks = None
+        if self.worker_task:
+            self.worker_task.cancel()
+            self.worker_task = None
+        await self.proactive.stop_main_task()
+        if self.manner_tasks:
+            await asyncio.wait(list(self.manner_tasks))
+        await Persistence.flush()
+
+    def take_pending_messages(self) -> typing.Tuple[list, typing.Optional[EventContext]]:
+        """
+        取出尚未处理的消息及正在等待回复的消息，供重载配置后的新会话缓存接手
+        """
+        items, self.ingesting = self.ingesting, []
+        while not self.inbox.empty():
+            items.append(self.inbox.get_nowait())
+        pending_reply, self.pending_reply = self.pending_reply, None
+        return items, pending_reply
 
 @runner.runner_class("waifu-mode")
 class WaifuRunner(runner.RequestRunner):
@@ -116,7 +173,14 @@ class WaifuPlugin(BasePlugin):
         self.host = host
         self._ensure_required_files_exist()
         self._generator = Generator(self.ap)
-        self.waifu_cache: typing.Dict[str, WaifuCache] = {}
+        Persistence.configure(self.ap)
+        LLMScheduler.configure(self.ap)
+        self.waifu_cache: typing.OrderedDict[str, WaifuCache] = OrderedDict()  # 按最近访问排序，末尾为最新
+        self.max_resident_launchers = 0
+        self.launcher_idle_timeout = 0
+        self._eviction_task = None
+        self._closing_tasks: typing.Dict[str, asyncio.Task] = {}
+        self._reply_semaphore = asyncio.Semaphore(5)  # 所有会话同时生成回复的数量上限
         self._set_permissions_recursively("data/plugins/Waifu/", 0o777)
         asyncio.create_task(self.initialize())
 
@@ -127,6 +191,20 @@ class WaifuPlugin(BasePlugin):
             try:
                 config_mgr = ConfigManager(f"data/plugins/Waifu/config/waifu", "plugins/Waifu/templates/waifu")
                 await config_mgr.load_config(completion=True)
+                Persistence.configure(self.ap, config_mgr.data.get("persistence_max_latency", 1.0), config_mgr.data.get("persistence_max_dirty_bytes", 262144))
+                SqliteStorage.configure(self.ap, config_mgr.data.get("storage_backend", "json"))
+                self.max_resident_launchers = config_mgr.data.get("max_resident_launchers", 200)
+                self.launcher_idle_timeout = config_mgr.data.get("launcher_idle_timeout", 3600)
+                self._reply_semaphore = asyncio.Semaphore(max(1, config_mgr.data.get("max_concurrent_replies", 5)))
+                LLMScheduler.configure(self.ap, config_mgr.data.get("llm_max_concurrency", 4))
+                Generator.configure_response_cache(
+                    config_mgr.data.get("llm_response_cache", False),
+                    config_mgr.data.get("llm_response_cache_persist", False),
+                    config_mgr.data.get("llm_response_cache_max_bytes", 4194304),
+                    config_mgr.data.get("llm_response_cache_ttl", {}),
+                )
+                if self.launcher_idle_timeout > 0 and not self._eviction_task:
+                    self._eviction_task = asyncio.create_task(self._evict_idle_loop())
                 await self._generator._initialize_model_config()  # 主动调用初始化方法
 
                 if self._generator.selected_model_info:
@@ -141,6 +219,9 @@ class WaifuPlugin(BasePlugin):
 
     async def destroy(self):
         self.ap.logger.warning("Waifu插件正在退出....")
+        if self._eviction_task:
+            self._eviction_task.cancel()
+        await Persistence.flush()  # 确保所有待写入的数据落盘
     # @handler(NormalMessageResponded)
     # async def normal_message_responded(self, ctx: EventContext):
     #     self.ap.logger.info(f"LangGPT的NormalMessageResponded: {str(ctx.event.response_text)}。")
@@ -174,11 +255,18 @@ class WaifuPlugin(BasePlugin):
             return False
 
         # 检查配置是否存在，若不存在则加载配置
+        if launcher_id not in self.waifu_cache:
+            closing = self._closing_tasks.get(launcher_id)
+            if closing:
+                await asyncio.shield(closing)  # 等待释放时的数据落盘完成后再重新载入
         if launcher_id not in self.waifu_cache:
             await self._load_config(launcher_id, ctx.event.launcher_type)
+            await self._evict_waifu_cache(launcher_id)
         waifu_data = self.waifu_cache.get(launcher_id, None)
         if waifu_data:
             waifu_data.memory.bot_account_id = bot_account_id
+            waifu_data.last_active = time.time()
+            self.waifu_cache.move_to_end(launcher_id)
         # 继承LangBot的群消息响应规则时忽略 GroupMessageReceived 信号
         if event_type == "GMR" and waifu_data.langbot_group_rule == True:
             return False
@@ -216,90 +304,124 @@ class WaifuPlugin(BasePlugin):
 
     @handler(PersonMessageReceived)
     async def person_message_received(self, ctx: EventContext):
+        LLMScheduler.set_launcher(ctx.event.launcher_id)  # 此后的模型请求及创建的任务归属该会话
         if not await self._access_control_check(ctx):
             return
 
-        # 检查是否为主程序命令，如果是则直接返回让主程序处理
-        text_message = str(ctx.event.query.message_chain)
-        cmd_prefix = self.ap.instance_config.data.get("command", {}).get("prefix", [])
-        if any(text_message.startswith(prefix) for prefix in cmd_prefix):
-            return  # 让主程序处理命令
+        config = self.waifu_cache[ctx.event.launcher_id]
+        config.active_handlers += 1  # 处理期间不释放该会话
+        try:
+            # 检查是否为主程序命令，如果是则直接返回让主程序处理
+            text_message = str(ctx.event.query.message_chain)
+            cmd_prefix = self.ap.instance_config.data.get("command", {}).get("prefix", [])
+            if any(text_message.startswith(prefix) for prefix in cmd_prefix):
+                return  # 让主程序处理命令
 
-        need_assistant_reply, need_save_memory = await self._handle_command(ctx)
-        if need_assistant_reply:
-            await self._request_person_reply(ctx, need_save_memory)
-            asyncio.create_task(self._handle_narration(ctx, ctx.event.launcher_id))
-            ctx.prevent_default()  # 阻止 LangBot 的默认回复行为
+            need_assistant_reply, need_save_memory = await self._handle_command_locked(ctx)
+            if need_assistant_reply:
+                await self._request_person_reply(ctx, need_save_memory)
+                asyncio.create_task(self._handle_narration(ctx, ctx.event.launcher_id))
+                ctx.prevent_default()  # 阻止 LangBot 的默认回复行为
+        finally:
+            config.active_handlers -= 1
 
     @handler(GroupMessageReceived)
     @handler(GroupNormalMessageReceived)
     async def group_message_received(self, ctx: EventContext):
+        LLMScheduler.set_launcher(ctx.event.launcher_id)  # 此后的模型请求及创建的任务归属该会话
         if not await self._access_control_check(ctx):
             return
 
-        # 在GroupNormalMessageReceived的ctx.event.query.message_chain会将At移除
-        # 所以这在经过主项目处理前先进行备份
-        self.waifu_cache[ctx.event.launcher_id].group_message_chain = copy.deepcopy(ctx.event.query.message_chain)
+        config = self.waifu_cache[ctx.event.launcher_id]
+        config.active_handlers += 1  # 处理期间不释放该会话
+        try:
+            # 在GroupNormalMessageReceived的ctx.event.query.message_chain会将At移除
+            # 所以这在经过主项目处理前先进行备份
+            self.waifu_cache[ctx.event.launcher_id].group_message_chain = copy.deepcopy(ctx.event.query.message_chain)
 
-        is_mentioned = False
-        if self.waifu_cache[ctx.event.launcher_id].group_message_chain:
-            is_mentioned = self.waifu_cache[ctx.event.launcher_id].group_message_chain.has(platform_message.At(ctx.event.query.adapter.bot_account_id))
+            is_mentioned = False
+            if self.waifu_cache[ctx.event.launcher_id].group_message_chain:
+                is_mentioned = self.waifu_cache[ctx.event.launcher_id].group_message_chain.has(platform_message.At(ctx.event.query.adapter.bot_account_id))
         
-        if is_mentioned:
-            # 检查是否为主程序命令，如果是则直接返回让主程序处理
-            text_message = str(ctx.event.query.message_chain)
-            cmd_prefix = self.ap.instance_config.data.get("command", {}).get("prefix", [])
-            if any(text_message.startswith(prefix) for prefix in cmd_prefix):
-                return  # 让主程序处理命令
-
-        need_assistant_reply, _ = await self._handle_command(ctx)
-        if need_assistant_reply:
-            await self._request_group_reply(ctx)
-            ctx.prevent_default()  # 阻止 LangBot 的默认回复行为
+            if is_mentioned:
+                # 检查是否为主程序命令，如果是则直接返回让主程序处理
+                text_message = str(ctx.event.query.message_chain)
+                cmd_prefix = self.ap.instance_config.data.get("command", {}).get("prefix", [])
+                if any(text_message.startswith(prefix) for prefix in cmd_prefix):
+                    return  # 让主程序处理命令
+
+            need_assistant_reply, _ = await self._handle_command_locked(ctx)
+            if need_assistant_reply:
+                await self._request_group_reply(ctx, is_mentioned)
+                ctx.prevent_default()  # 阻止 LangBot 的默认回复行为
+        finally:
+            config.active_handlers -= 1
 
     async def _load_config(self, launcher_id: str, launcher_type: str):    ##加载配置
 
+        old_cache = self.waifu_cache.get(launcher_id)
         self.waifu_cache[launcher_id] = WaifuCache(self.ap, launcher_id, launcher_type)
         cache = self.waifu_cache[launcher_id]
-        config_mgr = ConfigManager(f"data/plugins/Waifu/config/waifu", "plugins/Waifu/templates/waifu", launcher_id) #读取用户配置
-        await config_mgr.load_config(completion=True)
-
-        character = config_mgr.data.get("character", f"default")
-        if character == "default":  # 区分私聊和群聊的模板
-            character = f"default_{launcher_type}"
-        else:
-            character = character.replace(".yaml", "")
-
-        cache.narrate_intervals = config_mgr.data.get("intervals", [])
-        cache.story_mode_flag = config_mgr.data.get("story_mode", True)
-        cache.thinking_mode_flag = config_mgr.data.get("thinking_mode", True)
-        cache.conversation_analysis_flag = config_mgr.data.get("conversation_analysis", True)
-        cache.display_thinking = config_mgr.data.get("display_thinking", True)
-        cache.display_value = config_mgr.data.get("display_value", False)
-        cache.response_rate = config_mgr.data.get("response_rate", 0.7)
-        cache.summarization_mode = config_mgr.data.get("summarization_mode", False)
-        cache.personate_mode = config_mgr.data.get("personate_mode", True)
-        cache.jail_break_mode = config_mgr.data.get("jail_break_mode", "off")
-        cache.bracket_rate = config_mgr.data.get("bracket_rate", [])
-        cache.group_response_delay = config_mgr.data.get("group_response_delay", 10)
-        cache.person_response_delay = config_mgr.data.get("person_response_delay", 0)
-        cache.personate_delay = config_mgr.data.get("personate_delay", 0)
-        cache.continued_rate = config_mgr.data.get("continued_rate", 0.5)
-        cache.continued_max_count = config_mgr.data.get("continued_max_count", 2)
-        cache.blacklist = config_mgr.data.get("blacklist", [])
-        cache.langbot_group_rule = config_mgr.data.get("langbot_group_rule", False)
-        cache.ignore_prefix = config_mgr.data.get("ignore_prefix", [])
-
-        await cache.memory.load_config(character, launcher_id, launcher_type)
-        await cache.value_game.load_config(character, launcher_id, launcher_type)
-        await cache.cards.load_config(character, launcher_type)
-        await cache.narrator.load_config()
-        await cache.proactive.load_config(cache.memory, cache.summarization_mode)
-
-        self._set_jail_break(cache, "off")
-        if cache.jail_break_mode in ["before", "after", "end", "all"]:
-            self._set_jail_break(cache, cache.jail_break_mode)
-        self._set_permissions_recursively("data/plugins/Waifu/", 0o777)
+        async with cache.lock:  # 载入完成前新到的消息在队列中等待
+            if old_cache:
+                # 未处理的消息交由新缓存接手，再停止旧缓存的工作协程、计时器及主动问候
+                pending_items, cache.pending_reply = old_cache.take_pending_messages()
+                for item in pending_items:
+                    cache.inbox.put_nowait(item)
+                cache.unreplied_count = old_cache.unreplied_count
+                await old_cache.close()
+            config_mgr = ConfigManager(f"data/plugins/Waifu/config/waifu", "plugins/Waifu/templates/waifu", launcher_id) #读取用户配置
+            await config_mgr.load_config(completion=True)
+
+            character = config_mgr.data.get("character", f"default")
+            if character == "default":  # 区分私聊和群聊的模板
+                character = f"default_{launcher_type}"
+            else:
+                character = character.replace(".yaml", "")
+
+            cache.narrate_intervals = config_mgr.data.get("intervals", [])
+            cache.story_mode_flag = config_mgr.data.get("story_mode", True)
+            cache.thinking_mode_flag = config_mgr.data.get("thinking_mode", True)
+            cache.conversation_analysis_flag = config_mgr.data.get("conversation_analysis", True)
+            cache.display_thinking = config_mgr.data.get("display_thinking", True)
+            cache.display_value = config_mgr.data.get("display_value", False)
+            cache.response_rate = config_mgr.data.get("response_rate", 0.7)
+            cache.summarization_mode = config_mgr.data.get("summarization_mode", False)
+            cache.personate_mode = config_mgr.data.get("personate_mode", True)
+            cache.jail_break_mode = config_mgr.data.get("jail_break_mode", "off")
+            cache.bracket_rate = config_mgr.data.get("bracket_rate", [])
+            cache.group_response_delay = config_mgr.data.get("group_response_delay", 10)
+            cache.person_response_delay = config_mgr.data.get("person_response_delay", 0)
+            cache.personate_delay = config_mgr.data.get("personate_delay", 0)
+            cache.continued_rate = config_mgr.data.get("continued_rate", 0.5)
+            cache.continued_max_count = config_mgr.data.get("continued_max_count", 2)
+            cache.blacklist = config_mgr.data.get("blacklist", [])
+            cache.langbot_group_rule = config_mgr.data.get("langbot_group_rule", False)
+            cache.ignore_prefix = config_mgr.data.get("ignore_prefix", [])
+
+            await cache.memory.load_config(character, launcher_id, launcher_type)
+            await cache.value_game.load_config(character, launcher_id, launcher_type)
+            await cache.cards.load_config(character, launcher_type)
+            await cache.narrator.load_config()
+            await cache.proactive.load_config(cache.memory, cache.summarization_mode)
+
+            self._set_jail_break(cache, "off")
+            if cache.jail_break_mode in ["before", "after", "end", "all"]:
+                self._set_jail_break(cache, cache.jail_break_mode)
+            self._set_permissions_recursively("data/plugins/Waifu/", 0o777)
+
+        if (cache.pending_reply or not cache.inbox.empty()) and (cache.worker_task is None or cache.worker_task.done()):
+            cache.worker_task = asyncio.create_task(self._launcher_worker(cache))
+
+    async def _handle_command_locked(self, ctx: EventContext) -> typing.Tuple[bool, bool]:
+        """
+        命令会修改会话状态，持有会话锁执行；普通聊天消息不需等待
+        """
+        msg = str(ctx.event.query.message_chain)
+        if not msg.startswith(tuple(COMMANDS) + ("功能测试",)):
+            return await self._handle_command(ctx)
+        async with self.waifu_cache[ctx.event.launcher_id].lock:
+            return await self._handle_command(ctx)
 
     async def _handle_command(self, ctx: EventContext) -> typing.Tuple[bool, bool]:
         need_assistant_reply = False
@@ -360,9 +482,15 @@ class WaifuPlugin(BasePlugin):
             response = config.memory.get_last_l5_recall_memories()
         elif msg == "召回阈值":
             response = config.memory.format_thresholds()
+        elif msg == "标签缓存":
+            response = config.memory.get_tag_cache_stats()
+        elif msg == "模型队列":
+            response = LLMScheduler.stats()
+        elif msg == "模型缓存":
+            response = Generator.response_cache_stats()
         elif msg == "删除记忆":
             response = self._stop_timer(launcher_id)
-            config.memory.delete_local_files()
+            await config.memory.delete_local_files()
             config.value_game.reset_value()
             response += "记忆已删除。"
         elif msg.startswith("修改数值"):
@@ -377,6 +505,7 @@ class WaifuPlugin(BasePlugin):
                 response = f"错误：未正确设定态度值相关配置"
         elif msg == "加载配置":
             launcher_type = ctx.event.launcher_type
+            await self._generator._initialize_model_config()  # 模型配置文件变化时重新选定模型
             await self._load_config(launcher_id, launcher_type)
             response = "配置已重载"
         elif msg == "停止活动":
@@ -423,6 +552,11 @@ class WaifuPlugin(BasePlugin):
             await self._test(ctx)
         elif msg == "撤回":
             response = f"已撤回：\n{await config.memory.remove_last_memory()}"
+        elif msg == "迁移数据":
+            if SqliteStorage.enabled():
+                response = f"已导入{await SqliteStorage.migrate()}个会话的数据。"
+            else:
+                response = "错误：请先将storage_backend设为sqlite"
         elif msg == "列出命令":
             response = self._list_commands()
         else:
@@ -433,6 +567,43 @@ class WaifuPlugin(BasePlugin):
             await ctx.event.query.adapter.reply_message(ctx.event.query.message_event, platform_message.MessageChain([str(response)]), False)
         return need_assistant_reply, need_save_memory
 
+    async def _evict_waifu_cache(self, keep_launcher_id: str = None):
+        """
+        释放闲置超时的会话，以及超出最大常驻数量时最久未访问的会话；忙碌中的会话跳过
+        """
+        now = time.time()
+        evict_ids = []
+        resident = len(self.waifu_cache)
+        for launcher_id, cache in self.waifu_cache.items():
+            if launcher_id == keep_launcher_id or cache.is_busy():
+                continue
+            idle = self.launcher_idle_timeout > 0 and now - cache.last_active > self.launcher_idle_timeout
+            over = self.max_resident_launchers > 0 and resident > self.max_resident_launchers
+            if idle or over:
+                evict_ids.append(launcher_id)
+                resident -= 1
+        for launcher_id in evict_ids:
+            cache = self.waifu_cache.pop(launcher_id, None)
+            if cache is None:
+                continue
+            closing = asyncio.create_task(cache.close())
+            self._closing_tasks[launcher_id] = closing
+            try:
+                await closing
+            finally:
+                if self._closing_tasks.get(launcher_id) is closing:
+                    del self._closing_tasks[launcher_id]
+            self.ap.logger.info(f"释放会话缓存：{launcher_id}，常驻会话数：{len(self.waifu_cache)}")
+
+    async def _evict_idle_loop(self):
+        interval = max(1, min(60, self.launcher_idle_timeout))
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self._evict_waifu_cache()
+            except Exception as e:
+                self.ap.logger.error(f"释放会话缓存出错：{e}")
+
     def _list_commands(self) -> str:
         return "\n".join([f"{cmd}: {desc}" for cmd, desc in COMMANDS.items()])
 
@@ -467,59 +638,105 @@ class WaifuPlugin(BasePlugin):
             for filename in files:
                 os.chmod(os.path.join(root, filename), mode)
 
-    async def _request_group_reply(self, ctx: EventContext):
-        launcher_id = ctx.event.launcher_id
-        config = self.waifu_cache[launcher_id]
+    async def _request_group_reply(self, ctx: EventContext, is_mentioned: bool):
         sender = ctx.event.query.message_event.sender.member_name
         msg = await self._vision(ctx)  # 用眼睛看消息？
-        await config.memory.save_memory(role=sender, content=msg)
-        config.unreplied_count += 1
-        await self._group_reply(ctx)
+        self._post_message(ctx, sender, msg, is_mentioned)
 
-    async def _group_reply(self, ctx: EventContext):
-        launcher_id = ctx.event.launcher_id
-        config = self.waifu_cache[launcher_id]
-        need_assistant_reply = False
-        if config.group_message_chain and config.group_message_chain.has(platform_message.At(ctx.event.query.adapter.bot_account_id)):
-            need_assistant_reply = True
+    def _post_message(self, ctx: EventContext, role: str, msg: typing.Optional[str], is_mentioned: bool = False):
+        """
+        消息交由该会话的工作协程按顺序处理
+        """
+        config = self.waifu_cache[ctx.event.launcher_id]
+        config.inbox.put_nowait((ctx, role, msg, is_mentioned))
+        if config.worker_task is None or config.worker_task.done():
+            config.worker_task = asyncio.create_task(self._launcher_worker(config))
+
+    async def _launcher_worker(self, config: WaifuCache):
+        """
+        每个会话一个工作协程：按到达顺序保存消息，回复前的等待期间陆续到达的消息合并为同一次回复；
+        各会话同时调用模型生成回复的数量受 max_concurrent_replies 限制，发送及拟人打字等待期间不占名额
+        """
+        launcher_id = config.launcher_id
+        while True:
+            if config.pending_reply:  # 重载配置前已在等待回复的消息
+                ctx = config.pending_reply
+                await self._ingest_messages(config, wait=False)
+            else:
+                ctx = await self._ingest_messages(config, wait=True)
+            if ctx is None:
+                continue
+            config.pending_reply = ctx
+            config.response_timers_flag = True
+            try:
+                self._prefetch_recall_tags(config)
+                if config.launcher_type == "group":
+                    delay = config.group_response_delay
+                else:
+                    delay = config.person_response_delay
+                self.ap.logger.info(f"wait {config.launcher_type} {launcher_id} for {delay}s")
+                await asyncio.sleep(delay)
+                await self._ingest_messages(config, wait=False)
+                self._prefetch_recall_tags(config)  # 等待期间有新消息时窗口随之变化
+                async with config.lock:
+                    config.pending_reply = None
+                    self.ap.logger.info(f"generating {config.launcher_type} {launcher_id} response")
+                    if config.launcher_type == "group":
+                        await self._run_group_reply(ctx)
+                    else:
+                        await self._run_person_reply(ctx)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self.ap.logger.error(f"Error occurred during {config.launcher_type} reply: {e}")
+                self.ap.logger.error(traceback.format_exc())
+            finally:
+                config.response_timers_flag = False
+
+    async def _ingest_messages(self, config: WaifuCache, wait: bool) -> typing.Optional[EventContext]:
+        """
+        保存队列中的全部消息，返回第一条需要回复的消息的 ctx，无需回复时返回 None
+        """
+        items = config.ingesting  # 已出队、等待会话锁期间仍可被重载配置接手
+        if wait:
+            items.append(await config.inbox.get())
+        while not config.inbox.empty():
+            items.append(config.inbox.get_nowait())
+        reply_ctx = None
+        async with config.lock:
+            config.ingesting = []
+            for ctx, role, msg, is_mentioned in items:
+                if msg is not None:
+                    await config.memory.save_memory(role=role, content=msg)
+                config.unreplied_count += 1
+                if config.launcher_type == "group":
+                    need_assistant_reply = self._need_group_reply(config, is_mentioned)
+                else:
+                    need_assistant_reply = getattr(self, "generator_model_ready", False)
+                if need_assistant_reply and reply_ctx is None:
+                    reply_ctx = ctx
+        return reply_ctx
+
+    def _need_group_reply(self, config: WaifuCache, is_mentioned: bool) -> bool:
+        need_assistant_reply = is_mentioned
         if config.unreplied_count >= config.memory.response_min_conversations:
             if random.random() < config.response_rate:
                 need_assistant_reply = True
         else:
-            self.ap.logger.info(f"群聊{launcher_id}还差{config.memory.response_min_conversations - config.unreplied_count}条消息触发回复")
-
-        config.group_message_chain = None
-        if need_assistant_reply:
-            if launcher_id not in self.waifu_cache or not config.response_timers_flag:
-                config.response_timers_flag = True
-                asyncio.create_task(self._delayed_group_reply(ctx))
+            self.ap.logger.info(f"群聊{config.launcher_id}还差{config.memory.response_min_conversations - config.unreplied_count}条消息触发回复")
+        return need_assistant_reply
 
-    async def _delayed_group_reply(self, ctx: EventContext):
+    async def _run_group_reply(self, ctx: EventContext):
         launcher_id = ctx.event.launcher_id
         config = self.waifu_cache[launcher_id]
-        self.ap.logger.info(f"wait group {launcher_id} for {config.group_response_delay}s")
-        await asyncio.sleep(config.group_response_delay)
-        self.ap.logger.info(f"generating group {launcher_id} response")
-
-        try:
-            # 触发回复后，首先检查是否满足预设回复形式，预设回复不用脑子，不走模型。
-            response = self._response_presets(launcher_id)
-            if response:
-                config.unreplied_count = 0
-                await config.memory.save_memory(role="assistant", content=response)
-                await self._reply(ctx, f"{response}", True)
-            else:
-                await self._send_group_reply(ctx)
-
-            config.response_timers_flag = False
-            await self._group_reply(ctx)  # 检查是否回复期间又满足响应条件
-
-        except Exception as e:
-            self.ap.logger.error(f"Error occurred during group reply: {e}")
-            raise
-
-        finally:
-            config.response_timers_flag = False
+        # 触发回复后，首先检查是否满足预设回复形式，预设回复不用脑子，不走模型。
+        response = self._response_presets(launcher_id)
+        if response:
+            config.unreplied_count = 0
+            await config.memory.save_memory(role="assistant", content=response)
+            await self._reply(ctx, f"{response}", True)
+        else:
+            await self._send_group_reply(ctx)
 
     async def _send_group_reply(self, ctx: EventContext):
         """
@@ -527,23 +744,23 @@ class WaifuPlugin(BasePlugin):
         """
         launcher_id = ctx.event.launcher_id
         config = self.waifu_cache[launcher_id]
-        if config.summarization_mode:
-            _, unreplied_conversations = config.memory.get_unreplied_msg(config.unreplied_count)
-            related_memories = await config.memory.load_memory(unreplied_conversations)
-            if related_memories:
-                config.cards.set_memory(related_memories)
-        # 如果是群聊则不修改为自定义角色名
-        system_prompt = config.memory.to_custom_names(config.cards.generate_system_prompt())
         # 备份然后重置避免回复过程中接收到新讯息导致计数错误
         unreplied_count = config.unreplied_count
         config.unreplied_count = 0
-        user_prompt = config.memory.get_normalize_short_term_memory()  # 默认为当前short_term_memory_size条聊天记录
-        if config.thinking_mode_flag:
-            user_prompt, analysis = await config.thoughts.generate_group_prompt(config.memory, config.cards, unreplied_count)
-            if config.display_thinking and config.conversation_analysis_flag:
-                await self._reply(ctx, f"【分析】：{analysis}")
-        self._generator.set_speakers([config.memory.assistant_name])
-        response = await self._generator.return_chat(user_prompt, system_prompt)
+        # 记忆召回与群聊分析互不依赖，同时进行
+        related_memories, (user_prompt, analysis) = await asyncio.gather(
+            self._recall_memories(config, unreplied_count),
+            self._generate_group_prompt(config, unreplied_count),
+        )
+        if related_memories:
+            config.cards.set_memory(related_memories)
+        if analysis and config.display_thinking and config.conversation_analysis_flag:
+            await self._reply(ctx, f"【分析】：{analysis}")
+        # 如果是群聊则不修改为自定义角色名
+        system_prompt = config.memory.to_custom_names(config.cards.generate_system_prompt())
+        async with self._reply_semaphore:  # 仅生成回复期间占用名额，召回、分析由模型调度器限流
+            self._generator.set_speakers([config.memory.assistant_name])
+            response = await self._generator.return_chat(user_prompt, system_prompt)
         await config.memory.save_memory(role="assistant", content=response)
 
         if config.personate_mode:
@@ -552,24 +769,10 @@ class WaifuPlugin(BasePlugin):
             await self._reply(ctx, f"{response}", True)
 
     async def _request_person_reply(self, ctx: EventContext, need_save_memory: bool):
-        launcher_id = ctx.event.launcher_id
-        config = self.waifu_cache[launcher_id]
-
+        msg = None
         if need_save_memory:  # 此处仅处理user的发言，保存至短期记忆
             msg = await self._vision(ctx)  # 用眼睛看消息？
-            await config.memory.save_memory(role="user", content=msg)
-        config.unreplied_count += 1
-        await self._person_reply(ctx)
-
-    async def _person_reply(self, ctx: EventContext):   #私聊回复
-        launcher_id = ctx.event.launcher_id
-        config = self.waifu_cache[launcher_id]
-
-        if config.unreplied_count > 0:
-            if launcher_id not in self.waifu_cache or not config.response_timers_flag:
-                if self.generator_model_ready:
-                    config.response_timers_flag = True
-                    asyncio.create_task(self._delayed_person_reply(ctx))  # 创建任务
+        self._post_message(ctx, "user", msg)
 
     async def _delayed_person_reply(self, ctx: EventContext):
         launcher_id = ctx.event.launcher_id
@@ -577,50 +780,82 @@ class WaifuPlugin(BasePlugin):
         self.ap.logger.info(f"wait person {launcher_id} for {config.person_response_delay}s")
         await asyncio.sleep(config.person_response_delay)
         self.ap.logger.info(f"generating person {launcher_id} response")
-        try:
-            config.unreplied_count = 0
-            if config.story_mode_flag:
-                value_game = config.value_game
-                manner = value_game.get_manner_description()
-                if manner:
-                    config.cards.set_manner(manner)
-            if config.summarization_mode:
-                _, unreplied_conversations = config.memory.get_unreplied_msg(config.unreplied_count)
-                related_memories = await config.memory.load_memory(unreplied_conversations)
-                config.cards.set_memory(related_memories)
+        await self._run_person_reply(ctx)
 
+    async def _run_person_reply(self, ctx: EventContext):
+        launcher_id = ctx.event.launcher_id
+        config = self.waifu_cache[launcher_id]
+        config.unreplied_count = 0
+        if config.story_mode_flag:
+            value_game = config.value_game
+            manner = value_game.get_manner_description()
+            if manner:
+                config.cards.set_manner(manner)
+        # 记忆召回与会话分析互不依赖，同时进行
+        related_memories, (user_prompt, analysis) = await asyncio.gather(
+            self._recall_memories(config, config.unreplied_count),
+            self._generate_person_prompt(config),
+        )
+        if config.summarization_mode:
+            config.cards.set_memory(related_memories)
+        if analysis and config.display_thinking and config.conversation_analysis_flag:
+            await self._reply(ctx, f"【分析】：{analysis}")
+        await self._send_person_reply(ctx, user_prompt)  # 生成回复并发送
+
+        if config.story_mode_flag:
+            # 情绪分析不影响本次回复，回复发出后在后台进行
+            last_content = config.value_game.get_manner_change_content(config.memory, config.continued_count)
+            if last_content is not None:
+                task = asyncio.create_task(self._update_manner_value(ctx, config, last_content))
+                config.manner_tasks.add(task)
+                task.add_done_callback(config.manner_tasks.discard)
+        config.continued_count = 0
+
+    def _prefetch_recall_tags(self, config: WaifuCache):
+        """
+        按回复时召回记忆所用的对话窗口提前提取标签：群聊为全部未回复消息，私聊为最后一条消息
+        """
+        if not config.summarization_mode:
+            return
+        unreplied_count = config.unreplied_count if config.launcher_type == "group" else 0
+        _, unreplied_conversations = config.memory.get_unreplied_msg(unreplied_count)
+        config.memory.prefetch_tags(unreplied_conversations)
+
+    async def _recall_memories(self, config: WaifuCache, unreplied_count: int) -> typing.Optional[typing.List[str]]:
+        if not config.summarization_mode:
+            return None
+        _, unreplied_conversations = config.memory.get_unreplied_msg(unreplied_count)
+        return await config.memory.load_memory(unreplied_conversations)
+
+    async def _generate_person_prompt(self, config: WaifuCache) -> typing.Tuple[typing.Any, str]:
+        if not config.thinking_mode_flag:
             # user_prompt不直接从msg生成，而是先将msg保存至短期记忆，再由短期记忆生成。
             # 好处是不论旁白或是控制人物，都能直接调用记忆生成回复
-            user_prompt = config.memory.get_normalize_short_term_memory()  # 默认为当前short_term_memory_size条聊天记录
-            if config.thinking_mode_flag:
-                user_prompt, analysis = await config.thoughts.generate_person_prompt(config.memory, config.cards)
-                if config.display_thinking and config.conversation_analysis_flag:
-                    await self._reply(ctx, f"【分析】：{analysis}")
-            await self._send_person_reply(ctx, user_prompt)  # 生成回复并发送
-
-            if config.story_mode_flag:
-                value_game = config.value_game
-                await value_game.determine_manner_change(config.memory, config.continued_count)
-                if config.display_value:  # 是否开启数值显示
-                    response = value_game.get_manner_value_str()
-                    if response:
-                        await self._reply(ctx, f"{response}")
-            config.continued_count = 0
-
-            config.response_timers_flag = False
+            return config.memory.get_normalize_short_term_memory(), ""  # 默认为当前short_term_memory_size条聊天记录
+        return await config.thoughts.generate_person_prompt(config.memory, config.cards)
+
+    async def _generate_group_prompt(self, config: WaifuCache, unreplied_count: int) -> typing.Tuple[typing.Any, str]:
+        if not config.thinking_mode_flag:
+            return config.memory.get_normalize_short_term_memory(), ""  # 默认为当前short_term_memory_size条聊天记录
+        return await config.thoughts.generate_group_prompt(config.memory, config.cards, unreplied_count)
 
+    async def _update_manner_value(self, ctx: EventContext, config: WaifuCache, last_content: str):
+        try:
+            await config.value_game.change_manner_by_sentiment(last_content)
+            if config.display_value:  # 是否开启数值显示
+                response = config.value_game.get_manner_value_str()
+                if response:
+                    await self._reply(ctx, f"{response}")
         except Exception as e:
-            self.ap.logger.error(f"Error occurred during person reply: {e}")
-            raise
-        finally:
-            config.response_timers_flag = False
+            self.ap.logger.error(f"数值变化判断出错：{e}")
 
     async def _send_person_reply(self, ctx: EventContext, user_prompt: str | list[llm_entities.ContentElement]):
         launcher_id = ctx.event.launcher_id
         config = self.waifu_cache[launcher_id]
         system_prompt = config.memory.to_custom_names(config.cards.generate_system_prompt())
-        self._generator.set_speakers([config.memory.assistant_name])
-        response = await self._generator.return_chat(user_prompt, system_prompt)   #发消息
+        async with self._reply_semaphore:  # 仅生成回复期间占用名额，发送及打字等待前释放
+            self._generator.set_speakers([config.memory.assistant_name])
+            response = await self._generator.return_chat(user_prompt, system_prompt)   #发消息
         await config.memory.save_memory(role="assistant", content=response)  #存入消息对话
 
         if config.personate_mode:
@@ -631,7 +866,7 @@ class WaifuPlugin(BasePlugin):
         if random.random() < config.continued_rate and config.continued_count < config.continued_max_count:  # 机率触发继续发言
             if not config.personate_mode:  # 拟人模式使用默认打字时间，非拟人模式喘口气
                 await asyncio.sleep(1)
-            if config.unreplied_count == 0:  # 用户未曾打断
+            if config.unreplied_count == 0 and config.inbox.empty():  # 用户未曾打断
                 config.continued_count += 1
                 self.ap.logger.info(f"模型触发继续回复{config.continued_count}次")
                 await self._continue_person_reply(ctx)
@@ -662,7 +897,8 @@ class WaifuPlugin(BasePlugin):
 
     async def _sleep_and_narrate(self, ctx: EventContext, launcher_id: str, interval: int):
         await asyncio.sleep(interval)
-        await self._narrate(ctx, launcher_id)
+        async with self.waifu_cache[launcher_id].lock:
+            await self._narrate(ctx, launcher_id)
 
     async def _narrate(self, ctx: EventContext, launcher_id: str):
         config = self.waifu_cache[launcher_id]
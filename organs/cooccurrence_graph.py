@@ -0,0 +1,218 @@
+import typing
+from array import array
+import numpy as np
+
+
+class CooccurrenceGraph:
+    """
+    关键词共现图的紧凑实现（无向、无自环）
+    节点名称映射为整数编号；边的两端、共现次数、权重分别存放在并行数组中
+    每个节点维护 邻居编号 -> 边编号 的邻接表，度数随增删边同步更新
+    编号按插入顺序递增，删除只做标记，裁剪后由 compact 统一回收；因此边编号顺序即创建顺序，
+    按编号顺序重新插入即可还原每个节点邻接表的顺序
+    每次增删节点或边、改变共现次数时版本号加一，供上层判断缓存是否过期
+    """
+
+    _node_ids: typing.Dict[str, int]
+    _node_names: typing.List[typing.Optional[str]]
+    _adjacency: typing.List[typing.Dict[int, int]]
+    _degrees: array
+    _edge_u: array
+    _edge_v: array
+    _cooccurrences: array
+    _weights: array
+    _edge_cnt: int
+    _version: int
+
+    def __init__(self):
+        self._version = 0
+        self.clear()
+
+    def clear(self):
+        self._node_ids = {}
+        self._node_names = []
+        self._adjacency = []
+        self._degrees = array("q")
+        self._edge_u = array("q")
+        self._edge_v = array("q")
+        self._cooccurrences = array("q")
+        self._weights = array("d")
+        self._edge_cnt = 0
+        self._version += 1
+
+    def version(self) -> int:
+        return self._version
+
+    def number_of_nodes(self) -> int:
+        return len(self._node_ids)
+
+    def number_of_edges(self) -> int:
+        return self._edge_cnt
+
+    def degree_sum(self) -> int:
+        return 2 * self._edge_cnt
+
+    def has_node(self, name: str) -> bool:
+        return name in self._node_ids
+
+    def node_id(self, name: str) -> typing.Optional[int]:
+        return self._node_ids.get(name)
+
+    def node_name(self, node: int) -> str:
+        return self._node_names[node]
+
+    def nodes(self) -> typing.List[int]:
+        """
+        按插入顺序返回节点编号
+        """
+        return list(self._node_ids.values())
+
+    def names(self) -> typing.KeysView[str]:
+        return self._node_ids.keys()
+
+    def add_node(self, name: str) -> int:
+        node = self._node_ids.get(name)
+        if node is not None:
+            return node
+        node = len(self._node_names)
+        self._node_names.append(name)
+        self._adjacency.append({})
+        self._degrees.append(0)
+        self._node_ids[name] = node
+        self._version += 1
+        return node
+
+    def remove_node(self, node: int):
+        for edge in list(self._adjacency[node].values()):
+            self.remove_edge(edge)
+        del self._node_ids[self._node_names[node]]
+        self._node_names[node] = None
+        self._version += 1
+
+    def degree(self, node: int) -> int:
+        return self._degrees[node]
+
+    def neighbors(self, node: int) -> typing.Dict[int, int]:
+        """
+        返回 邻居编号 -> 边编号，顺序与边的插入顺序一致，调用方不应修改
+        """
+        return self._adjacency[node]
+
+    def edge_id(self, u: int, v: int) -> typing.Optional[int]:
+        return self._adjacency[u].get(v)
+
+    def add_cooccurrence(self, u: int, v: int, count: int = 1) -> int:
+        """
+        增加两个节点的共现次数，边不存在时新建，返回边编号
+        """
+        self._version += 1
+        edge = self._adjacency[u].get(v)
+        if edge is not None:
+            self._cooccurrences[edge] += count
+            return edge
+        edge = len(self._edge_u)
+        self._edge_u.append(u)
+        self._edge_v.append(v)
+        self._cooccurrences.append(count)
+        self._weights.append(0.0)
+        self._adjacency[u][v] = edge
+        self._adjacency[v][u] = edge
+        self._degrees[u] += 1
+        self._degrees[v] += 1
+        self._edge_cnt += 1
+        return edge
+
+    def remove_edge(self, edge: int):
+        u = self._edge_u[edge]
+        v = self._edge_v[edge]
+        if u < 0:
+            return
+        del self._adjacency[u][v]
+        del self._adjacency[v][u]
+        self._degrees[u] -= 1
+        self._degrees[v] -= 1
+        self._edge_u[edge] = -1
+        self._edge_v[edge] = -1
+        self._edge_cnt -= 1
+        self._version += 1
+
+    def edges(self) -> typing.List[int]:
+        """
+        返回全部有效边的编号
+        """
+        return [edge for edge, u in enumerate(self._edge_u) if u >= 0]
+
+    def endpoints(self, edge: int) -> typing.Tuple[int, int]:
+        return self._edge_u[edge], self._edge_v[edge]
+
+    def cooccurrence(self, edge: int) -> int:
+        return self._cooccurrences[edge]
+
+    def weight(self, edge: int) -> float:
+        return self._weights[edge]
+
+    def set_weight(self, edge: int, weight: float):
+        self._weights[edge] = weight
+
+    def weights(self) -> typing.List[float]:
+        return [self._weights[edge] for edge in self.edges()]
+
+    def edge_arrays(self) -> typing.Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+        """
+        以 numpy 数组返回全部有效边：(边编号, 端点u, 端点v, 共现次数)
+        """
+        if not self._edge_u:
+            empty = np.empty(0, dtype=np.int64)
+            return empty, empty, empty, empty
+        edge_u = np.frombuffer(self._edge_u, dtype=np.int64)
+        edges = np.flatnonzero(edge_u >= 0)
+        return (
+            edges,
+            edge_u[edges],
+            np.frombuffer(self._edge_v, dtype=np.int64)[edges],
+            np.frombuffer(self._cooccurrences, dtype=np.int64)[edges],
+        )
+
+    def degree_array(self) -> np.ndarray:
+        if not self._degrees:
+            return np.empty(0, dtype=np.int64)
+        return np.frombuffer(self._degrees, dtype=np.int64).copy()
+
+    def set_weights(self, edges: np.ndarray, weights: np.ndarray):
+        """
+        批量写入边权重，不改变版本号
+        """
+        if len(edges) == 0:
+            return
+        view = np.frombuffer(self._weights, dtype=np.float64)
+        view[edges] = weights
+        # 释放缓冲区引用，之后数组才能继续扩容
+        del view
+
+    def to_arrays(self) -> typing.Tuple[typing.List[str], np.ndarray, np.ndarray, np.ndarray]:
+        """
+        导出紧凑编号后的图：(按插入顺序的节点名称, 端点u, 端点v, 共现次数)，边按创建顺序排列
+        """
+        nodes = self.nodes()
+        edges, edge_u, edge_v, cooccurrences = self.edge_arrays()
+        remap = np.full(len(self._node_names), -1, dtype=np.int64)
+        remap[nodes] = np.arange(len(nodes), dtype=np.int64)
+        return [self._node_names[node] for node in nodes], remap[edge_u], remap[edge_v], cooccurrences
+
+    def load_arrays(self, names: typing.List[str], edge_u: np.ndarray, edge_v: np.ndarray, cooccurrences: np.ndarray):
+        """
+        由 to_arrays 的结果重建图
+        """
+        self.clear()
+        for name in names:
+            self.add_node(name)
+        for u, v, count in zip(edge_u.tolist(), edge_v.tolist(), cooccurrences.tolist()):
+            self.add_cooccurrence(u, v, count)
+
+    def compact(self):
+        """
+        按原有顺序重新编号节点和边，回收已删除的位置
+        """
+        if len(self._node_ids) == len(self._node_names) and self._edge_cnt == len(self._edge_u):
+            return
+        self.load_arrays(*self.to_arrays())
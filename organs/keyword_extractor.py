@@ -0,0 +1,98 @@
+import math
+import re
+import typing
+from plugins.Waifu.organs.memory_store import MemoryStore
+
+LATIN_WORD = re.compile(r"[a-z0-9]+")
+
+
+class KeywordExtractor:
+    """
+    离线关键词提取，不访问网络，结果只由输入文本和当前长期记忆决定
+    - 以该会话长期记忆的标签表为词典，对文本做正向最大匹配（逐个尝试词典中出现过的n-gram长度）
+    - 英文、数字按整词匹配，不在单词中间截取
+    - 按 TF-IDF 排序，文档频率取自长期记忆中包含该标签的记忆条数
+    """
+
+    _tags_index: dict
+    _tags_version: typing.Callable[[], int]
+    _store: MemoryStore
+    _max_keywords: int
+    _lookup: typing.Dict[str, str]
+    _lengths: typing.List[int]
+    _vocab_key: typing.Optional[typing.Tuple[int, int]]
+
+    def __init__(self, tags_index: dict, tags_version: typing.Callable[[], int], store: MemoryStore, max_keywords: int = 10):
+        self._tags_index = tags_index
+        self._tags_version = tags_version
+        self._store = store
+        self._max_keywords = max_keywords
+        self._lookup = {}
+        self._lengths = []
+        self._vocab_key = None
+
+    def _refresh_vocabulary(self):
+        """
+        标签表整体重写时版本号递增，两次重写之间只会增长，版本号或条数变化时重建词典
+        """
+        vocab_key = (self._tags_version(), len(self._tags_index))
+        if self._vocab_key == vocab_key:
+            return
+        self._vocab_key = vocab_key
+        self._lookup = {}
+        for tag in self._tags_index:
+            key = tag.lower()
+            if key.strip() and key not in self._lookup:
+                self._lookup[key] = tag
+        self._lengths = sorted({len(key) for key in self._lookup}, reverse=True)
+
+    def _segment(self, text: str) -> typing.List[str]:
+        """
+        返回文本中依次匹配到的词典标签
+        """
+        self._refresh_vocabulary()
+        text = text.lower()
+        size = len(text)
+        terms = []
+        i = 0
+        while i < size:
+            if not text[i].isalnum():
+                i += 1
+                continue
+            latin = LATIN_WORD.match(text, i)
+            matched = 0
+            for length in self._lengths:
+                if length > size - i:
+                    continue
+                end = i + length
+                # 英文单词不能在词中截断
+                if latin is not None and end < latin.end():
+                    continue
+                term = self._lookup.get(text[i:end])
+                if term is not None:
+                    terms.append(term)
+                    matched = length
+                    break
+            if matched:
+                i += matched
+            elif latin is not None:
+                i = latin.end()
+            else:
+                i += 1
+        return terms
+
+    def extract(self, text: str) -> typing.List[str]:
+        terms = self._segment(text)
+        if not terms:
+            return []
+        term_freq: typing.Dict[str, int] = {}
+        for term in terms:
+            term_freq[term] = term_freq.get(term, 0) + 1
+
+        total = len(self._store)
+        scores = []
+        for position, (term, freq) in enumerate(term_freq.items()):
+            idf = math.log((total + 1) / (self._store.document_frequency(term) + 1)) + 1
+            scores.append((-freq * idf, position, term))
+        scores.sort()
+        return [term for _, _, term in scores[:self._max_keywords]]
@@ -1,26 +1,142 @@
-from typing import List, Optional
+import json
+import sys
+import time
+from typing import Any, Dict, Hashable, List, Optional
 from collections import OrderedDict
+from pkg.core import app
+from plugins.Waifu.cells.journal import Journal
 
 class LRUCache:
+    """
+    LRU缓存，可选：
+    - max_bytes：按键值估算的字节数限制容量
+    - ttl：条目存活秒数，过期后视为未命中
+    - journal：追加写入的日志，启动时重放恢复内容（键值需可JSON序列化）
+    命中、未命中及淘汰次数记录在 hits / misses / evictions
+    """
+
+    # 按名称共享的缓存实例，如同一模型的标签缓存由所有会话共用
+    SHARED: Dict[str, "LRUCache"] = {}
+
     capacity: int
-    cache: OrderedDict[str, List[str]]
+    max_bytes: Optional[int]
+    ttl: Optional[float]
+    cache: OrderedDict[Hashable, Any]
+    size_bytes: int
+    hits: int
+    misses: int
+    evictions: int
+    _times: Dict[Hashable, float]
+    _sizes: Dict[Hashable, int]
+    _journal: Optional[Journal]
 
-    def __init__(self, capacity: int):
+    def __init__(self, capacity: int, max_bytes: Optional[int] = None, ttl: Optional[float] = None, journal: Optional[Journal] = None):
         self.capacity = capacity
-        self.cache: OrderedDict[str, List[str]] = OrderedDict()
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.cache: OrderedDict[Hashable, Any] = OrderedDict()
+        self.size_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._times = {}
+        self._sizes = {}
+        self._journal = None
+        if journal is not None:
+            self._load_journal(journal)
+            self._journal = journal
+
+    @classmethod
+    def shared(cls, ap: app.Application, name: str, capacity: int, max_bytes: Optional[int] = None, ttl: Optional[float] = None, file: Optional[str] = None) -> "LRUCache":
+        """
+        按名称取得共享缓存，首次取得时从 file 恢复；已存在时更新容量及存活时间
+        """
+        cache = cls.SHARED.get(name)
+        if cache is None:
+            cache = cls(capacity, max_bytes, ttl, Journal(ap, file) if file else None)
+            cls.SHARED[name] = cache
+        else:
+            cache.capacity = capacity
+            cache.max_bytes = max_bytes
+            cache.ttl = ttl
+            cache._evict()
+        return cache
 
-    def get(self, key: str) -> Optional[List[str]]:
+    def get(self, key: Hashable) -> Optional[Any]:
         """获取缓存值，若存在则将其标记为最新使用"""
         if key not in self.cache:
+            self.misses += 1
             return None
+        if self._expired(key):
+            self._remove(key)
+            self.misses += 1
+            return None
+        self.hits += 1
         self.cache.move_to_end(key)  # 移动到末尾表示最新访问
         return self.cache[key]
 
-    def put(self, key: str, value: List[str]) -> None:
+    def put(self, key: Hashable, value: Any) -> None:
         """插入或更新缓存值"""
+        timestamp = time.time()
+        self._set(key, value, timestamp)
+        if self._journal is not None:
+            self._journal.append({"key": key, "value": value, "time": timestamp})
+            # 日志中的过期、重复条目过多时，用当前内容重写日志
+            if len(self._journal) > max(1000, 2 * len(self.cache)):
+                self._journal.rewrite(self._records, len(self.cache))
+
+    def stats(self) -> str:
+        total = self.hits + self.misses
+        hit_rate = self.hits / total if total else 0.0
+        return f"条目：{len(self.cache)} 占用：{self.size_bytes}字节 命中：{self.hits} 未命中：{self.misses} 命中率：{hit_rate:.2%} 淘汰：{self.evictions}"
+
+    def _set(self, key: Hashable, value: Any, timestamp: float):
         if key in self.cache:
             self.cache.move_to_end(key)  # 已存在则更新并标记为最新
+            self.size_bytes -= self._sizes.pop(key, 0)
         self.cache[key] = value
+        self._times[key] = timestamp
+        if self.max_bytes is not None:
+            size = self._estimate_size(key, value)
+            self._sizes[key] = size
+            self.size_bytes += size
+        self._evict()
+
+    def _evict(self):
         # 若超出容量，移除最久未使用的键（头部）
-        if len(self.cache) > self.capacity:
-            self.cache.popitem(last=False)
\ No newline at end of file
+        while self.cache and (len(self.cache) > self.capacity or (self.max_bytes is not None and self.size_bytes > self.max_bytes)):
+            self._remove(next(iter(self.cache)))
+            self.evictions += 1
+
+    def _remove(self, key: Hashable):
+        del self.cache[key]
+        self._times.pop(key, None)
+        self.size_bytes -= self._sizes.pop(key, 0)
+
+    def _expired(self, key: Hashable) -> bool:
+        return self.ttl is not None and self.ttl > 0 and time.time() - self._times[key] > self.ttl
+
+    @staticmethod
+    def _estimate_size(key: Hashable, value: Any) -> int:
+        try:
+            return len(json.dumps([key, value], ensure_ascii=False).encode("utf-8"))
+        except TypeError:
+            return sys.getsizeof(key) + sys.getsizeof(value)
+
+    def _records(self) -> List[dict]:
+        return [{"key": key, "value": value, "time": self._times[key]} for key, value in self.cache.items()]
+
+    def _load_journal(self, journal: Journal):
+        # 缓存创建前该日志不会有尚未写盘的记录
+        for record in journal.read_written():
+            try:
+                key = record["key"]
+                if isinstance(key, list):
+                    key = tuple(key)
+                self._set(key, record["value"], record.get("time", time.time()))
+            except (KeyError, TypeError):
+                continue
+        # 恢复过程中的淘汰不计入统计
+        self.evictions = 0
+        for key in [key for key in self.cache if self._expired(key)]:
+            self._remove(key)
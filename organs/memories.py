@@ -12,12 +12,19 @@ from pkg.core import app
 from collections import Counter,defaultdict
 from plugins.Waifu.cells.text_analyzer import TextAnalyzer
 from plugins.Waifu.cells.generator import Generator
+from plugins.Waifu.cells.llm_scheduler import LLMScheduler
 from pkg.plugin.context import APIHost
 from pkg.provider import entities as llm_entities
 from plugins.Waifu.cells.config import ConfigManager
+from plugins.Waifu.cells.journal import Journal
+from plugins.Waifu.cells.persistence import Persistence
+from plugins.Waifu.cells.storage import SqliteStorage
 from plugins.Waifu.organs.memory_item import MemoryItem
 from plugins.Waifu.organs.lru_cache import LRUCache
+from plugins.Waifu.organs.tag_extractor import TagExtractor
+from plugins.Waifu.organs.keyword_extractor import KeywordExtractor
 from plugins.Waifu.organs.memory_graph import MemoryGraph
+from plugins.Waifu.organs.memory_store import MemoryStore
 
 
 class Memory:
@@ -40,14 +47,22 @@ class Memory:
     _launcher_id: str
     _launcher_type: str
     _generator: Generator
-    _long_term_memory: typing.List[typing.Tuple[str, typing.List[str]]]
+    _long_term_memory: MemoryStore
     _tags_index: dict
     _short_term_memory_size: int
     _retrieve_top_n: int
     _summary_max_tags: int
     _long_term_memory_file: str
+    _long_term_memory_journal: Journal
+    _journal_compaction_limit: int
     _conversations_file: str
     _short_term_memory_file: str
+    _short_term_memory_journal: Journal
+    _short_term_memory_seq: int
+    _checkpoint_limit: int
+    _summary_marker_file: str
+    _summary_task: typing.Optional[asyncio.Task]
+    _summary_generation: int
     _summarization_mode: bool
     _status_file: str
     _thinking_mode_flag: bool
@@ -65,8 +80,16 @@ class Memory:
     _state_trace_div: str
     _tags_div: str
     _split_word_cache: LRUCache
+    _tag_extractor: TagExtractor
+    _keyword_extractor: KeywordExtractor
+    _tag_extraction_mode: str
+    _hybrid_min_tags: int
+    _tag_cache_max_bytes: int
+    _tag_cache_ttl: float
+    _tag_cache_persist: bool
     _tag_boost: float
     _memory_graph: MemoryGraph
+    _memory_graph_file: str
     _l0_threshold: float
     _l1_base: float
     _l1_threshold_floor: float
@@ -108,21 +131,28 @@ class Memory:
         self._launcher_id = launcher_id
         self._launcher_type = launcher_type
         self._generator = Generator(ap)
-        self._long_term_memory: typing.List[typing.Tuple[str, typing.List[str]]] = []
         self._tags_index = {}
+        self._tags_index_version = 0 # 标签表整体重写时递增，供关键词提取判断词典是否过期
+        self._long_term_memory = MemoryStore(self._tags_index)
         self._short_term_memory_size = 1500
         self._retrieve_top_n = 5
         self._summary_max_tags = 30
         self._long_term_memory_file = f"data/plugins/Waifu/data/memories_{launcher_id}.json"
+        self._long_term_memory_journal = Journal(ap, f"data/plugins/Waifu/data/memories_{launcher_id}.jsonl")
+        self._journal_compaction_limit = 50 # 日志累计条数达到该值时合并进快照
         self._conversations_file = f"data/plugins/Waifu/data/conversations_{launcher_id}.log"
         self._short_term_memory_file = f"data/plugins/Waifu/data/short_term_memory_{launcher_id}.json"
+        self._short_term_memory_journal = Journal(ap, f"data/plugins/Waifu/data/short_term_memory_{launcher_id}.jsonl")
+        self._short_term_memory_seq = 0
+        self._checkpoint_limit = 200 # 短期记忆日志累计条数达到该值时写入检查点
+        self._summary_marker_file = f"data/plugins/Waifu/data/pending_summary_{launcher_id}.json"
+        self._summary_task = None
+        self._summary_generation = 0 # 删除记忆时递增，使进行中的总结作废
         self._summarization_mode = False
         self._status_file = ""
         self._thinking_mode_flag = True
         self._already_repeat = set()
         self._meta_tag_count = 5 # year month day period datetime_mark
-        self._load_long_term_memory_from_file()
-        self._load_short_term_memory_from_file()
         self._has_preset = True
         self._memories_session = []
         self._memories_session_capacity = 0
@@ -135,8 +165,16 @@ class Memory:
         self._state_trace_div = "状态追踪："
         self._tags_div = "关键概念："
         self._split_word_cache = LRUCache(100000)
+        self._tag_extractor = TagExtractor(ap, self._request_tags, self._split_word_cache)
+        self._keyword_extractor = KeywordExtractor(self._tags_index, lambda: self._tags_index_version, self._long_term_memory)
+        self._tag_extraction_mode = "llm" # llm/local/hybrid
+        self._hybrid_min_tags = 3 # hybrid模式下本地提取的关键概念少于该数量时再调用模型
+        self._tag_cache_max_bytes = 8 * 1024 * 1024
+        self._tag_cache_ttl = 0
+        self._tag_cache_persist = True
         self._tag_boost = 0.2
         self._memory_graph = MemoryGraph(ap)
+        self._memory_graph_file = f"data/plugins/Waifu/data/memory_graph_{launcher_id}.bin"
         self._l0_threshold = 0.0
         self._l1_base = 0.0
         self._l1_threshold_floor = 0.0
@@ -172,6 +210,7 @@ class Memory:
                         f"Memory：: Generator model selected: {self._generator.selected_model_info.model_entity.name}")
 
                 self.generator_model_ready = True
+                self._attach_tag_cache()
 
             except Exception as e:
                 self.ap.logger.error(f"Memory：: Error during Generator model initialization: {e}")
@@ -193,6 +232,14 @@ class Memory:
         self._memories_session_capacity = waifu_config.data["session_memories_size"]
         self._summary_max_tags = waifu_config.data["summary_max_tags"]
         self._summarization_mode = waifu_config.data.get("summarization_mode", False)
+        self._tag_extraction_mode = waifu_config.data.get("tag_extraction_mode", "llm")
+        if self._tag_extraction_mode not in ("llm", "local", "hybrid"):
+            self.ap.logger.warning(f"未知的 tag_extraction_mode：{self._tag_extraction_mode}，使用 llm")
+            self._tag_extraction_mode = "llm"
+        self._tag_cache_max_bytes = waifu_config.data.get("tag_cache_max_bytes", 8 * 1024 * 1024)
+        self._tag_cache_ttl = waifu_config.data.get("tag_cache_ttl", 0)
+        self._tag_cache_persist = waifu_config.data.get("tag_cache_persist", True)
+        self._attach_tag_cache()
 
         self.analyze_max_conversations = waifu_config.data.get("analyze_max_conversations", 9)
         self.narrate_max_conversations = waifu_config.data.get("narrat_max_conversations", 8)
@@ -215,27 +262,61 @@ class Memory:
         else:
             self._has_preset = False
 
+        await self._load_long_term_memory_from_file()
+        await self._load_short_term_memory_from_file()
+        await self._recover_pending_summary()
         self._adjust_long_term_memory_tags()
-        self._build_memory_graph()
+        await self._build_memory_graph()
         self._adjust_memory_thresholds()
 
+    def _attach_tag_cache(self):
+        """
+        模型确定后改用按模型共享的标签缓存：同一模型的所有会话共用，可保存到磁盘供重启后使用
+        """
+        model_info = self._generator.selected_model_info
+        if model_info is None:
+            return
+        model_uuid = model_info.model_entity.uuid
+        file = f"data/plugins/Waifu/data/tag_cache_{model_uuid}.jsonl" if self._tag_cache_persist else None
+        self._split_word_cache = LRUCache.shared(self.ap, f"tags_{model_uuid}", 100000, self._tag_cache_max_bytes, self._tag_cache_ttl, file)
+        self._tag_extractor.set_cache(self._split_word_cache)
+
+    def get_tag_cache_stats(self) -> str:
+        return self._split_word_cache.stats()
+
     async def _tag_conversations(self, conversations: typing.List[llm_entities.Message], summary_flag: bool) -> typing.Tuple[str, typing.List[str]]:
         # 生成Tags：
         # 1、短期记忆转换长期记忆时：进行记忆总结
         # 2、对话提取记忆时：直接拼凑末尾对话
+        if not summary_flag and self._tag_extraction_mode != "llm":
+            return await self._tag_conversations_locally(conversations)
+
         if self.generator_model_ready:
             if summary_flag:
                 (memory,tags) = await self._generate_summary(conversations)
                 return (memory,tags)
 
             memory = self.get_last_content(conversations,10)
-            tags = await self._generate_tags(memory)
+            tags = await self._generate_tags(memory)  # 回复前已预取时直接取得结果
             return (memory, tags)
         else:
             self.ap.logger.warning(f"Error generator_model_ready is not ready!")
             return ("", [])
 
 
+    async def _tag_conversations_locally(self, conversations: typing.List[llm_entities.Message]) -> typing.Tuple[str, typing.List[str]]:
+        """
+        local：只用本地词典提取关键概念，不调用模型
+        hybrid：本地提取的关键概念不足时再调用模型，合并两者结果
+        """
+        memory = self.get_last_content(conversations,10)
+        tags = self._keyword_extractor.extract(memory)
+        self.ap.logger.info(f"本地提取关键概念：{tags}")
+        if self._tag_extraction_mode == "hybrid" and len(tags) < self._hybrid_min_tags and self.generator_model_ready:
+            llm_tags = await self._generate_tags(memory)
+            tags = list(dict.fromkeys(tags + llm_tags))
+        return (memory, tags)
+
     def _remove_prefix_suffix_from_tag(self,tag:str) ->str:
         t = tag.replace("\"","").replace("\"","").replace("[","").replace("]","").replace("\n","")
         # Strip all invisible characters from beginning and end
@@ -263,11 +344,24 @@ class Memory:
             self.ap.logger.warning(f"Error generator_model_ready is not ready!")
             return []
 
+    def prefetch_tags(self, conversations: typing.List[llm_entities.Message]):
+        """
+        决定回复后即开始提取召回记忆所用对话窗口的标签，与回复等待时间重叠；窗口与 load_memory 相同时直接复用结果
+        """
+        if not self._summarization_mode or not self.generator_model_ready or len(self._long_term_memory) == 0:
+            return
+        if self._tag_extraction_mode == "local" or not conversations:
+            return
+        memory = self.get_last_content(conversations,10)
+        if self._tag_extraction_mode == "hybrid" and len(self._keyword_extractor.extract(memory)) >= self._hybrid_min_tags:
+            return
+        self._tag_extractor.prefetch(memory.replace("{","").replace("}",""))
+
     async def _generate_tags(self,conversation:str) -> typing.List[str]:
         conversation = conversation.replace("{","").replace("}","")
-        tags = self._split_word_cache.get(conversation)
-        if tags != None:
-            return tags
+        return await self._tag_extractor.extract(conversation)
+
+    async def _request_tags(self,conversation:str) -> typing.List[str]:
         user_prompt_tags = f"""
 提取文字中的关键概念："{conversation}"
 1. 关键概念可以是名词，动词，或者特定人物
@@ -275,9 +369,7 @@ class Memory:
 """
         output = await self._generator.return_string_without_jail_break(user_prompt_tags)
         self.ap.logger.info(f"词语： {conversation} 分词： {output}")
-        tags = self._get_tags_from_str_array(output)
-        self._split_word_cache.put(conversation,tags)
-        return tags
+        return self._get_tags_from_str_array(output)
 
     async def _generate_summary(self, conversations: typing.List[llm_entities.Message]) -> tuple[str,typing.List[str]]:
         user_prompt_summary = ""
@@ -379,30 +471,115 @@ class Memory:
     def get_time_form_str(self, time_str: str) -> datetime:
         return datetime.strptime(time_str, "%Y-%m-%d %H:%M:%S")
 
-    async def _tag_and_add_conversations(self):
-        if self.short_term_memory:
-            summary, tags = await self._tag_conversations(self.short_term_memory, True)
-            tags.extend(self._generate_time_tags()) # 增加当天时间标签并去重
-            tags = list(set(tags))
+    def _schedule_summary(self):
+        """
+        在后台总结当前短期记忆的快照，不阻塞回复；同时只进行一次总结
+        """
+        if self.is_summarizing():
+            return
+        snapshot = list(self.short_term_memory)
+        self._write_summary_marker({"count": len(snapshot)})
+        self._summary_task = asyncio.create_task(self._tag_and_add_conversations(snapshot))
+        self._summary_task.add_done_callback(self._on_summary_done)
+
+    def is_summarizing(self) -> bool:
+        return self._summary_task is not None and not self._summary_task.done()
+
+    def _on_summary_done(self, task: asyncio.Task):
+        if not task.cancelled() and task.exception() is not None:
+            self.ap.logger.error(f"记忆总结失败：{task.exception()}")
 
-            # 保留最后1/10
-            limit = self._short_term_memory_size / 10
-            self._drop_short_term_memory(int(limit))
+    async def _tag_and_add_conversations(self, snapshot: typing.List[llm_entities.Message]):
+        if not snapshot:
+            return
+        generation = self._summary_generation
+        with LLMScheduler.priority(LLMScheduler.BACKGROUND):  # 总结不应挤占回复
+            summary, tags = await self._tag_conversations(snapshot, True)
+        if generation != self._summary_generation:
+            self.ap.logger.info("总结期间记忆已被删除，放弃本次总结")
+            return
+        tags.extend(self._generate_time_tags()) # 增加当天时间标签并去重
+        tags = list(set(tags))
 
-            # 加入元标签
-            tags.append("DATETIME:" + self.current_time_str())
+        # 加入元标签
+        tags.append("DATETIME:" + self.current_time_str())
 
-            # 填充到指定数量
-            tag_cnt = self._meta_tag_count + self._summary_max_tags
-            need_padding = tag_cnt - len(tags)
-            if need_padding > 0:
-                for i in range(need_padding):
-                    tags.append(f"PADDING:{i}")
+        # 填充到指定数量
+        tag_cnt = self._meta_tag_count + self._summary_max_tags
+        need_padding = tag_cnt - len(tags)
+        if need_padding > 0:
+            for i in range(need_padding):
+                tags.append(f"PADDING:{i}")
 
-            # 保存记忆
-            self._add_long_term_memory(summary, tags)
-            self._save_long_term_memory_to_file()
-            self._save_short_term_memory_to_file()
+        # 快照只保留最后1/10，总结期间新增的对话不受影响
+        limit = self._short_term_memory_size / 10
+        dropped = snapshot[:len(snapshot) - self._count_kept_conversations(snapshot, int(limit))]
+        await self._commit_summary(summary, tags, [[conv.role, conv.content] for conv in dropped], generation)
+
+    async def _commit_summary(self, summary: str, tags: typing.List[str], dropped: typing.List[typing.List[str]], generation: int):
+        """
+        先落盘带有总结结果的标记，再写入长期记忆、截断短期记忆，最后清除标记；
+        中途中断时，重启后按标记补完未完成的步骤
+        """
+        self._write_summary_marker({"summary": summary, "tags": tags, "dropped": dropped})
+        await Persistence.flush_file(self._summary_marker_file)
+        if generation != self._summary_generation:
+            self.ap.logger.info("总结期间记忆已被删除，放弃本次总结")
+            return
+        self._add_long_term_memory(summary, tags)
+        self._append_long_term_memory_to_journal(summary, tags)
+        self._trim_summarized_conversations(dropped)
+        # 截断后的短期记忆较小，顺便写入检查点
+        self._checkpoint_short_term_memory()
+        self._write_summary_marker(None)
+
+    def _trim_summarized_conversations(self, dropped: typing.List[typing.List[str]]):
+        """
+        短期记忆开头仍是已总结的对话时才截断，保证重复执行不会多删
+        """
+        count = len(dropped)
+        if count == 0 or len(self.short_term_memory) < count:
+            return
+        for conv, (role, content) in zip(self.short_term_memory, dropped):
+            if conv.role != role or conv.content != content:
+                return
+        self.short_term_memory = self.short_term_memory[count:]
+        self._log_short_term_memory({"op": "keep", "count": len(self.short_term_memory)})
+
+    def _write_summary_marker(self, marker: typing.Optional[dict]):
+        # 空文件表示没有未完成的总结
+        Persistence.write(self._summary_marker_file, json.dumps(marker, ensure_ascii=False) if marker else "")
+
+    async def _recover_pending_summary(self):
+        """
+        重启后处理上次未完成的总结：已得到结果的补写长期记忆并截断短期记忆，尚未得到结果的由之后的保存重新触发
+        """
+        try:
+            await Persistence.flush_file(self._summary_marker_file)
+            with open(self._summary_marker_file, "r", encoding="utf-8") as file:
+                content = file.read()
+        except FileNotFoundError:
+            return
+        if not content.strip():
+            return
+        try:
+            marker = json.loads(content)
+        except json.JSONDecodeError as e:
+            self.ap.logger.error(f"总结标记文件损坏，已忽略：{e}")
+            self._write_summary_marker(None)
+            return
+        if "summary" not in marker:
+            self.ap.logger.info("上次的记忆总结未完成，将在短期记忆超出上限时重新总结")
+            self._write_summary_marker(None)
+            return
+        summary, tags = marker["summary"], marker["tags"]
+        if len(self._long_term_memory) == 0 or self._long_term_memory.summary(-1) != summary:
+            self._long_term_memory.append(summary, tags)
+            self._append_long_term_memory_to_journal(summary, tags)
+        self._trim_summarized_conversations(marker.get("dropped", []))
+        self._checkpoint_short_term_memory()
+        self._write_summary_marker(None)
+        self.ap.logger.info(f"已补完上次中断的记忆总结：{summary}")
 
     def _generate_time_tags(self) -> typing.List[str]:
         now = datetime.now()
@@ -419,23 +596,18 @@ class Memory:
         return [year_tag, month_tag, day_tag, period_tag]
 
     def _save_conversations_to_file(self, conversations: typing.List[llm_entities.Message]):
-        try:
-            with open(self._conversations_file, "a", encoding="utf-8") as file:
-                for conv in conversations:
-                    file.write(conv.readable_str() + "\n")
-                file.flush()
-        except Exception as e:
-            self.ap.logger.error(f"Error saving conversations to file '{self._conversations_file}': {e}")
+        if SqliteStorage.enabled():
+            SqliteStorage.append_conversations(self._launcher_id, [conv.readable_str() for conv in conversations])
+            return
+        Persistence.append(self._conversations_file, "".join(conv.readable_str() + "\n" for conv in conversations))
 
     def _add_long_term_memory(self, summary: str, tags: typing.List[str]):
         formatted_tags = ", ".join(tags)
         self.ap.logger.info(f"New memories: \nSummary: {summary}\nTags: {formatted_tags}")
-        self._long_term_memory.append((summary, tags))
-        self._memory_graph.add_memory(MemoryItem(summary, tags))
-        for tag in tags:
-            if tag not in self._tags_index:
-                if tag.count(":") == 0:
-                    self._tags_index[tag] = len(self._tags_index)
+        self._long_term_memory.append(summary, tags)
+        self._memory_graph.add_memory(self._long_term_memory.item(-1))
+        if self._memory_graph.memory_count() % self._journal_compaction_limit == 0:
+            self._memory_graph.save(self._memory_graph_file)
 
     def _extract_time_tag(self, tags: typing.List[str]) -> tuple[int, str]:
         for i in range(len(tags)):
@@ -461,15 +633,6 @@ class Memory:
             tags.pop(priority_index)
         return tags
 
-    def _get_tag_vector(self, tags: typing.List[str]) -> np.ndarray:
-        tags = self._get_real_tags(tags)
-
-        vector = np.zeros(len(self._tags_index))
-        for tag in tags:
-            if tag in self._tags_index:
-                vector[self._tags_index[tag]] = 1
-        return vector
-
     def _cosine_similarity(self, vector_a: np.ndarray, vector_b: np.ndarray) -> float:
         dot_product = np.dot(vector_a, vector_b)
         norm_a = np.linalg.norm(vector_a)
@@ -653,130 +816,121 @@ class Memory:
 
         return
 
-    def _retrieve_related_l0_memories(self, input_tags: typing.List[str]) -> typing.List[tuple[float, MemoryItem]]:
-        self.ap.logger.info(f"开始L0记忆召回 Tags: {', '.join(input_tags)}")
-        current_time = datetime.now()
-        input_vector = self._get_tag_vector(input_tags)
-        l0_memories = []
-        self._last_l0_recall_memories = []
+    def _get_window_ids(self, candidates: np.ndarray, current_timestamp: float, min_age: typing.Optional[float], max_age: typing.Optional[float]) -> np.ndarray:
+        """
+        通过时间索引取出距今 [min_age, max_age] 秒内的候选记忆编号（不考虑最新的记忆），None表示不限
+        """
+        start = None if max_age is None else current_timestamp - max_age
+        end = None if min_age is None else current_timestamp - min_age
+        ids = np.intersect1d(self._long_term_memory.window(start, end), candidates, assume_unique=True)
+        return ids[ids < len(self._long_term_memory) - 1]
+
+    def _compute_recall_features(self, input_tags: typing.List[str], ids: np.ndarray, current_timestamp: float) -> typing.Dict[str, np.ndarray]:
+        """
+        计算时间窗口内记忆的召回特征，耗时只与窗口内记忆数量相关
+        ids: 记忆编号  age: 距今秒数  similarity: 余弦相似度  hits: 命中标签数
+        jaccard: Jaccard系数  tag_boost: 命中加成  tag_count: 标签总数
+        """
+        # 元标签已在MemoryStore中预先解析
+        columns = self._long_term_memory.columns()
+        timestamps = columns["timestamp"][ids]
+        real_tag_sizes = columns["real_tag_size"][ids]
+        tag_counts = columns["tag_count"][ids]
+
+        similarities, hits = self._long_term_memory.similarity(input_tags, ids)
+        hits = hits.astype(np.float64)
+
+        input_cnt = len(set(input_tags))
+        union = input_cnt + real_tag_sizes - hits
+        jaccard = np.zeros(len(ids), dtype=np.float64)
+        np.divide(hits, union, out=jaccard, where=union > 0)
+        tag_boost = np.clip(hits ** 1.5 / input_cnt, 0.8, 2.5)
+
+        return {
+            "ids": ids,
+            "age": current_timestamp - timestamps,
+            "similarity": similarities,
+            "hits": hits,
+            "jaccard": jaccard,
+            "tag_boost": tag_boost,
+            "tag_count": tag_counts,
+        }
+
+    def _slice_recall_features(self, features: typing.Dict[str, np.ndarray], current_timestamp: float, min_age: typing.Optional[float], max_age: typing.Optional[float]) -> typing.Dict[str, np.ndarray]:
+        """
+        通过时间索引选出层级窗口内记忆在召回特征中的行，各层级共用同一份特征，不重复计算
+        """
+        window_ids = self._get_window_ids(features["ids"], current_timestamp, min_age, max_age)
+        rows = np.searchsorted(features["ids"], window_ids)
+        return {name: column[rows] for name, column in features.items()}
+
+    def _select_level_memories(self, features: typing.Dict[str, np.ndarray], in_window: np.ndarray, weights: np.ndarray, admitted: np.ndarray) -> typing.List[tuple[float, MemoryItem]]:
+        """在时间窗口内按准入规则选取记忆，按权重降序取前recall_once条"""
+        selected = np.flatnonzero(in_window & admitted)
+        selected = selected[np.argsort(-weights[selected], kind="stable")][: self._memories_recall_once]
+        memories = []
+        for j in selected:
+            memories.append((float(weights[j]), self._long_term_memory.item(features["ids"][j])))
+        return memories
+
+    def _retrieve_related_l0_memories(self, recall_features: typing.Dict[str, np.ndarray], current_timestamp: float) -> typing.List[tuple[float, MemoryItem]]:
+        self.ap.logger.info("开始L0记忆召回")
 
         # L0配置（0-24小时）
         DECAY_RATE_PER_MIN = 0.002
         MAX_HOURS = 24
         COMBO_THRESHOLD = self._l0_threshold  # 权重门槛
 
-        if len(self._long_term_memory) == 0:
-            return []
-
-        # 不考虑最新的记忆
-        for summary, tags in self._long_term_memory[:len(self._long_term_memory) - 1]:
-            # 提取元标签
-            (_,time_tags) = self._extract_time_tag(tags)
-            summary_time = datetime.fromtimestamp(self._backoff_timestamp)
-            if time_tags != "":
-                summary_time = self.get_time_form_str(time_tags)
-            else:
-                time_tags = summary_time.strftime("%Y-%m-%d %H:%M:%S")
-
-            delta = current_time - summary_time
-            # 时间过滤与权重计算
-            delta_hours = delta.total_seconds()/3600
-            if delta_hours > MAX_HOURS:
-                # 记忆按时间排序
-                break
-
-            # 分钟级衰减计算
-            delta_min = delta.total_seconds() / 60
-            time_weight = math.exp(-DECAY_RATE_PER_MIN * delta_min)
-            similarity = self._cosine_similarity(input_vector, self._get_tag_vector(tags))
+        features = self._slice_recall_features(recall_features, current_timestamp, None, MAX_HOURS * 3600)
+        similarity = features["similarity"]
+        delta_hours = features["age"] / 3600
+        in_window = delta_hours <= MAX_HOURS
 
-            input_set = set(input_tags)
-            mem_tags = set(self._get_real_tags(tags))
-            hits = len(input_set & mem_tags)  # 实际命中标签数
+        # 分钟级衰减计算
+        delta_min = features["age"] / 60
+        time_weight = np.exp(-DECAY_RATE_PER_MIN * delta_min)
 
-            recency_boost = 1.2   # 衰减斜率降低
-            similarity_weight = similarity * self._calc_tag_boost_rate(hits,len(input_set))
-            weight = similarity_weight * (time_weight**0.8)  * recency_boost  # 添加指数平滑
+        recency_boost = 1.2   # 衰减斜率降低
+        similarity_weight = similarity * features["tag_boost"]
+        weight = similarity_weight * (time_weight**0.8) * recency_boost  # 添加指数平滑
+        weight = np.minimum(weight, self._memory_weight_max)  # 限制最大权重
 
-            weight = min(weight, self._memory_weight_max)  # 限制最大权重
+        # 准入规则
+        admitted = weight >= COMBO_THRESHOLD
 
-            # 准入规则
-            if weight >= COMBO_THRESHOLD:
-                result_mem = MemoryItem(summary,tags)
-                l0_memories.append((weight,result_mem))
+        self._last_l0_recall_memories = [(weight[j], similarity[j], self._long_term_memory.summary(i)[:40], self._long_term_memory.tags(i)) for j, i in enumerate(features["ids"]) if in_window[j]]
+        return self._select_level_memories(features, in_window, weight, admitted)
 
-            self._last_l0_recall_memories.append((weight, similarity, summary[:40],tags))
-
-
-        l0_memories.sort(reverse=True, key=lambda x: x[0])
-        return l0_memories[: self._memories_recall_once]
-
-    def _retrieve_related_l1_memories(self, input_tags: typing.List[str]) -> typing.List[tuple[float, MemoryItem]]:
-        self.ap.logger.info(f"开始L1记忆召回 Tags: {', '.join(input_tags)}")
-        current_time = datetime.now()
-        input_vector = self._get_tag_vector(input_tags)
-        l1_memories = []
-        self._last_l1_recall_memories = []
+    def _retrieve_related_l1_memories(self, recall_features: typing.Dict[str, np.ndarray], current_timestamp: float) -> typing.List[tuple[float, MemoryItem]]:
+        self.ap.logger.info("开始L1记忆召回")
 
         # L1配置（1-3天）
         DECAY_RATE_PER_HOUR = 0.02
         MIN_HOURS, MAX_HOURS = 19, 72
 
-        if len(self._long_term_memory) == 0:
-            return []
-
-        # 不考虑最新的记忆
-        for summary, tags in self._long_term_memory[:len(self._long_term_memory) - 1]:
-            # 提取元标签
-            (_,time_tags) = self._extract_time_tag(tags)
-            summary_time = datetime.fromtimestamp(self._backoff_timestamp)
-            if time_tags != "":
-                summary_time = self.get_time_form_str(time_tags)
-            else:
-                time_tags = summary_time.strftime("%Y-%m-%d %H:%M:%S")
-
-            # 严格时间过滤
-            delta_hours = (current_time - summary_time).total_seconds() / 3600
-
-            if delta_hours > MAX_HOURS:
-                # 记忆按时间排序
-                break
-
-            if not (MIN_HOURS <= delta_hours <= MAX_HOURS):
-                continue
-
-
-            # 时间敏感度检测
-            time_weight = math.exp(-DECAY_RATE_PER_HOUR * delta_hours)
-            similarity = self._cosine_similarity(input_vector, self._get_tag_vector(tags))
-            # 新增命中数计算
-            input_set = set(input_tags)
-            mem_tags = set(self._get_real_tags(tags))
-            hits = len(input_set & mem_tags)
-
-            similarity_weight = similarity * self._calc_tag_boost_rate(hits,len(input_set))
-            weight = similarity_weight * time_weight
-
-            weight = min(weight, self._memory_weight_max)  # 限制最大权重
+        features = self._slice_recall_features(recall_features, current_timestamp, MIN_HOURS * 3600, MAX_HOURS * 3600)
+        similarity = features["similarity"]
+        # 严格时间过滤
+        delta_hours = features["age"] / 3600
+        in_window = (delta_hours >= MIN_HOURS) & (delta_hours <= MAX_HOURS)
 
-            self._last_l1_recall_memories.append((weight, similarity, summary[:40],tags))
+        # 时间敏感度检测
+        time_weight = np.exp(-DECAY_RATE_PER_HOUR * delta_hours)
+        similarity_weight = similarity * features["tag_boost"]
+        weight = similarity_weight * time_weight
+        weight = np.minimum(weight, self._memory_weight_max)  # 限制最大权重
 
-            # 动态准入（随时间放宽阈值）
-            hour_factor = (delta_hours - MIN_HOURS) / (MAX_HOURS - MIN_HOURS)  # 0~1
-            dynamic_th = self._l1_base * (1 - self._l1_hour_reduction_rate * hour_factor)
-            dynamic_th = max(dynamic_th,self._l1_threshold_floor)
-            if weight > dynamic_th:
-                result_mem = MemoryItem(summary,tags)
-                l1_memories.append((weight, result_mem))
+        # 动态准入（随时间放宽阈值）
+        hour_factor = (delta_hours - MIN_HOURS) / (MAX_HOURS - MIN_HOURS)  # 0~1
+        dynamic_th = self._l1_base * (1 - self._l1_hour_reduction_rate * hour_factor)
+        dynamic_th = np.maximum(dynamic_th, self._l1_threshold_floor)
+        admitted = weight > dynamic_th
 
-        l1_memories.sort(reverse=True, key=lambda x: x[0])
-        return l1_memories[: self._memories_recall_once]
+        self._last_l1_recall_memories = [(weight[j], similarity[j], self._long_term_memory.summary(i)[:40], self._long_term_memory.tags(i)) for j, i in enumerate(features["ids"]) if in_window[j]]
+        return self._select_level_memories(features, in_window, weight, admitted)
 
-    def _retrieve_related_l2_memories(self, input_tags: typing.List[str]) -> typing.List[tuple[float, MemoryItem]]:
-        self.ap.logger.info(f"开始L2记忆召回 Tags: {', '.join(input_tags)}")
-        current_time = datetime.now()
-        input_vector = self._get_tag_vector(input_tags)
-        l2_memories = []
+    def _retrieve_related_l2_memories(self, recall_features: typing.Dict[str, np.ndarray], current_timestamp: float) -> typing.List[tuple[float, MemoryItem]]:
+        self.ap.logger.info("开始L2记忆召回")
 
         # L2配置（3-7天）
         TIME_DECAY_RATE = 0.0002 # 小时级衰减
@@ -785,66 +939,28 @@ class Memory:
         TOPIC_WEIGHT = 1.2
         BASE_VALUE = 0.7
 
-        if len(self._long_term_memory) == 0:
-            return []
-
-        # 不考虑最新的记忆
-        for summary, tags in self._long_term_memory[:len(self._long_term_memory) - 1]:
-            # 提取元标签
-            (_,time_tags) = self._extract_time_tag(tags)
-            summary_time = datetime.fromtimestamp(self._backoff_timestamp)
-            if time_tags != "":
-                summary_time = self.get_time_form_str(time_tags)
-            else:
-                time_tags = summary_time.strftime("%Y-%m-%d %H:%M:%S")
+        # 按天取整，窗口上界放宽一天后再精确过滤
+        features = self._slice_recall_features(recall_features, current_timestamp, MIN_DAYS * 86400, (MAX_DAYS + 1) * 86400)
+        similarity = features["similarity"]
+        jaccard = features["jaccard"]
+        delta_days = np.floor(features["age"] / 86400)
+        in_window = (delta_days >= MIN_DAYS) & (delta_days <= MAX_DAYS)
 
-            delta_days = (current_time - summary_time).days
+        # 权重计算
+        delta_hours = features["age"] / 3600
+        time_weight = np.exp(-TIME_DECAY_RATE * delta_hours)
+        similarity_weight = similarity * features["tag_boost"]
+        weight = similarity_weight * (time_weight ** 0.4) * (BASE_VALUE + TOPIC_WEIGHT * jaccard)
+        weight = np.minimum(weight, self._memory_weight_max)  # 限制最大权重
 
-            if delta_days > MAX_DAYS:
-                # 记忆按时间排序
-                break
+        # 分级准入
+        admitted = (weight >= SIMILARITY_THRESHOLD) | ((jaccard >= self._l2_jaccard) & (similarity >= self._l2_similarity))
 
-            if not (MIN_DAYS <= delta_days <= MAX_DAYS):
-                continue
+        self._last_l2_recall_memories = [(weight[j], jaccard[j], similarity[j], self._long_term_memory.summary(i)[:40], self._long_term_memory.tags(i)) for j, i in enumerate(features["ids"]) if in_window[j]]
+        return self._select_level_memories(features, in_window, weight, admitted)
 
-            # 主题关联计算
-            real_tags = self._get_real_tags(tags)
-            input_set = set(input_tags)
-            mem_tags = set(real_tags)
-            intersection = input_set & mem_tags
-            union = input_set | mem_tags
-            jaccard = len(intersection)/len(union) if union else 0
-
-            # 权重计算
-            delta_hours = (current_time - summary_time).total_seconds() / 3600
-            time_weight = math.exp(-TIME_DECAY_RATE * delta_hours)
-            similarity = self._cosine_similarity(input_vector, self._get_tag_vector(tags))
-            # 新增命中数计算
-            input_set = set(input_tags)
-            mem_tags = set(self._get_real_tags(tags))
-            hits = len(input_set & mem_tags)
-
-            # 修改权重公式
-            similarity_weight = similarity * self._calc_tag_boost_rate(hits,len(input_set))
-            weight = similarity_weight * (time_weight ** 0.4) * (BASE_VALUE + TOPIC_WEIGHT * jaccard)
-
-            weight = min(weight, self._memory_weight_max)  # 限制最大权重
-
-            self._last_l2_recall_memories.append((weight,jaccard, similarity, summary[:40],tags))
-
-            # 分级准入
-            if weight >= SIMILARITY_THRESHOLD or (jaccard >= self._l2_jaccard and similarity >= self._l2_similarity):
-                result_mem = MemoryItem(summary,tags)
-                l2_memories.append((weight, result_mem))
-
-        l2_memories.sort(reverse=True, key=lambda x: x[0])
-        return l2_memories[: self._memories_recall_once]
-
-    def _retrieve_related_l3_memories(self, input_tags: typing.List[str]) -> typing.List[tuple[float, MemoryItem]]:
-        self.ap.logger.info(f"开始L3记忆召回 Tags: {', '.join(input_tags)}")
-        current_time = datetime.now()
-        input_vector = self._get_tag_vector(input_tags)
-        l3_memories = []
+    def _retrieve_related_l3_memories(self, recall_features: typing.Dict[str, np.ndarray], current_timestamp: float) -> typing.List[tuple[float, MemoryItem]]:
+        self.ap.logger.info("开始L3记忆召回")
 
         # L3配置（7-30天）
         DECAY_RATE = 0.01  # 天级衰减
@@ -852,63 +968,27 @@ class Memory:
         MIN_DAYS, MAX_DAYS = 5.6, 30
         JACCARD_FLOOR = self._l3_jaccard_floor  # 最低标签匹配
 
-        if len(self._long_term_memory) == 0:
-            return []
-
-        # 不考虑最新的记忆
-        for summary, tags in self._long_term_memory[:len(self._long_term_memory) - 1]:
-            # 提取元标签
-            (_,time_tags) = self._extract_time_tag(tags)
-            summary_time = datetime.fromtimestamp(self._backoff_timestamp)
-            if time_tags != "":
-                summary_time = self.get_time_form_str(time_tags)
-            else:
-                time_tags = summary_time.strftime("%Y-%m-%d %H:%M:%S")
-
-            delta_days = (current_time - summary_time).days
-
-            if delta_days > MAX_DAYS:
-                # 记忆按时间排序
-                break
-
-            if not (MIN_DAYS <= delta_days <= MAX_DAYS):
-                continue
-
-            # 混合匹配计算
-            mem_tags = set(self._get_real_tags(tags))
-            input_set = set(input_tags)
-            jaccard = len(input_set & mem_tags) / len(input_set | mem_tags) if input_set else 0
-
-            similarity = self._cosine_similarity(input_vector, self._get_tag_vector(tags))
-            time_weight = math.exp(-DECAY_RATE * delta_days)
-            # 新增命中数计算
-            input_set = set(input_tags)
-            mem_tags = set(self._get_real_tags(tags))
-            hits = len(input_set & mem_tags)
-            # 修改权重计算
-            similarity_weight = similarity * self._calc_tag_boost_rate(hits,len(input_set))
-            weight = (similarity_weight * 0.4 + jaccard * 0.6) * (time_weight**0.2)
+        features = self._slice_recall_features(recall_features, current_timestamp, MIN_DAYS * 86400, (MAX_DAYS + 1) * 86400)
+        similarity = features["similarity"]
+        jaccard = features["jaccard"]
+        delta_days = np.floor(features["age"] / 86400)
+        in_window = (delta_days >= MIN_DAYS) & (delta_days <= MAX_DAYS)
 
-            weight = min(weight, self._memory_weight_max)  # 限制最大权重
+        # 混合匹配计算
+        time_weight = np.exp(-DECAY_RATE * delta_days)
+        similarity_weight = similarity * features["tag_boost"]
+        weight = (similarity_weight * 0.4 + jaccard * 0.6) * (time_weight**0.2)
+        weight = np.minimum(weight, self._memory_weight_max)  # 限制最大权重
+        weight = np.where(delta_days > 15, weight * (1.2 - 0.01 * (delta_days - 15)), weight)
 
-            if delta_days > 15:
-                weight *= 1.2 - 0.01*(delta_days-15)
+        # 准入规则
+        admitted = (weight >= SIMILARITY_THRESHOLD) & (jaccard >= JACCARD_FLOOR)
 
-            self._last_l3_recall_memories.append((weight, jaccard, similarity, summary[:40],tags))
+        self._last_l3_recall_memories = [(weight[j], jaccard[j], similarity[j], self._long_term_memory.summary(i)[:40], self._long_term_memory.tags(i)) for j, i in enumerate(features["ids"]) if in_window[j]]
+        return self._select_level_memories(features, in_window, weight, admitted)
 
-            # 准入规则
-            if weight >= SIMILARITY_THRESHOLD and jaccard >= JACCARD_FLOOR:
-                result_mem = MemoryItem(summary,tags)
-                l3_memories.append((weight, result_mem))
-
-        l3_memories.sort(reverse=True, key=lambda x: x[0])
-        return l3_memories[: self._memories_recall_once]
-
-    def _retrieve_related_l4_memories(self, input_tags: typing.List[str]) -> typing.List[tuple[float, MemoryItem]]:
-        self.ap.logger.info(f"开始L4记忆召回 Tags: {', '.join(input_tags)}")
-        current_time = datetime.now()
-        input_vector = self._get_tag_vector(input_tags)
-        l4_memories = []
+    def _retrieve_related_l4_memories(self, recall_features: typing.Dict[str, np.ndarray], current_timestamp: float) -> typing.List[tuple[float, MemoryItem]]:
+        self.ap.logger.info("开始L4记忆召回")
 
         # L4配置（30天到365天）
         DECAY_RATE = 0.00003  # 超低衰减率
@@ -917,110 +997,52 @@ class Memory:
         MIN_DAYS = 24
         MAX_DAYS = 365
 
-        if len(self._long_term_memory) == 0:
-            return []
+        features = self._slice_recall_features(recall_features, current_timestamp, MIN_DAYS * 86400, (MAX_DAYS + 1) * 86400)
+        similarity = features["similarity"]
+        delta_days = np.floor(features["age"] / 86400)
+        in_window = (delta_days >= MIN_DAYS) & (delta_days <= MAX_DAYS)
 
-        # 不考虑最新的记忆
-        for summary, tags in self._long_term_memory[:len(self._long_term_memory) - 1]:
-            # 提取元标签
-            (_,time_tags) = self._extract_time_tag(tags)
-            summary_time = datetime.fromtimestamp(self._backoff_timestamp)
-            if time_tags != "":
-                summary_time = self.get_time_form_str(time_tags)
-            else:
-                time_tags = summary_time.strftime("%Y-%m-%d %H:%M:%S")
+        # 优化衰减公式（添加非线性因子）
+        decay_factor = 1 + 0.8 * (delta_days // 180)
+        time_weight = np.exp(-DECAY_RATE * delta_days * decay_factor)
 
-            delta_days = (current_time - summary_time).days
+        # 纯语义匹配
+        similarity_weight = similarity * features["tag_boost"]
+        weight = similarity_weight * time_weight
+        weight = np.minimum(weight, self._memory_weight_max)  # 限制最大权重
 
-            if delta_days > MAX_DAYS:
-                # 记忆按时间排序
-                break
-
-            if not (MIN_DAYS <= delta_days <= MAX_DAYS):
-                continue
-
-            # 优化衰减公式（添加非线性因子）
-            decay_factor = 1 + 0.8 * (delta_days//180)
-            time_weight = math.exp(-DECAY_RATE * delta_days * decay_factor)
-
-            # 命中数计算
-            input_set = set(input_tags)
-            mem_tags = set(self._get_real_tags(tags))
-            hits = len(input_set & mem_tags)
-
-            # 纯语义匹配
-            similarity = self._cosine_similarity(input_vector, self._get_tag_vector(tags))
-            similarity_weight = similarity * self._calc_tag_boost_rate(hits,len(input_set))
+        # 紧急通道 + 正常准入
+        admitted = (weight >= SIMILARITY_THRESHOLD) | ((similarity >= EMERGENCY_THRESHOLD) & (features["tag_count"] >= 5))
 
-            weight = similarity_weight * time_weight
+        self._last_l4_recall_memories = [(weight[j], similarity[j], self._long_term_memory.summary(i)[:40], self._long_term_memory.tags(i)) for j, i in enumerate(features["ids"]) if in_window[j]]
+        return self._select_level_memories(features, in_window, weight, admitted)
 
-            weight = min(weight, self._memory_weight_max)  # 限制最大权重
-
-            self._last_l4_recall_memories.append((weight, similarity, summary[:40],tags))
-
-            # 紧急通道 + 正常准入
-            if weight >= SIMILARITY_THRESHOLD or similarity >= EMERGENCY_THRESHOLD and len(tags) >= 5:
-                result_mem = MemoryItem(summary,tags)
-                l4_memories.append((weight, result_mem))
-
-        l4_memories.sort(reverse=True, key=lambda x: x[0])
-        return l4_memories[: self._memories_recall_once]
-
-    def _retrieve_related_l5_memories(self, input_tags: typing.List[str]) -> typing.List[tuple[float, MemoryItem]]:
-        self.ap.logger.info(f"开始L5记忆召回 Tags: {', '.join(input_tags)}")
-        current_time = datetime.now()
-        input_vector = self._get_tag_vector(input_tags)
-        l5_memories = []
-
-        self._last_l5_recall_memories = []
+    def _retrieve_related_l5_memories(self, recall_features: typing.Dict[str, np.ndarray], current_timestamp: float) -> typing.List[tuple[float, MemoryItem]]:
+        self.ap.logger.info("开始L5记忆召回")
 
         # L5配置（1年以上记忆）
         DECAY_RATE = 0.00003  # 极低衰减率（十年后保留≈e^(-0.00001 * 3650)=0.964）
         SIMILARITY_THRESHOLD = self._l5_threshold  # 高精度阈值
         MIN_DAYS = 365  # 1年+
 
-        if len(self._long_term_memory) == 0:
-            return []
-
-        # 不考虑最新的记忆
-        for summary, tags in self._long_term_memory[:len(self._long_term_memory) - 1]:
-            # 提取元标签
-            (_,time_tags) = self._extract_time_tag(tags)
-            summary_time = datetime.fromtimestamp(self._backoff_timestamp)
-            if time_tags != "":
-                summary_time = self.get_time_form_str(time_tags)
-            else:
-                time_tags = summary_time.strftime("%Y-%m-%d %H:%M:%S")
-
-            delta_days = (current_time - summary_time).days
-            if delta_days < MIN_DAYS:
-                continue
-
-            # 纯语义匹配（可扩展点：未来在此添加事件触发逻辑）
-            similarity = self._cosine_similarity(input_vector, self._get_tag_vector(tags))
-            decay_factor = 1 + 0.5 * (delta_days//180)
-            time_weight = math.exp(-DECAY_RATE * delta_days * decay_factor)
-            # 新增命中数计算
-            input_set = set(input_tags)
-            mem_tags = set(self._get_real_tags(tags))
-            hits = len(input_set & mem_tags)
-            similarity_weight = similarity * self._calc_tag_boost_rate(hits,len(input_set))
-            weight = similarity_weight * time_weight
-
-            weight = min(weight, self._memory_weight_max)  # 限制最大权重
+        features = self._slice_recall_features(recall_features, current_timestamp, MIN_DAYS * 86400, None)
+        similarity = features["similarity"]
+        delta_days = np.floor(features["age"] / 86400)
+        in_window = delta_days >= MIN_DAYS
 
-            if delta_days > 730:  # 2年以上的记忆
-                weight *= 1.3  # 给予历史记忆加成
+        # 纯语义匹配（可扩展点：未来在此添加事件触发逻辑）
+        decay_factor = 1 + 0.5 * (delta_days // 180)
+        time_weight = np.exp(-DECAY_RATE * delta_days * decay_factor)
+        similarity_weight = similarity * features["tag_boost"]
+        weight = similarity_weight * time_weight
+        weight = np.minimum(weight, self._memory_weight_max)  # 限制最大权重
+        weight = np.where(delta_days > 730, weight * 1.3, weight)  # 2年以上的记忆给予历史记忆加成
 
-            self._last_l5_recall_memories.append((weight, similarity, summary[:40],tags))
+        # 准入规则（可扩展点：未来添加人工审核接口）
+        admitted = weight >= SIMILARITY_THRESHOLD
 
-            # 准入规则（可扩展点：未来添加人工审核接口）
-            if weight >= SIMILARITY_THRESHOLD:
-                result_mem = MemoryItem(summary,tags)
-                l5_memories.append((weight,result_mem))
-
-        l5_memories.sort(reverse=True, key=lambda x: x[0])
-        return l5_memories[: self._memories_recall_once]
+        self._last_l5_recall_memories = [(weight[j], similarity[j], self._long_term_memory.summary(i)[:40], self._long_term_memory.tags(i)) for j, i in enumerate(features["ids"]) if in_window[j]]
+        return self._select_level_memories(features, in_window, weight, admitted)
 
     def _clear_memories_session(self):
         self._memories_session = []
@@ -1160,28 +1182,37 @@ class Memory:
         recall_threshold = self._memories_recall_once * 3
         current_recall_count = 0
 
+        if len(self._long_term_memory) == 0:
+            return []
+
+        # 只计算至少命中一个标签的记忆
+        current_timestamp = datetime.now().timestamp()
+        candidates = self._long_term_memory.candidates(input_tags)
+        # 召回特征在各层级窗口的并集上只计算一次，各层级按时间窗口取行
+        recall_features = self._compute_recall_features(input_tags, self._get_window_ids(candidates, current_timestamp, None, None), current_timestamp)
+
         if current_recall_count < recall_threshold:
-            l0_results = self._retrieve_related_l0_memories(input_tags)
+            l0_results = self._retrieve_related_l0_memories(recall_features, current_timestamp)
             current_recall_count += len(l0_results)
 
         if current_recall_count < recall_threshold:
-            l1_results = self._retrieve_related_l1_memories(input_tags)
+            l1_results = self._retrieve_related_l1_memories(recall_features, current_timestamp)
             current_recall_count += len(l1_results)
 
         if current_recall_count < recall_threshold:
-            l2_results = self._retrieve_related_l2_memories(input_tags)
+            l2_results = self._retrieve_related_l2_memories(recall_features, current_timestamp)
             current_recall_count += len(l2_results)
 
         if current_recall_count < recall_threshold:
-            l3_results = self._retrieve_related_l3_memories(input_tags)
+            l3_results = self._retrieve_related_l3_memories(recall_features, current_timestamp)
             current_recall_count += len(l3_results)
 
         if current_recall_count < recall_threshold:
-            l4_results = self._retrieve_related_l4_memories(input_tags)
+            l4_results = self._retrieve_related_l4_memories(recall_features, current_timestamp)
             current_recall_count += len(l4_results)
 
         if current_recall_count < recall_threshold:
-            l5_results = self._retrieve_related_l5_memories(input_tags)
+            l5_results = self._retrieve_related_l5_memories(recall_features, current_timestamp)
             current_recall_count += len(l5_results)
 
         # 构建带权记忆池
@@ -1372,12 +1403,9 @@ class Memory:
 
         # 强制添加最新记忆保持连续
         if len(self._long_term_memory) != 0:
-            latest = self._long_term_memory[-1]
-            tags = latest[1]
-            time_tags = self._extract_time_tag(tags)[1]
-            if time_tags != "":
-                summary_time = self.get_time_form_str(time_tags)
-                latest = latest[0]
+            summary_time = self._long_term_memory.time(-1)
+            if summary_time is not None:
+                latest = self._long_term_memory.summary(-1)
                 if latest not in memories:
                     memories.append((summary_time,latest))
 
@@ -1390,33 +1418,38 @@ class Memory:
                 size += len(conversation.content)
         return size
 
-    def _drop_short_term_memory(self,limit:int):
-        memories = self.short_term_memory.copy()
-        memories.reverse()
+    def _count_kept_conversations(self, conversations: typing.List[llm_entities.Message], limit: int) -> int:
+        """
+        从末尾起累计字数不超过limit的对话条数
+        """
         size = 0
         max_cnt = 0
-        for i in range(len(memories)):
-            mem = memories[i]
+        for mem in reversed(conversations):
             if mem.content != None:
                 size += len(mem.content)
                 if size >= limit:
                     break
             max_cnt += 1
+        return max_cnt
+
+    def _drop_short_term_memory(self,limit:int):
+        max_cnt = self._count_kept_conversations(self.short_term_memory, limit)
         self.short_term_memory = self.short_term_memory[-max_cnt:]
+        self._log_short_term_memory({"op": "keep", "count": len(self.short_term_memory)})
         return
 
     async def save_memory(self, role: str, content: str):
         time = self._generator.get_chinese_current_time()
         conversation = llm_entities.Message(role=role, content=f"[{time}]{content}")
         self.short_term_memory.append(conversation)
-        self._save_short_term_memory_to_file()
+        self._log_short_term_memory({"op": "append", "role": conversation.role, "content": conversation.content})
         self._save_conversations_to_file([conversation])
         current_size = self._calc_short_term_memory_size()
         self.ap.logger.info(f"当前短期记忆大小: {current_size} 字符, 允许最大值: {self._short_term_memory_size} 字符")
 
         if current_size >= self._short_term_memory_size:
             if self._summarization_mode:
-                await self._tag_and_add_conversations()
+                self._schedule_summary()
             else:
                 max_remain = self._short_term_memory_size//2
                 self._drop_short_term_memory(max_remain)
@@ -1424,7 +1457,7 @@ class Memory:
     async def remove_last_memory(self) -> str:
         if len(self.short_term_memory) > 0:
             last_conversation = self.short_term_memory.pop().get_content_platform_message_chain()
-            self._save_short_term_memory_to_file()
+            self._log_short_term_memory({"op": "pop"})
             return last_conversation # type: ignore
         return ""
 
@@ -1445,62 +1478,113 @@ class Memory:
             memories_str.append(memory_str)
         return "\n\n".join(memories_str)
 
-    def delete_local_files(self):
+    async def delete_local_files(self):
+        self._summary_generation += 1  # 先作废进行中的总结，删除文件期间不再写入
         files_to_delete = [
             self._long_term_memory_file,
+            self._long_term_memory_journal.file(),
             self._conversations_file,
             self._short_term_memory_file,
+            self._short_term_memory_journal.file(),
             self._status_file,
             f"data/plugins/Waifu/data/life_{self._launcher_id}.json",
+            self._memory_graph_file,
+            self._summary_marker_file,
         ]
 
         for file in files_to_delete:
+            await Persistence.discard(file)
             if os.path.exists(file):
                 os.remove(file)
                 self.ap.logger.info(f"Deleted {file}")
             else:
                 self.ap.logger.info(f"File {file} does not exist")
 
+        await self._long_term_memory_journal.delete()
+        await self._short_term_memory_journal.delete()
+        if SqliteStorage.enabled():
+            SqliteStorage.delete_launcher(self._launcher_id)
         self.short_term_memory.clear()
         self._long_term_memory.clear()
+        self._reset_tags_index()
         self._memory_graph.clear()
         self.ap.logger.info("Cleared short-term and long-term memories")
 
-    def _save_long_term_memory_to_file(self):
-        tmpFile = "{}.tmp".format(self._long_term_memory_file)
-        try:
-            with open(tmpFile, "w", encoding="utf-8") as file:
-                json.dump({"long_term": [{"summary": summary, "tags": tags} for summary, tags in self._long_term_memory], "tags_index": self._tags_index}, file, ensure_ascii=False, indent=4)
-                file.flush()
-        except Exception as e:
-            self.ap.logger.error(f"Error saving memory to file '{self._long_term_memory_file}': {e}")
+    def _append_long_term_memory_to_journal(self, summary: str, tags: typing.List[str]):
+        """
+        新记忆只追加到日志，累计到一定条数后再合并进快照
+        """
+        seq = len(self._long_term_memory) - 1
+        if SqliteStorage.enabled():
+            SqliteStorage.add_long_term_memory(self._launcher_id, seq, summary, tags)
+            return
+        self._long_term_memory_journal.append({"seq": seq, "summary": summary, "tags": tags})
+        if len(self._long_term_memory_journal) >= self._journal_compaction_limit:
+            self._compact_long_term_memory()
 
-        try:
-            os.replace(tmpFile, self._long_term_memory_file)
-        except Exception as e:
-            self.ap.logger.error(f"Error replacing memory file '{self._long_term_memory_file}': {e}")
+    def _compact_long_term_memory(self):
+        # 快照写盘成功后日志才会被清空
+        self._save_long_term_memory_to_file()
+        self._long_term_memory_journal.truncate()
+        self.ap.logger.info(f"记忆日志已合并进快照，共{len(self._long_term_memory)}条记忆")
 
-    def _save_short_term_memory_to_file(self):
-        tmpFile = "{}.tmp".format(self._short_term_memory_file)
-        try:
-            with open(tmpFile, "w", encoding="utf-8") as file:
-                json.dump([{"role": conv.role, "content": conv.content} for conv in self.short_term_memory], file, ensure_ascii=False, indent=4)
-                file.flush()
-        except Exception as e:
-            self.ap.logger.error(f"Error saving memory to file '{self._short_term_memory_file}': {e}")
+    def _save_long_term_memory_to_file(self):
+        # 内容在后台写盘前才序列化，多次保存只序列化一次
+        Persistence.write(self._long_term_memory_file, lambda: json.dumps({"long_term": [{"summary": summary, "tags": tags} for summary, tags in self._long_term_memory], "tags_index": self._tags_index}, ensure_ascii=False, indent=4))
+
+    def _log_short_term_memory(self, record: dict):
+        """
+        短期记忆的变更（append/pop/keep）写入预写日志，累计到一定条数后写入检查点
+        """
+        if SqliteStorage.enabled():
+            SqliteStorage.apply_short_term_memory(self._launcher_id, record)
+            return
+        self._short_term_memory_seq += 1
+        record["seq"] = self._short_term_memory_seq
+        self._short_term_memory_journal.append(record)
+        if len(self._short_term_memory_journal) >= self._checkpoint_limit:
+            self._checkpoint_short_term_memory()
+
+    def _checkpoint_short_term_memory(self):
+        if SqliteStorage.enabled():
             return
+        # 检查点写盘成功后日志才会被清空
+        self._save_short_term_memory_to_file()
+        self._short_term_memory_journal.truncate()
 
-        try:
-            os.replace(tmpFile, self._short_term_memory_file)
-        except Exception as e:
-            self.ap.logger.error(f"Error replacing memory file '{self._short_term_memory_file}': {e}")
+    def _save_short_term_memory_to_file(self):
+        # 内容在后台写盘前才序列化，seq为检查点包含的最后一条日志序号，重放时据此跳过已包含的记录
+        Persistence.write(self._short_term_memory_file, lambda: json.dumps({"seq": self._short_term_memory_seq, "messages": [{"role": conv.role, "content": conv.content} for conv in self.short_term_memory]}, ensure_ascii=False, indent=4))
 
-    def _build_memory_graph(self):
-        self.ap.logger.info("开始构建记忆图谱")
-        for summary, tags in self._long_term_memory:
-            mem = MemoryItem(summary, tags)
-            self._memory_graph.add_memory(mem)
+    async def _build_memory_graph(self):
+        """
+        优先沿用已构建的图或磁盘快照，只补充其后新增的记忆；记忆标签有变化时才完整重建
+        """
+        if self._memory_graph.memory_count() == 0 and await self._memory_graph.load(self._memory_graph_file):
+            self.ap.logger.info(f"已载入记忆图谱快照，包含{self._memory_graph.memory_count()}条记忆")
+        if not self._is_memory_graph_valid():
+            self.ap.logger.info("记忆图谱与长期记忆不一致，重新构建")
+            self._memory_graph.clear()
+
+        start = self._memory_graph.memory_count()
+        if start == len(self._long_term_memory):
+            return
+        self.ap.logger.info(f"开始构建记忆图谱，新增{len(self._long_term_memory) - start}条记忆")
+        self._memory_graph.add_memories(self._long_term_memory.item(i) for i in range(start, len(self._long_term_memory)))
         self._memory_graph.print_graph()
+        self._memory_graph.save(self._memory_graph_file)
+
+    def _is_memory_graph_valid(self) -> bool:
+        """
+        图中已有的记忆必须与长期记忆的前若干条逐条一致（截断、填充标签后摘要会变化）
+        """
+        count = self._memory_graph.memory_count()
+        if count > len(self._long_term_memory):
+            return False
+        digest = b""
+        for i in range(count):
+            digest = MemoryGraph.chain_digest(digest, self._long_term_memory.item(i).tags())
+        return digest == self._memory_graph.memory_digest()
 
     def _adjust_long_term_memory_tags(self):
         tag_cnt = self._summary_max_tags + self._meta_tag_count
@@ -1537,17 +1621,34 @@ class Memory:
                 tags[i] = tags[i].lower()
         return tags
 
-    def _load_long_term_memory_from_file(self):
+    def _reset_tags_index(self, tags_index: typing.Optional[dict] = None):
+        """
+        原地重写标签表（与长期记忆、关键词提取共用同一字典），并递增版本号
+        """
+        self._tags_index.clear()
+        if tags_index:
+            self._tags_index.update(tags_index)
+        self._tags_index_version += 1
+
+    async def _load_long_term_memory_from_file(self):
+        if SqliteStorage.enabled():
+            rows = await SqliteStorage.load_long_term_memory(self._launcher_id)
+            # 标签编号在载入时按出现顺序重新生成
+            self._reset_tags_index()
+            self._long_term_memory.load((summary, self._trim_for_tags(tags)) for summary, tags in rows)
+            return
+
         try:
+            await Persistence.flush_file(self._long_term_memory_file)
             with open(self._long_term_memory_file, "r", encoding="utf-8") as file:
                 file_content = file.read()
-                if not file_content.strip():
-                    self.ap.logger.warning(f"Memory file '{self._long_term_memory_file}' is empty. Starting with empty memory.")
-                    return
-
+            if not file_content.strip():
+                self.ap.logger.warning(f"Memory file '{self._long_term_memory_file}' is empty. Starting with empty memory.")
+            else:
                 data = json.loads(file_content)
-                self._long_term_memory = [(item["summary"], self._trim_for_tags(item["tags"])) for item in data["long_term"]]
-                self._tags_index = data["tags_index"]
+                # 元标签解析及标签编号化在载入时一次完成
+                self._reset_tags_index(data["tags_index"])
+                self._long_term_memory.load((item["summary"], self._trim_for_tags(item["tags"])) for item in data["long_term"])
         except FileNotFoundError:
             self.ap.logger.warning(f"Memory file '{self._long_term_memory_file}' not found. Starting with empty memory.")
         except json.JSONDecodeError as e:
@@ -1555,14 +1656,45 @@ class Memory:
         except Exception as e:
             self.ap.logger.error(f"Unexpected error loading memory file '{self._long_term_memory_file}': {e}")
 
-    def _load_short_term_memory_from_file(self):
+        await self._replay_long_term_memory_journal()
+
+    async def _replay_long_term_memory_journal(self):
+        """
+        在快照之后重放日志中的新记忆；序号小于快照条数的记录说明合并后日志未及清空，直接跳过
+        """
+        try:
+            records = await self._long_term_memory_journal.read()
+        except Exception as e:
+            self.ap.logger.error(f"Unexpected error loading memory journal '{self._long_term_memory_journal.file()}': {e}")
+            return
+
+        replayed = 0
+        for record in records:
+            if record.get("seq", len(self._long_term_memory)) < len(self._long_term_memory):
+                continue
+            self._long_term_memory.append(record["summary"], self._trim_for_tags(record["tags"]))
+            replayed += 1
+        if replayed > 0:
+            self.ap.logger.info(f"从记忆日志恢复{replayed}条记忆")
+
+    async def _load_short_term_memory_from_file(self):
+        if SqliteStorage.enabled():
+            rows = await SqliteStorage.load_short_term_memory(self._launcher_id)
+            self.short_term_memory = [llm_entities.Message(role=role, content=content) for role, content in rows]
+            return
+
         try:
+            await Persistence.flush_file(self._short_term_memory_file)
             with open(self._short_term_memory_file, "r", encoding="utf-8") as file:
                 file_content = file.read()
-                if not file_content.strip():
-                    self.ap.logger.warning(f"Cache file '{self._short_term_memory_file}' is empty. Starting with empty memory.")
-                    return
+            if not file_content.strip():
+                self.ap.logger.warning(f"Cache file '{self._short_term_memory_file}' is empty. Starting with empty memory.")
+            else:
                 data = json.loads(file_content)
+                # 兼容旧版本直接保存的消息列表
+                if isinstance(data, dict):
+                    self._short_term_memory_seq = data.get("seq", 0)
+                    data = data["messages"]
                 self.short_term_memory = [llm_entities.Message(role=item["role"], content=item["content"]) for item in data]
         except FileNotFoundError:
             self.ap.logger.warning(f"Cache file '{self._short_term_memory_file}' not found. Starting with empty memory.")
@@ -1571,6 +1703,34 @@ class Memory:
         except Exception as e:
             self.ap.logger.error(f"Unexpected error loading memory file '{self._short_term_memory_file}': {e}")
 
+        await self._replay_short_term_memory_journal()
+
+    async def _replay_short_term_memory_journal(self):
+        """
+        在检查点之后重放预写日志，序号不大于检查点的记录已包含在检查点中
+        """
+        try:
+            records = await self._short_term_memory_journal.read()
+        except Exception as e:
+            self.ap.logger.error(f"Unexpected error loading memory journal '{self._short_term_memory_journal.file()}': {e}")
+            return
+
+        checkpoint_seq = self._short_term_memory_seq
+        for record in records:
+            seq = record.get("seq", 0)
+            if seq <= checkpoint_seq:
+                continue
+            op = record.get("op")
+            if op == "append":
+                self.short_term_memory.append(llm_entities.Message(role=record["role"], content=record["content"]))
+            elif op == "pop":
+                if self.short_term_memory:
+                    self.short_term_memory.pop()
+            elif op == "keep":
+                count = record["count"]
+                self.short_term_memory = self.short_term_memory[len(self.short_term_memory) - count:] if count < len(self.short_term_memory) else self.short_term_memory
+            self._short_term_memory_seq = max(self._short_term_memory_seq, seq)
+
     def get_conversations_str_for_person(self, conversations: typing.List[llm_entities.Message]) -> typing.Tuple[typing.List[str], str]:
         speakers = []
         conversations_str = ""
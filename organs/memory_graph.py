@@ -1,14 +1,22 @@
 from plugins.Waifu.organs.memory_item import MemoryItem
-import networkx as nx
+from plugins.Waifu.organs.cooccurrence_graph import CooccurrenceGraph
+from plugins.Waifu.organs.lru_cache import LRUCache
+from plugins.Waifu.cells.persistence import Persistence
+import hashlib
 import heapq
+import json
+import typing
+from collections import Counter
 from itertools import combinations
 import math
 from pkg.core import app
 import numpy as np
 
+SNAPSHOT_MAGIC = b"WAIFU-MEMORY-GRAPH-1\n"
+
 class MemoryGraph:
 
-    _graph:nx.Graph
+    _graph:CooccurrenceGraph
     _base_decay:float
     _noise_threshold:float
     _max_edges_per_node:int
@@ -16,10 +24,16 @@ class MemoryGraph:
     _need_update_noise:bool
     _add_cnt:int
     _add_cnt_limit:int
+    _weights_version:int
+    _memory_cnt:int
+    _memory_digest:bytes
+    _version:int
+    _neighbor_cache:typing.Dict[str, typing.List[typing.Tuple[str, float]]]
+    _related_cache:LRUCache
 
     def __init__(self,app:app.Application):
-        # 使用NetworkX图表示记忆连接
-        self._graph = nx.Graph()
+        # 使用紧凑的共现图表示记忆连接
+        self._graph = CooccurrenceGraph()
         self._base_decay = 0.6
         self._noise_threshold = 0.2
         self._max_edges_per_node = 30
@@ -27,22 +41,41 @@ class MemoryGraph:
         self._need_update_noise = True
         self._add_cnt = 0
         self._add_cnt_limit = 1000
+        self._weights_version = -1
+        self._memory_cnt = 0 # 已加入图中的记忆条数
+        self._memory_digest = b"" # 已加入记忆标签的链式摘要，用于校验快照
+        self._version = 0 # 图或噪声阈值每次变化加一
+        self._neighbor_cache = {}
+        self._related_cache = LRUCache(256)
 
     def add_memory(self, memory: MemoryItem):
-        tags = set(memory.tags())
-        # 添加节点（关键词）
-        current_node = self._graph.number_of_nodes()
-        self._graph.add_nodes_from(tags)
-        after_node = self._graph.number_of_nodes()
-
-        # 更新所有标签对之间的边
-        self._update_edges(tags)
+        self.add_memories([memory])
 
-        # 每一千个节点，进行一次裁剪
-        self._add_cnt += after_node - current_node
-        if self._add_cnt >= self._add_cnt_limit:
-            self._prune_graph()
-            self._add_cnt = 0
+    def add_memories(self, memories: typing.Iterable[MemoryItem]):
+        """
+        批量加入记忆：一次遍历统计标签对的共现次数，统一建边
+        节点和边按标签首次出现的顺序创建，与集合的哈希顺序无关；
+        裁剪点只取决于记忆的先后顺序，因此无论分几批加入，得到的图都完全相同
+        """
+        pair_counts: typing.Counter[typing.Tuple[int, int]] = Counter()
+        for memory in memories:
+            self._memory_cnt += 1
+            self._memory_digest = self.chain_digest(self._memory_digest, memory.tags())
+            # 添加节点（关键词）
+            current_node = self._graph.number_of_nodes()
+            nodes = [self._graph.add_node(tag) for tag in dict.fromkeys(memory.tags())]
+            pair_counts.update((i, j) if i < j else (j, i) for i, j in combinations(nodes, 2))
+
+            # 每新增一千个节点，先建边再进行一次裁剪
+            self._add_cnt += self._graph.number_of_nodes() - current_node
+            if self._add_cnt >= self._add_cnt_limit:
+                self._update_edges(pair_counts)
+                pair_counts = Counter()
+                self._prune_graph()
+                self._add_cnt = 0
+
+        # 更新其余标签对之间的边
+        self._update_edges(pair_counts)
 
     def get_avg_degree(self) -> float:
         """
@@ -50,7 +83,7 @@ class MemoryGraph:
         """
         if self._graph.number_of_nodes() == 0:
             return 0.0
-        return sum(dict(self._graph.degree()).values()) / self._graph.number_of_nodes()
+        return self._graph.degree_sum() / self._graph.number_of_nodes()
 
     def get_avg_degree_of_tags(self, tags: set[str]) -> float:
         """
@@ -59,9 +92,10 @@ class MemoryGraph:
         node_cnt = 0
         degree_sum = 0.0
         for tag in tags:
-            if self._graph.has_node(tag):
+            node = self._graph.node_id(tag)
+            if node is not None:
                 node_cnt += 1
-                degree_sum += self._graph.degree(tag)
+                degree_sum += self._graph.degree(node)
         if node_cnt == 0:
             return 0.0
         return degree_sum/ node_cnt
@@ -78,6 +112,7 @@ class MemoryGraph:
         动态调整噪声阈值，根据图的当前状态
         """
 
+        self._refresh_weights()
         if not self._need_update_noise:
             return
         self._need_update_noise = False
@@ -89,7 +124,7 @@ class MemoryGraph:
         self._adjust_max_edges_per_node()
 
         # 计算全图权重分布
-        weights = [data['weight'] for _, _, data in self._graph.edges(data=True)]
+        weights = self._graph.weights()
         if not weights:
             return
 
@@ -100,27 +135,31 @@ class MemoryGraph:
         # 动态调整阈值范围
         max_threshold = 0.4 + 0.1 * math.log2(avg_degree)
         self._noise_threshold = max(0.1, min(max_threshold, lower_quartile))
+        self._invalidate_cache()
         self._app.logger.info(f"动态噪声阈值已更新为: {self._noise_threshold:.4f}")
 
     def _remove_isolated_nodes(self):
         """
         移除孤立节点
         """
-        isolated_nodes = [node for node, degree in self._graph.degree() if degree == 0]
-        self._graph.remove_nodes_from(isolated_nodes)
+        isolated_nodes = [node for node in self._graph.nodes() if self._graph.degree(node) == 0]
+        for node in isolated_nodes:
+            self._graph.remove_node(node)
 
     def _limit_node_edges(self):
         """
         限制每个节点的最大边数
         """
         self._adjust_max_edges_per_node()
+        # 阈值裁剪改变了度数，按裁剪后的图重算权重
+        self._refresh_weights()
         for node in self._graph.nodes():
-            edges = list(self._graph.edges(node, data=True))
+            edges = list(self._graph.neighbors(node).values())
             if len(edges) > self._max_edges_per_node:
                 # 按权重排序，保留权重最高的边
-                edges = sorted(edges, key=lambda x: -x[2]['weight'])
+                edges = sorted(edges, key=lambda edge: -self._graph.weight(edge))
                 for edge in edges[self._max_edges_per_node:]:
-                    self._graph.remove_edge(edge[0], edge[1])
+                    self._graph.remove_edge(edge)
 
     def _adjust_max_edges_per_node(self):
         """
@@ -140,88 +179,125 @@ class MemoryGraph:
         """
         self._update_noise_threshold()
 
-        for u, v, data in list(self._graph.edges(data=True)):
-            if data['weight'] < self._noise_threshold:
-                self._graph.remove_edge(u, v)
+        for edge in self._graph.edges():
+            if self._graph.weight(edge) < self._noise_threshold:
+                self._graph.remove_edge(edge)
 
         self._limit_node_edges()
 
         self._remove_isolated_nodes()
 
+        self._graph.compact()
+
         self._need_update_noise = True
 
+        self._invalidate_cache()
+
         self.print_graph()
 
-    def _update_edges(self, keywords: set[str]):
+    def _update_edges(self, pair_counts: typing.Counter[typing.Tuple[int, int]]):
+        """
+        按统计好的标签对共现次数更新边，标签对按首次出现的顺序建边
+        PMI权重依赖全局边数和节点度数，新增边后所有权重都会变化，统一在读取前由 _refresh_weights 重算
         """
-        更新图的边权重并稀疏化，优化算法：
+        for (i, j), count in pair_counts.items():
+            self._graph.add_cooccurrence(i, j, count)
+        self._invalidate_cache()
+
+    def _refresh_weights(self):
+        """
+        图结构变化后，用numpy一次性重算全部边权重，优化算法：
         1. 基于PMI的权重计算：更准确地衡量关联性
         2. 引入全局归一化：平衡整体权重分布
         3. 动态平滑：防止低频节点权重过高
         """
-        edges_to_update = []
+        if self._weights_version == self._graph.version():
+            return
+        self._weights_version = self._graph.version()
+        self._need_update_noise = True
 
-        # 统计共现次数
-        for i, j in combinations(keywords, 2):
-            if self._graph.has_edge(i, j):
-                self._graph[i][j]['cooccurrence'] += 1
-            else:
-                self._graph.add_edge(i, j, cooccurrence=1)
-            edges_to_update.append((i, j))
+        edges, nodes_i, nodes_j, cooccurrence = self._graph.edge_arrays()
+        if len(edges) == 0:
+            return
 
         # 改进的PMI权重计算
-        total_edges = max(1, self._graph.number_of_edges())
-        for i, j in edges_to_update:
-            degree_i = max(1, self._graph.degree[i])  # 避免除零
-            degree_j = max(1, self._graph.degree[j])
-            cooccurrence = self._graph[i][j]['cooccurrence']
+        total_edges = len(edges)
+        degrees = self._graph.degree_array()
+        degree_i = np.maximum(1, degrees[nodes_i])  # 避免除零
+        degree_j = np.maximum(1, degrees[nodes_j])
 
-            # PMI计算：log(P(x,y) / (P(x) * P(y)))
-            pmi = math.log2((cooccurrence * total_edges) / (degree_i * degree_j))
+        # PMI计算：log(P(x,y) / (P(x) * P(y)))
+        pmi = np.log2((cooccurrence * total_edges) / (degree_i * degree_j))
 
-            # 添加平滑和归一化
-            smoothing = 0.2  # 平滑因子，防止极值
-            norm_factor = math.log2(total_edges) + smoothing
+        # 添加平滑和归一化
+        smoothing = 0.2  # 平滑因子，防止极值
+        norm_factor = math.log2(total_edges) + smoothing
 
-            # 权重计算综合考虑PMI和共现频率
-            freq_factor = math.log2(1 + cooccurrence) / math.log2(total_edges)
-            pmi_factor = (pmi + smoothing) / norm_factor
+        # 权重计算综合考虑PMI和共现频率（只有一条边时log2为0，避免除零）
+        freq_factor = np.log2(1 + cooccurrence) / max(1.0, math.log2(total_edges))
+        pmi_factor = (pmi + smoothing) / norm_factor
 
-            # 混合权重，可以调整alpha来控制PMI和频率的影响
-            alpha = 0.7  # PMI权重占比
-            weight = alpha * pmi_factor + (1-alpha) * freq_factor
+        # 混合权重，可以调整alpha来控制PMI和频率的影响
+        alpha = 0.7  # PMI权重占比
+        weights = alpha * pmi_factor + (1-alpha) * freq_factor
 
-            # 确保权重在合理范围内
-            weight = max(0.01, min(1.0, weight))
-            self._graph[i][j]['weight'] = weight
-
-        self._need_update_noise = True
+        # 确保权重在合理范围内
+        self._graph.set_weights(edges, np.clip(weights, 0.01, 1.0))
 
     def _get_valid_neighbors(self,keyword:str) -> list[str]:
         """
         获取与关键词相关的有效边
         """
-        if not self._graph.has_node(keyword):
+        return [neighbor for neighbor, _ in self._get_weighted_neighbors(keyword)]
+
+    def _get_weighted_neighbors(self, keyword: str) -> typing.List[typing.Tuple[str, float]]:
+        """
+        获取按权重降序排列、已过滤噪声的邻居及边权重，结果缓存到图下次变化为止
+        """
+        cached = self._neighbor_cache.get(keyword)
+        if cached is not None:
+            return cached
+        node = self._graph.node_id(keyword)
+        if node is None:
             return []
-        edges = self._graph.edges(keyword, data=True)
-        sorted_edges = sorted(edges, key=lambda x: -x[2]['weight'])[:self._max_edges_per_node]
+        self._refresh_weights()
+        edges = [(neighbor, self._graph.weight(edge)) for neighbor, edge in self._graph.neighbors(node).items()]
+        sorted_edges = sorted(edges, key=lambda x: -x[1])[:self._max_edges_per_node]
         # 过滤掉权重小于阈值的边
-        sorted_edges = [edge for edge in sorted_edges if edge[2]['weight'] > self._noise_threshold]
-        return [edge[1] for edge in sorted_edges]
+        neighbors = [(self._graph.node_name(neighbor), weight) for neighbor, weight in sorted_edges if weight > self._noise_threshold]
+        self._neighbor_cache[keyword] = neighbors
+        return neighbors
+
+    def _invalidate_cache(self):
+        """
+        图结构或噪声阈值变化后，邻居缓存失效，联想结果缓存随版本号失效
+        """
+        self._version += 1
+        self._neighbor_cache.clear()
 
     def get_connection_strength(self, key1, key2) -> float:
         """
         获取两个关键词之间的连接强度。
         """
-        if self._graph.has_edge(key1, key2):
-            return self._graph[key1][key2]['weight']
+        self._refresh_weights()
+        edge = self._get_edge(key1, key2)
+        if edge is not None:
+            return self._graph.weight(edge)
         return 0
 
     def get_connection_cooccurrence(self, key1, key2) -> float:
-        if self._graph.has_edge(key1, key2):
-            return self._graph[key1][key2]['cooccurrence']
+        edge = self._get_edge(key1, key2)
+        if edge is not None:
+            return self._graph.cooccurrence(edge)
         return 0
 
+    def _get_edge(self, key1, key2) -> typing.Optional[int]:
+        u = self._graph.node_id(key1)
+        v = self._graph.node_id(key2)
+        if u is None or v is None:
+            return None
+        return self._graph.edge_id(u, v)
+
     def get_related_keywords(self, keywords: set[str]) -> list[str]:
         """
         基于海马体特性的记忆扩散算法
@@ -252,21 +328,27 @@ class MemoryGraph:
         final_threshold = max(0.05, min(0.5, self._noise_threshold + adjustment))
 
         self._app.logger.info(f"当前全局噪声阈值：{self._noise_threshold:.4f} 当前联想噪声阈值：{final_threshold:.4f}")
-        self._app.logger.info(f"联想有效关键词：{valid_keywords}")
+        self._app.logger.debug(f"联想有效关键词：{valid_keywords}")
+
+        cache_key = (self._version, frozenset(valid_keywords))
+        cached = self._related_cache.get(cache_key)
+        if cached is not None:
+            self._app.logger.debug(f"联想结果命中缓存：{valid_keywords}")
+            return list(cached)
 
-        # 初始化优先队列和强度记录
+        # 初始化优先队列和强度记录，最后一项为到达该节点所经过边的权重
         need_search = []
         for k in valid_keywords:
-            heapq.heappush(need_search, (-1.0, k, 0,k))
+            heapq.heappush(need_search, (-1.0, k, 0, k, 1.0))
 
-        self._app.logger.info(f"初始优先队列大小：{len(need_search)}")
+        self._app.logger.debug(f"初始优先队列大小：{len(need_search)}")
 
         related:dict[str,float] = {}
         # 充当accessed_nodes
         max_strength = {}
 
         while len(need_search) > 0:
-            neg_strength, curr, depth,from_node = heapq.heappop(need_search)
+            neg_strength, curr, depth, from_node, from_weight = heapq.heappop(need_search)
 
             curr_strength = -neg_strength
 
@@ -278,17 +360,15 @@ class MemoryGraph:
 
             max_strength[curr] = curr_strength
 
-            self._app.logger.info(f"当前关键词：{curr}，强度：{curr_strength:.4f}")
+            self._app.logger.debug(f"当前关键词：{curr}，强度：{curr_strength:.4f}")
 
             related[curr] = curr_strength
 
             # 动态衰减计算（神经可塑性补偿）
-            neighbors = self._get_valid_neighbors(curr)
-            avg_weight = sum(self.get_connection_strength(curr, n) for n in neighbors) / max(1, len(neighbors))
-
-            for neighbor in neighbors:
-                edge_weight = self.get_connection_strength(curr, neighbor)
+            neighbors = self._get_weighted_neighbors(curr)
+            avg_weight = sum(weight for _, weight in neighbors) / max(1, len(neighbors))
 
+            for neighbor, edge_weight in neighbors:
                 # 改进的动态衰减：高权重边减缓衰减
                 weight_ratio = edge_weight / max(0.01, avg_weight)
                 dynamic_decay = self._base_decay + 0.2 * min(1.0, weight_ratio)
@@ -297,7 +377,7 @@ class MemoryGraph:
                 # 路径质量评估：考虑整条路径而非仅当前边
                 path_quality = 1.0
                 if depth > 0:
-                    path_quality = min(1.0, edge_weight / self.get_connection_strength(from_node, curr))
+                    path_quality = min(1.0, edge_weight / from_weight)
 
                 # 结合路径质量的衰减计算
                 adjusted_decay = dynamic_decay * (0.8 + 0.2 * path_quality)
@@ -306,7 +386,7 @@ class MemoryGraph:
 
                 # 过滤噪音
                 if new_strength > 0:
-                    heapq.heappush(need_search, (-new_strength, neighbor, depth + 1,curr))
+                    heapq.heappush(need_search, (-new_strength, neighbor, depth + 1, curr, edge_weight))
 
 
         # 前额叶皮层归一化处理
@@ -314,21 +394,117 @@ class MemoryGraph:
         normalized = {k: v/max_value for k, v in related.items()}
         sorted_related = sorted(normalized.items(), key=lambda x: -x[1])
 
-        for k,w in sorted_related[:20]:
-            self._app.logger.info(f"扩散关键词：{k}，强度：{w:.4f}")
+        self._app.logger.info("扩散关键词：" + "，".join(f"{k}({w:.4f})" for k, w in sorted_related[:20]))
 
         # 排除输入标签并返回
-        return [k for k, v in sorted_related
+        result = [k for k, v in sorted_related
                 if k not in valid_keywords]
+        self._related_cache.put(cache_key, result)
+        return list(result)
 
     def get_all_keywords(self):
         """
         获取图中的所有关键词。
         """
-        return set(self._graph.nodes())
+        return set(self._graph.names())
 
     def clear(self):
         """
         清除图中的所有数据。
         """
         self._graph.clear()
+        self._noise_threshold = 0.2
+        self._max_edges_per_node = 30
+        self._need_update_noise = True
+        self._add_cnt = 0
+        self._memory_cnt = 0
+        self._memory_digest = b""
+        self._invalidate_cache()
+
+    @staticmethod
+    def chain_digest(digest: bytes, tags: typing.List[str]) -> bytes:
+        """
+        在前序摘要之后追加一条记忆的标签，得到新的摘要
+        """
+        return hashlib.sha1(digest + "\0".join(tags).encode("utf-8")).digest()
+
+    def memory_count(self) -> int:
+        return self._memory_cnt
+
+    def memory_digest(self) -> bytes:
+        return self._memory_digest
+
+    def save(self, file: str):
+        """
+        写入二进制快照：魔数、JSON头、以NUL分隔的节点名称、边的端点及共现次数数组
+        权重由图结构决定，载入后重新计算
+        """
+        Persistence.write(file, self._to_bytes)
+
+    def _to_bytes(self) -> bytes:
+        names, edge_u, edge_v, cooccurrences = self._graph.to_arrays()
+        name_bytes = "\0".join(names).encode("utf-8")
+        header = {
+            "memory_cnt": self._memory_cnt,
+            "memory_digest": self._memory_digest.hex(),
+            "add_cnt": self._add_cnt,
+            "noise_threshold": self._noise_threshold,
+            "max_edges_per_node": self._max_edges_per_node,
+            "need_update_noise": self._need_update_noise,
+            "node_cnt": len(names),
+            "edge_cnt": len(edge_u),
+            "names_size": len(name_bytes),
+        }
+        return b"".join([
+            SNAPSHOT_MAGIC,
+            json.dumps(header).encode("utf-8") + b"\n",
+            name_bytes,
+            edge_u.astype("<i4").tobytes(),
+            edge_v.astype("<i4").tobytes(),
+            cooccurrences.astype("<i8").tobytes(),
+        ])
+
+    async def load(self, file: str) -> bool:
+        """
+        读取二进制快照，失败时图保持为空
+        """
+        self.clear()
+        await Persistence.flush_file(file)
+        try:
+            with open(file, "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            return False
+
+        try:
+            if not data.startswith(SNAPSHOT_MAGIC):
+                raise ValueError("bad magic")
+            offset = len(SNAPSHOT_MAGIC)
+            end = data.index(b"\n", offset)
+            header = json.loads(data[offset:end].decode("utf-8"))
+            offset = end + 1
+
+            node_cnt = header["node_cnt"]
+            edge_cnt = header["edge_cnt"]
+            name_bytes = data[offset:offset + header["names_size"]]
+            offset += header["names_size"]
+            names = name_bytes.decode("utf-8").split("\0") if node_cnt > 0 else []
+            if len(names) != node_cnt or len(data) != offset + edge_cnt * 16:
+                raise ValueError("size mismatch")
+            edge_u = np.frombuffer(data, dtype="<i4", count=edge_cnt, offset=offset).astype(np.int64)
+            edge_v = np.frombuffer(data, dtype="<i4", count=edge_cnt, offset=offset + edge_cnt * 4).astype(np.int64)
+            cooccurrences = np.frombuffer(data, dtype="<i8", count=edge_cnt, offset=offset + edge_cnt * 8).astype(np.int64)
+
+            self._graph.load_arrays(names, edge_u, edge_v, cooccurrences)
+            self._memory_cnt = header["memory_cnt"]
+            self._memory_digest = bytes.fromhex(header["memory_digest"])
+            self._add_cnt = header["add_cnt"]
+            self._noise_threshold = header["noise_threshold"]
+            self._max_edges_per_node = header["max_edges_per_node"]
+            self._need_update_noise = header["need_update_noise"]
+            self._invalidate_cache()
+        except Exception as e:
+            self._app.logger.warning(f"Error loading memory graph snapshot '{file}': {e}")
+            self.clear()
+            return False
+        return True
@@ -22,10 +22,14 @@ class MemoryItem:
     def _adjust_tags(self):
         self._tags = [i for i in self._tags if i.count(META_TAG_MARK) == 0]
 
-    def __init__(self, summary: str, tags: typing.List[str]):
+    def __init__(self, summary: str, tags: typing.List[str], created_time: typing.Optional[datetime] = None):
         self._summary = summary
         self._tags = tags
-        self._init_created_time()
+        if created_time is None:
+            self._init_created_time()
+        else:
+            # 已由MemoryStore预先解析
+            self._created_time = created_time
         self._adjust_tags()
 
     def tags(self) -> typing.List[str]:
@@ -0,0 +1,202 @@
+import typing
+import numpy as np
+from datetime import datetime
+from plugins.Waifu.organs.memory_item import MemoryItem, DATETIME_META, META_TAG_MARK
+from plugins.Waifu.organs.tag_matrix import TagMatrix
+from plugins.Waifu.organs.timeline import Timeline
+
+PRIORITY_META = "PRIORITY:"
+BACKOFF_TIMESTAMP = 1745069038
+
+
+class MemoryStore:
+    """
+    长期记忆的列式存储
+    加载或追加时一次性解析元标签（时间、优先级）并将真实标签编号化，召回时不再解析字符串
+    迭代及下标访问仍返回 (summary, tags)，与原先的列表结构保持一致
+    """
+
+    _summaries: typing.List[str]
+    _tags: typing.List[typing.List[str]]
+    _timestamps: typing.List[float]
+    _dated: typing.List[bool]
+    _priorities: typing.List[float]
+    _real_tag_sizes: typing.List[int]
+    _tags_index: dict
+    _tag_matrix: TagMatrix
+    _timeline: Timeline
+    _matrix_dirty: bool
+    _arrays: typing.Optional[typing.Dict[str, np.ndarray]]
+
+    def __init__(self, tags_index: dict):
+        self._tags_index = tags_index
+        self._tag_matrix = TagMatrix()
+        self._timeline = Timeline()
+        self.clear()
+
+    def __len__(self) -> int:
+        return len(self._summaries)
+
+    def __iter__(self) -> typing.Iterator[typing.Tuple[str, typing.List[str]]]:
+        return iter(zip(self._summaries, self._tags))
+
+    def __getitem__(self, index: int) -> typing.Tuple[str, typing.List[str]]:
+        return (self._summaries[index], self._tags[index])
+
+    def __setitem__(self, index: int, memory: typing.Tuple[str, typing.List[str]]):
+        summary, tags = memory
+        self._summaries[index] = summary
+        self._tags[index] = tags
+        timestamp, dated, priority, real_tags = self._parse_tags(tags)
+        if timestamp != self._timestamps[index]:
+            self._timestamps[index] = timestamp
+            self._build_timeline()
+        self._dated[index] = dated
+        self._priorities[index] = priority
+        self._real_tag_sizes[index] = len(set(real_tags))
+        self._index_tags(tags)
+        # 标签变化后稀疏矩阵需要整体重建，延迟到下次召回
+        self._matrix_dirty = True
+        self._arrays = None
+
+    def clear(self):
+        self._summaries = []
+        self._tags = []
+        self._timestamps = []
+        self._dated = []
+        self._priorities = []
+        self._real_tag_sizes = []
+        self._tag_matrix.clear()
+        self._timeline.clear()
+        self._matrix_dirty = False
+        self._arrays = None
+
+    def load(self, memories: typing.Iterable[typing.Tuple[str, typing.List[str]]]):
+        """
+        批量载入记忆，重建所有列
+        """
+        self.clear()
+        for summary, tags in memories:
+            self.append(summary, tags)
+
+    def append(self, summary: str, tags: typing.List[str]):
+        timestamp, dated, priority, real_tags = self._parse_tags(tags)
+        self._summaries.append(summary)
+        self._tags.append(tags)
+        self._timestamps.append(timestamp)
+        self._dated.append(dated)
+        self._priorities.append(priority)
+        self._real_tag_sizes.append(len(set(real_tags)))
+        self._timeline.add(timestamp, len(self._summaries) - 1)
+        self._index_tags(tags)
+        if not self._matrix_dirty:
+            self._tag_matrix.append_row(self._get_tag_ids(real_tags))
+        self._arrays = None
+
+    def _parse_tags(self, tags: typing.List[str]) -> typing.Tuple[float, bool, float, typing.List[str]]:
+        """
+        解析元标签，返回 (时间戳, 是否带时间标签, 优先级, 真实标签)
+        真实标签仅去除第一个时间标签与第一个优先级标签，与 Memory._get_real_tags 一致
+        """
+        real_tags = tags.copy()
+        timestamp = float(BACKOFF_TIMESTAMP)
+        dated = False
+        priority = 0.0
+        for i in range(len(real_tags)):
+            if real_tags[i].startswith(DATETIME_META):
+                try:
+                    timestamp = datetime.strptime(real_tags[i].replace(DATETIME_META, ""), "%Y-%m-%d %H:%M:%S").timestamp()
+                    dated = True
+                except ValueError:
+                    pass
+                real_tags.pop(i)
+                break
+        for i in range(len(real_tags)):
+            if real_tags[i].startswith(PRIORITY_META):
+                try:
+                    priority = float(real_tags[i].replace(PRIORITY_META, ""))
+                except ValueError:
+                    pass
+                real_tags.pop(i)
+                break
+        return timestamp, dated, priority, real_tags
+
+    def _index_tags(self, tags: typing.List[str]):
+        for tag in tags:
+            if tag not in self._tags_index:
+                if tag.count(META_TAG_MARK) == 0:
+                    self._tags_index[tag] = len(self._tags_index)
+
+    def _get_tag_ids(self, real_tags: typing.List[str]) -> typing.List[int]:
+        return [self._tags_index[tag] for tag in real_tags if tag in self._tags_index]
+
+    def _get_tag_matrix(self) -> TagMatrix:
+        if self._matrix_dirty:
+            self._tag_matrix.clear()
+            for tags in self._tags:
+                self._tag_matrix.append_row(self._get_tag_ids(self._parse_tags(tags)[3]))
+            self._matrix_dirty = False
+        return self._tag_matrix
+
+    def _build_timeline(self):
+        self._timeline.clear()
+        for i, timestamp in enumerate(self._timestamps):
+            self._timeline.add(timestamp, i)
+
+    def candidates(self, input_tags: typing.List[str]) -> np.ndarray:
+        """
+        通过倒排索引取出与输入标签至少有一个交集的记忆编号（升序）
+        """
+        input_ids = {self._tags_index[tag] for tag in input_tags if tag in self._tags_index}
+        return self._get_tag_matrix().candidates(input_ids)
+
+    def document_frequency(self, tag: str) -> int:
+        """
+        包含该真实标签的记忆条数
+        """
+        if tag not in self._tags_index:
+            return 0
+        return self._get_tag_matrix().document_frequency(self._tags_index[tag])
+
+    def window(self, start_timestamp: typing.Optional[float], end_timestamp: typing.Optional[float]) -> np.ndarray:
+        """
+        时间戳位于 [start_timestamp, end_timestamp] 的记忆编号（升序），None表示不限
+        """
+        return self._timeline.between(start_timestamp, end_timestamp)
+
+    def columns(self) -> typing.Dict[str, np.ndarray]:
+        """
+        numpy 列视图：timestamp 时间戳、priority 优先级、real_tag_size 去重后的真实标签数、tag_count 标签总数
+        """
+        if self._arrays is None:
+            self._arrays = {
+                "timestamp": np.asarray(self._timestamps, dtype=np.float64),
+                "priority": np.asarray(self._priorities, dtype=np.float64),
+                "real_tag_size": np.asarray(self._real_tag_sizes, dtype=np.float64),
+                "tag_count": np.asarray([len(tags) for tags in self._tags], dtype=np.int64),
+            }
+        return self._arrays
+
+    def similarity(self, input_tags: typing.List[str], ids: typing.Optional[np.ndarray] = None) -> typing.Tuple[np.ndarray, np.ndarray]:
+        """
+        一次稀疏乘法得到长期记忆的余弦相似度及命中数，指定ids时只计算这些记忆
+        """
+        input_ids = {self._tags_index[tag] for tag in input_tags if tag in self._tags_index}
+        return self._get_tag_matrix().similarity(input_ids, ids)
+
+    def summary(self, index: int) -> str:
+        return self._summaries[index]
+
+    def tags(self, index: int) -> typing.List[str]:
+        return self._tags[index]
+
+    def time(self, index: int) -> typing.Optional[datetime]:
+        """
+        记忆的创建时间，没有时间标签时返回None
+        """
+        if not self._dated[index]:
+            return None
+        return datetime.fromtimestamp(self._timestamps[index])
+
+    def item(self, index: int) -> MemoryItem:
+        return MemoryItem(self._summaries[index], self._tags[index], datetime.fromtimestamp(self._timestamps[index]))
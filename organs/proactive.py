@@ -10,16 +10,21 @@ from pkg.core import app
 from pkg.platform.sources.aiocqhttp import AiocqhttpAdapter
 from pkg.platform.types import message as platform_message
 from plugins.Waifu.cells.generator import Generator
+from plugins.Waifu.cells.llm_scheduler import LLMScheduler
 from plugins.Waifu.cells.config import ConfigManager
+from plugins.Waifu.cells.journal import Journal
+from plugins.Waifu.cells.persistence import Persistence
+from plugins.Waifu.cells.storage import SqliteStorage
 from plugins.Waifu.organs.memories import Memory
 
 
 class ProactiveGreeter:
     ap: app.Application
 
-    def __init__(self, ap: app.Application, launcher_id: str):
+    def __init__(self, ap: app.Application, launcher_id: str, lock: typing.Optional[asyncio.Lock] = None):
         self.ap = ap
-        self._generator = Generator(ap)
+        self._generator = Generator(ap, LLMScheduler.BACKGROUND)
+        self._lock = lock if lock is not None else asyncio.Lock()  # 与该会话的回复共用，避免同时修改记忆
 
         self._main_task: typing.Optional[asyncio.Task] = None   #loop状态
         self._first_adapter: typing.Optional[AiocqhttpAdapter] = None
@@ -159,7 +164,8 @@ class ProactiveGreeter:
         try:
             adapter_instance = self._first_adapter  # 获取适配器
             if adapter_instance:
-                message_to_send_str = await self.proactive_greeting()  # 返回message
+                async with self._lock:
+                    message_to_send_str = await self.proactive_greeting()  # 返回message
                 self.ap.logger.info(f"wait to send{self._proactive_target_user_id}\n")
                 await adapter_instance.send_message(
                     target_type="person",
@@ -178,17 +184,23 @@ class ProactiveGreeter:
         folder_path = f"data/plugins/Waifu/data/"
         filename = f"card_summary_{self._launcher_id}_{self._proactive_target_user_id}.txt"
         full_path = os.path.join(folder_path, filename)
-        summary_text, tags_list = self._get_tag_summary()  # 获取tag和summary
+        summary_text, tags_list = await self._get_tag_summary()  # 获取tag和summary
         if summary_text is None:
             summary_text = ""   #避免为空
-        file_exists = await loop.run_in_executor(None, os.path.exists, full_path)
-        if file_exists:
-            card_summary_text = await loop.run_in_executor(
-                None,
-                self.read_text_from_file_sync,
-                full_path
-            )
+        card_summary_text = None
+        if SqliteStorage.enabled():
+            card_summary_text = await SqliteStorage.load_card_summary(self._launcher_id, self._proactive_target_user_id)
+            file_exists = card_summary_text is not None
         else:
+            await Persistence.flush_file(full_path)
+            file_exists = await loop.run_in_executor(None, os.path.exists, full_path)
+            if file_exists:
+                card_summary_text = await loop.run_in_executor(
+                    None,
+                    self.read_text_from_file_sync,
+                    full_path
+                )
+        if not file_exists:
             raw_prompt = self._cards.generate_system_prompt()  # 获取角色卡
             full_card_prompt_text = self._memory.to_custom_names(raw_prompt)
             system_prompt_for_summarizing_card = (
@@ -204,12 +216,10 @@ class ProactiveGreeter:
                         request=full_card_prompt_text,
                         system_prompt=system_prompt_for_summarizing_card  # 指示LLM进行总结的系统提示
                     )
-                    await loop.run_in_executor(
-                        None,
-                        self.write_text_to_file_sync,
-                        full_path,
-                        card_summary_text
-                    )
+                    if SqliteStorage.enabled():
+                        SqliteStorage.save_card_summary(self._launcher_id, self._proactive_target_user_id, card_summary_text)
+                    else:
+                        Persistence.write(full_path, card_summary_text)
                 except Exception as e:
                     self.ap.logger.error(f"ERROR during LLM call for card summary: {e}")
             else:
@@ -241,11 +251,21 @@ class ProactiveGreeter:
         await self._memory.save_memory(role="assistant", content=response)  # 主动发言存入到历史记忆当中
         return response  # 返回LLM 回应
 
-    def _get_tag_summary(self):
+    async def _get_tag_summary(self):
         try:
             fixed_file_path = f"data/plugins/Waifu/data/memories_{self._proactive_target_user_id}.json"
-            with open(fixed_file_path, "r", encoding="utf-8") as file:
-                data = json.load(file)  # 解析整个JSON数据
+            if SqliteStorage.enabled():
+                latest_entry = await SqliteStorage.get_latest_long_term_memory(self._proactive_target_user_id)
+                data = {"long_term": [latest_entry] if latest_entry else []}
+            else:
+                # 最新的记忆可能还在日志中尚未合并进快照
+                journal_records = await Journal(self.ap, f"data/plugins/Waifu/data/memories_{self._proactive_target_user_id}.jsonl").read()
+                if journal_records:
+                    data = {"long_term": journal_records}
+                else:
+                    await Persistence.flush_file(fixed_file_path)
+                    with open(fixed_file_path, "r", encoding="utf-8") as file:
+                        data = json.load(file)  # 解析整个JSON数据
             if "long_term" in data and isinstance(data["long_term"], list) and data["long_term"]:
                 latest_entry = data["long_term"][-1]  # 获取列表的最后一个元素
                 if isinstance(latest_entry, dict) and "summary" in latest_entry and "tags" in latest_entry:
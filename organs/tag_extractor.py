@@ -0,0 +1,64 @@
+import asyncio
+import typing
+from pkg.core import app
+from plugins.Waifu.organs.lru_cache import LRUCache
+
+
+class TagExtractor:
+    """
+    异步标签提取服务
+    - 以对话窗口文本为单位提取并缓存标签，相同文本的并发请求合并为同一次提取
+    - prefetch 在决定回复时提前启动提取，与回复等待时间重叠
+    """
+
+    ap: app.Application
+    _extract: typing.Callable[[str], typing.Awaitable[typing.List[str]]]
+    _cache: LRUCache
+    _pending: typing.Dict[str, asyncio.Task]
+
+    def __init__(self, ap: app.Application, extract: typing.Callable[[str], typing.Awaitable[typing.List[str]]], cache: LRUCache):
+        self.ap = ap
+        self._extract = extract
+        self._cache = cache
+        self._pending = {}
+
+    def set_cache(self, cache: LRUCache):
+        self._cache = cache
+
+    def prefetch(self, text: str):
+        """
+        在后台开始提取，不等待结果
+        """
+        if not text or self._cache.get(text) is not None:
+            return
+        self._get_task(text)
+
+    async def extract(self, text: str) -> typing.List[str]:
+        if not text:
+            return []
+        tags = self._cache.get(text)
+        if tags is not None:
+            return tags
+        # 等待方被取消时不影响其他等待同一结果的请求
+        return await asyncio.shield(self._get_task(text))
+
+    def _get_task(self, text: str) -> asyncio.Task:
+        task = self._pending.get(text)
+        if task is None:
+            task = asyncio.create_task(self._run(text))
+            self._pending[text] = task
+            task.add_done_callback(self._on_done)
+        return task
+
+    async def _run(self, text: str) -> typing.List[str]:
+        try:
+            tags = await self._extract(text)
+            self._cache.put(text, tags)
+            return tags
+        finally:
+            self._pending.pop(text, None)
+
+    def _on_done(self, task: asyncio.Task):
+        # 预取任务可能无人等待，在此取出异常避免未处理异常警告
+        if not task.cancelled() and task.exception() is not None:
+            self.ap.logger.warning(f"标签提取失败：{task.exception()}")
@@ -0,0 +1,112 @@
+import typing
+import numpy as np
+
+
+class TagMatrix:
+    """
+    长期记忆×标签 的稀疏二值矩阵（CSR格式）
+    每一行对应一条长期记忆，列为标签在 tags_index 中的编号
+    同时维护倒排索引（标签编号 -> 记忆编号列表），用于召回前筛选候选记忆
+    """
+
+    _indptr: typing.List[int]
+    _indices: typing.List[int]
+    _width: int
+    _postings: typing.Dict[int, typing.List[int]]
+    _arrays: typing.Optional[typing.Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]]
+
+    def __init__(self):
+        self.clear()
+
+    def __len__(self) -> int:
+        return len(self._indptr) - 1
+
+    def append_row(self, tag_ids: typing.Iterable[int]):
+        """
+        追加一条记忆的标签编号（重复编号只计一次）
+        """
+        row = sorted(set(tag_ids))
+        self._indices.extend(row)
+        row_id = len(self._indptr) - 1
+        for tag_id in row:
+            self._postings.setdefault(tag_id, []).append(row_id)
+        self._indptr.append(len(self._indices))
+        if row:
+            self._width = max(self._width, row[-1] + 1)
+        self._arrays = None
+
+    def clear(self):
+        self._indptr = [0]
+        self._indices = []
+        self._width = 0
+        self._postings = {}
+        self._arrays = None
+
+    def _get_arrays(self) -> typing.Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+        """
+        惰性生成 numpy 视图：行指针、列编号、每个非零元素所在行、行范数
+        仅在追加新行后重建一次
+        """
+        if self._arrays is None:
+            indptr = np.asarray(self._indptr, dtype=np.int64)
+            indices = np.asarray(self._indices, dtype=np.int64)
+            row_nnz = np.diff(indptr)
+            rows = np.repeat(np.arange(len(row_nnz), dtype=np.int64), row_nnz)
+            self._arrays = (indptr, indices, rows, np.sqrt(row_nnz))
+        return self._arrays
+
+    def candidates(self, query_ids: typing.Collection[int]) -> np.ndarray:
+        """
+        合并查询标签的倒排列表，返回至少命中一个标签的记忆编号（升序）
+        未命中任何标签的记忆相似度为0，不可能通过任一层级的准入
+        """
+        postings = [self._postings[tag_id] for tag_id in query_ids if tag_id in self._postings]
+        if not postings:
+            return np.empty(0, dtype=np.int64)
+        return np.unique(np.concatenate([np.asarray(posting, dtype=np.int64) for posting in postings]))
+
+    def document_frequency(self, tag_id: int) -> int:
+        """
+        包含该标签的记忆条数
+        """
+        return len(self._postings.get(tag_id, ()))
+
+    def _get_query(self, query_ids: typing.Collection[int]) -> np.ndarray:
+        query = np.zeros(max(self._width, max(query_ids) + 1), dtype=bool)
+        query[list(query_ids)] = True
+        return query
+
+    def dot(self, query_ids: typing.Collection[int], row_ids: typing.Optional[np.ndarray] = None) -> np.ndarray:
+        """
+        矩阵乘以二值查询向量，返回每条记忆命中的标签数
+        指定row_ids时只计算这些行，耗时与这些行的非零元素数成正比
+        """
+        indptr, indices, rows, _ = self._get_arrays()
+        size = len(self) if row_ids is None else len(row_ids)
+        if len(indices) == 0 or not query_ids or size == 0:
+            return np.zeros(size, dtype=np.int64)
+        query = self._get_query(query_ids)
+        if row_ids is None:
+            return np.bincount(rows[query[indices]], minlength=size)
+
+        # 只取出所选行的非零元素
+        starts = indptr[row_ids]
+        lengths = indptr[row_ids + 1] - starts
+        offsets = np.cumsum(lengths) - lengths
+        positions = np.repeat(starts - offsets, lengths) + np.arange(int(lengths.sum()), dtype=np.int64)
+        local_rows = np.repeat(np.arange(size, dtype=np.int64), lengths)
+        return np.bincount(local_rows[query[indices[positions]]], minlength=size)
+
+    def similarity(self, query_ids: typing.Collection[int], row_ids: typing.Optional[np.ndarray] = None) -> typing.Tuple[np.ndarray, np.ndarray]:
+        """
+        一次稀疏乘法计算记忆与查询的余弦相似度及命中数
+        :return: (相似度数组, 命中数数组)
+        """
+        hits = self.dot(query_ids, row_ids)
+        norms = self._get_arrays()[3]
+        if row_ids is not None:
+            norms = norms[row_ids]
+        denominator = norms * np.sqrt(len(query_ids))
+        similarities = np.zeros(len(hits), dtype=np.float64)
+        np.divide(hits, denominator, out=similarities, where=denominator > 0)
+        return similarities, hits
@@ -0,0 +1,41 @@
+import bisect
+import typing
+import numpy as np
+
+
+class Timeline:
+    """
+    按时间戳排序的记忆索引
+    各级召回通过 bisect 只取出自身时间窗口内的记忆编号
+    """
+
+    _timestamps: typing.List[float]
+    _ids: typing.List[int]
+
+    def __init__(self):
+        self.clear()
+
+    def __len__(self) -> int:
+        return len(self._ids)
+
+    def clear(self):
+        self._timestamps = []
+        self._ids = []
+
+    def add(self, timestamp: float, memory_id: int):
+        """
+        插入一条记忆，按时间顺序追加时为O(1)
+        """
+        pos = bisect.bisect_right(self._timestamps, timestamp)
+        self._timestamps.insert(pos, timestamp)
+        self._ids.insert(pos, memory_id)
+
+    def between(self, start: typing.Optional[float], end: typing.Optional[float]) -> np.ndarray:
+        """
+        返回时间戳位于 [start, end] 的记忆编号（升序），None表示不限
+        """
+        lo = 0 if start is None else bisect.bisect_left(self._timestamps, start)
+        hi = len(self._timestamps) if end is None else bisect.bisect_right(self._timestamps, end)
+        if lo >= hi:
+            return np.empty(0, dtype=np.int64)
+        return np.sort(np.asarray(self._ids[lo:hi], dtype=np.int64))
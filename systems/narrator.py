@@ -1,8 +1,10 @@
 import json
 from pkg.core import app
 from plugins.Waifu.cells.generator import Generator
+from plugins.Waifu.cells.llm_scheduler import LLMScheduler
 from plugins.Waifu.organs.memories import Memory
 from plugins.Waifu.cells.cards import Cards
+from plugins.Waifu.cells.storage import SqliteStorage
 
 
 class Narrator:
@@ -11,14 +13,15 @@ class Narrator:
 
     def __init__(self, ap: app.Application, launcher_id: str):
         self.ap = ap
-        self._generator = Generator(ap)
+        self._generator = Generator(ap, LLMScheduler.NARRATION)
+        self._launcher_id = launcher_id
         self._life_data_file = f"data/plugins/Waifu/data/life_{launcher_id}.json"
         self._profile = ""
         self._action = ""
         self._life_data = {}
 
     async def load_config(self):
-        self._load_life_data()
+        await self._load_life_data()
 
     async def narrate(self, memory: Memory, card: Cards) -> str:
         conversations = memory.short_term_memory[-memory.narrate_max_conversations :]
@@ -42,7 +45,10 @@ class Narrator:
         self._action = await self._generator.return_string(user_prompt)
         return self._action
 
-    def _load_life_data(self):
+    async def _load_life_data(self):
+        if SqliteStorage.enabled():
+            self._life_data = await SqliteStorage.load_life_data(self._launcher_id) or {}
+            return
         try:
             with open(self._life_data_file, "r") as f:
                 self._life_data = json.load(f)
@@ -1,9 +1,13 @@
 import json
 import re
+import typing
 from pkg.core import app
 from plugins.Waifu.cells.text_analyzer import TextAnalyzer
 from plugins.Waifu.cells.config import ConfigManager
+from plugins.Waifu.cells.persistence import Persistence
+from plugins.Waifu.cells.storage import SqliteStorage
 from plugins.Waifu.cells.generator import Generator
+from plugins.Waifu.cells.llm_scheduler import LLMScheduler
 from plugins.Waifu.organs.memories import Memory
 
 
@@ -13,7 +17,7 @@ class ValueGame:
 
     def __init__(self, ap: app.Application):
         self.ap = ap
-        self._generator = Generator(ap)
+        self._generator = Generator(ap, LLMScheduler.NARRATION)
         self._text_analyzer = TextAnalyzer(ap)
         self._value = 0
         self._manner_descriptions = []
@@ -21,6 +25,8 @@ class ValueGame:
         self._value_change = None
         self._config = None
         self._status_file = ""
+        self._launcher_id = ""
+        self._character = ""
         self._has_preset = True
 
     async def load_config(self, character: str, launcher_id: str, launcher_type: str):
@@ -30,32 +36,51 @@ class ValueGame:
         self._has_preset = True
 
         self._status_file = f"data/plugins/Waifu/data/{character}_{launcher_id}.json"
+        self._launcher_id = launcher_id
+        self._character = character
 
         character_config_path = f"data/plugins/Waifu/cards/{character}"
         self._config = ConfigManager(character_config_path, f"plugins/Waifu/templates/default_{launcher_type}")
         await self._config.load_config(completion=False)
 
+        if SqliteStorage.enabled():
+            value = await SqliteStorage.load_value(launcher_id, character)
+            self._value = 0 if value is None else value
+        else:
+            await self._load_value_from_status_file()
+
+        self._manner_descriptions = self._config.data.get("value_descriptions", [])
+        self._max_manner_change = self._config.data.get("max_manner_change", 10)
+
+    async def _load_value_from_status_file(self):
         try:
+            await Persistence.flush_file(self._status_file)
             with open(self._status_file, "r") as file:
                 data = json.load(file)
                 self._value = data.get("value", 0)
         except FileNotFoundError:
             self._value = 0
 
-        self._manner_descriptions = self._config.data.get("value_descriptions", [])
-        self._max_manner_change = self._config.data.get("max_manner_change", 10)
-
     async def determine_manner_change(self, memory: Memory, continued_count: int):
+        last_content = self.get_manner_change_content(memory, continued_count)
+        if last_content is not None:
+            await self.change_manner_by_sentiment(last_content)
+
+    def get_manner_change_content(self, memory: Memory, continued_count: int) -> typing.Optional[str]:
+        """
+        取得用于情绪分析的内容，不影响数值时返回 None；在回复之后立即同步调用，避免读到之后新增的对话
+        """
         if not self._has_preset:
-            return
+            return None
         last_speaker = memory.get_last_speaker(memory.short_term_memory)
         if last_speaker != memory.user_name:  # 只有用户发言可以影响到Value值变化
             self._value_change = None
-            return
+            return None
         count = continued_count + 1  # 继续发言次数 + 正常回复
         conversations = memory.short_term_memory[-count:]
-        last_content = memory.get_last_content(conversations)
+        return memory.get_last_content(conversations)
 
+    async def change_manner_by_sentiment(self, last_content: str):
         # self.ap.logger.info(f"情绪分析: {last_content}")
         sentiment_result = await self._text_analyzer.sentiment(text=last_content)
         positive_emotions = sentiment_result.get("positive_num", 0)
@@ -115,8 +140,10 @@ class ValueGame:
         self._save_value_to_status_file()
 
     def _save_value_to_status_file(self):
-        with open(self._status_file, "w") as file:
-            json.dump({"value": self._value}, file)
+        if SqliteStorage.enabled():
+            SqliteStorage.save_value(self._launcher_id, self._character, self._value)
+            return
+        Persistence.write(self._status_file, json.dumps({"value": self._value}))
 
     def reset_value(self):
         self._value = 0